@@ -147,6 +147,7 @@ def make_map(global_conf={}, app_conf={}):
        sort = "")
 
     mc('/health', controller='health', action='health')
+    mc('/health/locks', controller='health', action='locks')
     mc('/shutdown', controller='health', action='shutdown')
 
     mc('/', controller='hot', action='listing')
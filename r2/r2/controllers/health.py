@@ -7,6 +7,7 @@ from pylons import c, g
 
 from reddit_base import MinimalController
 from r2.lib.amqp import worker
+from r2.lib import lock
 
 from validator import *
 
@@ -22,7 +23,7 @@ class HealthController(MinimalController):
                 time.sleep(1)
 
             thread_pool.shutdown()
-            worker.join()
+            worker.drain(timeout = 30)
             os._exit(3)
 
         t = Thread(target = _shutdown)
@@ -55,3 +56,16 @@ class HealthController(MinimalController):
         c.response_content_type = 'text/plain'
         c.response.content = 'shutting down...'
         return c.response
+
+    @validate(secret=nop('secret'))
+    def GET_locks(self, secret):
+        """The contention counters of the locks taken in this process"""
+        if not g.shutdown_secret:
+            self.abort404()
+        if not secret or secret != g.shutdown_secret:
+            self.abort403()
+
+        c.dontcache = True
+        c.response_content_type = 'text/plain'
+        c.response.content = '\n'.join(lock.stats_report())
+        return c.response
@@ -20,16 +20,20 @@
 # CondeNet, Inc. All Rights Reserved.
 ################################################################################
 
-from Queue import Queue
-from threading import local, Thread
+from __future__ import with_statement
+from Queue import Queue, Empty, Full
+from threading import local, Thread, Lock, Condition
 from datetime import datetime
 import os
 import sys
+import atexit
 import time
 import errno
 import socket
+import select
 import itertools
 import pickle
+import re
 
 from amqplib import client_0_8 as amqp
 
@@ -41,6 +45,13 @@ amqp_pass = g.amqp_pass
 log = g.log
 amqp_virtual_host = g.amqp_virtual_host
 amqp_logging = g.amqp_logging
+amqp_consume = getattr(g, 'amqp_consume', False)
+amqp_prefetch = getattr(g, 'amqp_prefetch', None)
+amqp_max_wait = getattr(g, 'amqp_max_wait', None) or 0.1
+amqp_worker_threads = getattr(g, 'amqp_worker_threads', None) or 1
+amqp_worker_max_size = getattr(g, 'amqp_worker_max_size', None) or 0
+amqp_worker_when_full = getattr(g, 'amqp_worker_when_full', None) or 'block'
+amqp_worker_spill_dir = getattr(g, 'amqp_worker_spill_dir', None)
 
 connection = None
 channel = local()
@@ -52,30 +63,298 @@ have_init = False
 #amount of time while trying to get a connection amqp.
 
 class Worker:
-    def __init__(self):
-        self.q = Queue()
-        self.t = Thread(target=self._handle)
-        self.t.setDaemon(True)
-        self.t.start()
+    """A pool of `num_threads' threads that runs functions handed to
+       do() and publishes the messages handed to publish() in the
+       background.
+
+       At most `max_size' jobs (0 for no limit) are queued. When the
+       queue is full, `when_full' decides what happens to a new one:
+       'block' the caller until there's room, 'drop' it, or 'spill'
+       it to a file in `spill_dir' (which shouldn't be shared between
+       hosts) to be published by the next worker to start up once
+       this process has exited. Only publishes can be spilled (or
+       dropped); other jobs always block.
+
+       Each thread takes up to `batch_size' jobs at a time and runs
+       them in the order they were queued, publishing runs of
+       consecutive messages together. A batch doesn't publish anything
+       until the batches taken before it have finished, so messages
+       always go out after the jobs queued ahead of them; with more
+       than one thread, do() jobs in different batches can run at the
+       same time. Jobs queued from a worker thread never wait for room
+       (that could wait on the worker itself): if the queue is full,
+       they're run right away. See stats() for the queue depth and
+       how long jobs wait.
+
+       When the process exits we wait up to `drain_timeout' seconds
+       for the queue to empty (see drain())."""
+    def __init__(self, num_threads = 1, max_size = 0, when_full = 'block',
+                 spill_dir = None, batch_size = 100, drain_timeout = 10):
+        if when_full not in ('block', 'drop', 'spill'):
+            raise ValueError("unknown when_full %r" % when_full)
+        if when_full == 'spill' and not spill_dir:
+            raise ValueError("spilling needs a spill_dir")
+
+        self.q = Queue(max_size)
+        self.when_full = when_full
+        self.spill_dir = spill_dir
+        self.batch_size = batch_size
+        self.stats_lock = Lock()
+        self.publish_lock = Lock()
+        self.get_lock = Lock()
+        # batches are numbered as they're taken off the queue, and
+        # `finished' is the number of the first one not yet done
+        self.order = Condition()
+        self.next_batch = 0
+        self.finished = 0
+        self.finished_later = set()
+        self.local = local()
+        self._stats = dict(queued = 0, done = 0, errors = 0, inline = 0,
+                           dropped = 0, spilled = 0, unspilled = 0,
+                           corrupt = 0,
+                           max_depth = 0, total_wait = 0., max_wait = 0.)
+
+        self.threads = []
+        for x in xrange(num_threads):
+            t = Thread(target=self._handle)
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+
+        self.unspill_thread = None
+        if spill_dir:
+            t = self.unspill_thread = Thread(target=self._unspill)
+            t.setDaemon(True)
+            t.start()
+
+        # don't lose what's queued when the process exits
+        atexit.register(self.drain, drain_timeout)
+
+    def _count(self, **kw):
+        with self.stats_lock:
+            for k, v in kw.iteritems():
+                self._stats[k] += v
+
+    def stats(self):
+        with self.stats_lock:
+            stats = self._stats.copy()
+        stats['depth'] = self.q.qsize()
+        done = stats['done'] + stats['errors']
+        stats['avg_wait'] = stats['total_wait'] / done if done else 0.
+        return stats
 
     def _handle(self):
+        self.local.in_worker = True
         while True:
-            fn = self.q.get()
+            with self.get_lock:
+                jobs = [self.q.get()]
+                while len(jobs) < self.batch_size:
+                    try:
+                        jobs.append(self.q.get_nowait())
+                    except Empty:
+                        break
+                batch = self.next_batch
+                self.next_batch += 1
+
+            now = time.time()
+            waits = [now - queued for queued, job in jobs]
+            with self.stats_lock:
+                self._stats['total_wait'] += sum(waits)
+                self._stats['max_wait'] = max([self._stats['max_wait']]
+                                              + waits)
+
             try:
-                fn()
-                self.q.task_done()
-            except:
-                import traceback
-                print traceback.format_exc()
+                for is_publish, group in itertools.groupby(
+                        (job for queued, job in jobs),
+                        lambda job: isinstance(job, tuple)):
+                    group = list(group)
+                    if is_publish:
+                        self._wait_for(batch)
+                        self._run(len(group), self._publish, group)
+                    else:
+                        for fn in group:
+                            self._run(1, fn)
+            finally:
+                self._finish(batch)
+                for job in jobs:
+                    self.q.task_done()
+
+    def _wait_for(self, batch):
+        """Waits for every batch taken before `batch' to finish"""
+        with self.order:
+            while self.finished < batch:
+                self.order.wait()
+
+    def _finish(self, batch):
+        with self.order:
+            self.finished_later.add(batch)
+            while self.finished in self.finished_later:
+                self.finished_later.remove(self.finished)
+                self.finished += 1
+            self.order.notifyAll()
+
+    def _run(self, num_jobs, fn, *a):
+        try:
+            fn(*a)
+            self._count(done = num_jobs)
+        except:
+            self._count(errors = num_jobs)
+            import traceback
+            print traceback.format_exc()
+
+    def _publish(self, msgs):
+        # the amqp connection is shared, so only one thread can be
+        # writing to it at a time
+        with self.publish_lock:
+            for routing_key, body, message_id in msgs:
+                _add_item(routing_key, body, message_id = message_id)
+
+    def _put(self, job):
+        is_publish = isinstance(job, tuple)
+        in_worker = getattr(self.local, 'in_worker', False)
+        if not in_worker and (self.when_full == 'block' or not is_publish):
+            self.q.put((time.time(), job))
+        else:
+            try:
+                self.q.put_nowait((time.time(), job))
+            except Full:
+                if is_publish and self.when_full == 'spill':
+                    self._spill(job)
+                elif is_publish and self.when_full == 'drop':
+                    self._count(dropped = 1)
+                    log.error("amqp worker queue full, dropping %r" % (job,))
+                else:
+                    # we're a worker, so waiting for room could mean
+                    # waiting for ourselves
+                    self._count(inline = 1)
+                    if is_publish:
+                        self._run(1, self._publish, [job])
+                    else:
+                        self._run(1, job)
+                return
+
+        with self.stats_lock:
+            self._stats['queued'] += 1
+            self._stats['max_depth'] = max(self._stats['max_depth'],
+                                           self.q.qsize())
 
     def do(self, fn, *a, **kw):
         fn1 = lambda: fn(*a, **kw)
-        self.q.put(fn1)
+        self._put(fn1)
+
+    def publish(self, routing_key, body, message_id = None):
+        self._put((routing_key, body, message_id))
+
+    def _spill_file(self):
+        return os.path.join(self.spill_dir, 'amqp-%d.spill' % os.getpid())
+
+    def _spill(self, job):
+        with self.stats_lock:
+            with open(self._spill_file(), 'ab') as f:
+                pickle.dump(job, f, pickle.HIGHEST_PROTOCOL)
+            self._stats['spilled'] += 1
+
+    def _unspill(self):
+        """Queues up the publishes spilled by processes that have
+           exited, including any that a process exited part way through
+           publishing (so some of those may go out twice)"""
+        for fname in os.listdir(self.spill_dir):
+            # amqp-<writer pid>.spill, or amqp-<writer pid>.spill.<pid>
+            # once a process has claimed it
+            m = _spill_re.match(fname)
+            if not m:
+                continue
+            owner = int(m.group(3) or m.group(2))
+            if owner == os.getpid() or _pid_alive(owner):
+                continue
+
+            path = os.path.join(self.spill_dir, fname)
+            # renaming it first means only one process gets it
+            claimed = os.path.join(self.spill_dir,
+                                   '%s.%d' % (m.group(1), os.getpid()))
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                continue
+
+            with open(claimed, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                while f.tell() < size:
+                    start = f.tell()
+                    try:
+                        job = pickle.load(f)
+                        routing_key, body, message_id = job
+                    except Exception, e:
+                        # including a publish cut off part way through
+                        # being written
+                        log.error("skipping corrupt amqp spill record at "
+                                  "%s:%d (%r)" % (claimed, start, e))
+                        self._count(corrupt = 1)
+                        if not _next_pickle(f, start + 1):
+                            break
+                        continue
+                    self.publish(routing_key, body, message_id)
+                    self._count(unspilled = 1)
+            os.unlink(claimed)
 
     def join(self):
         self.q.join()
 
-worker = Worker()
+    def drain(self, timeout = None):
+        """Waits up to `timeout' seconds for the queued jobs to finish
+           (e.g. before the process exits). If they don't, any
+           publishes that are still queued are spilled, if we can.
+           Returns True if everything was handled."""
+        if timeout is None:
+            self.join()
+            return True
+
+        deadline = time.time() + timeout
+        while self.q.unfinished_tasks and time.time() < deadline:
+            time.sleep(.05)
+        if not self.q.unfinished_tasks:
+            return True
+
+        if self.spill_dir:
+            while True:
+                try:
+                    queued, job = self.q.get_nowait()
+                except Empty:
+                    break
+                if isinstance(job, tuple):
+                    self._spill(job)
+                self.q.task_done()
+        return False
+
+_spill_re = re.compile(r'^(amqp-(\d+)\.spill)(?:\.(\d+))?$')
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno != errno.ESRCH
+    return True
+
+def _next_pickle(f, pos, chunk_size = 64 * 1024):
+    """Seeks f to the next thing that looks like the start of a spilled
+       pickle at or after pos. Returns False if there isn't one"""
+    marker = '\x80' + chr(pickle.HIGHEST_PROTOCOL)
+    while True:
+        f.seek(pos)
+        chunk = f.read(chunk_size)
+        i = chunk.find(marker)
+        if i >= 0:
+            f.seek(pos + i)
+            return True
+        elif len(chunk) < chunk_size:
+            return False
+        # the marker could straddle the chunks
+        pos += len(chunk) - (len(marker) - 1)
+
+worker = Worker(num_threads = amqp_worker_threads,
+                max_size = amqp_worker_max_size,
+                when_full = amqp_worker_when_full,
+                spill_dir = amqp_worker_spill_dir)
 
 def get_connection():
     global connection
@@ -151,7 +430,7 @@ def _add_item(routing_key, body, message_id = None):
     except Exception as e:
         if e.errno == errno.EPIPE:
             get_channel(True)
-            add_item(routing_key, body, message_id)
+            _add_item(routing_key, body, message_id)
         else:
             raise
 
@@ -159,7 +438,7 @@ def add_item(routing_key, body, message_id = None):
     if amqp_host and amqp_logging:
         log.debug("amqp: adding item %r to %r" % (body, routing_key))
 
-    worker.do(_add_item, routing_key, body, message_id = message_id)
+    worker.publish(routing_key, body, message_id = message_id)
 
 def add_kw(routing_key, **kw):
     add_item(routing_key, pickle.dumps(kw))
@@ -170,6 +449,11 @@ def handle_items(queue, callback, ack = True, limit = 1, drain = False,
        connection to the queue is lost, it will die. Intended to be
        used as a long-running process."""
 
+    if amqp_consume:
+        return consume_items(queue, callback, ack = ack, limit = limit,
+                             drain = drain, verbose = verbose,
+                             sleep_time = sleep_time)
+
     chan = get_channel()
     countdown = None
 
@@ -224,6 +508,94 @@ def handle_items(queue, callback, ack = True, limit = 1, drain = False,
             raise
 
 
+def _wait_for_delivery(chan, timeout):
+    """Waits up to `timeout' seconds (forever if None) for something to
+       arrive on chan and dispatches it (e.g. to a basic_consume
+       callback). Returns False if nothing arrived in time."""
+    transport = chan.connection.transport
+    # anything already read off of the socket won't show up in select
+    if not chan.method_queue and not getattr(transport, '_read_buffer', None):
+        r, w, x = select.select([transport.sock], [], [], timeout)
+        if not r:
+            return False
+    chan.wait()
+    return True
+
+def consume_items(queue, callback, ack = True, limit = 1, drain = False,
+                  verbose = True, sleep_time = 1, prefetch = None,
+                  max_wait = None):
+    """Like handle_items, but the broker pushes messages to us with
+       basic_consume instead of us polling for them one at a time with
+       basic_get, so there's no sleeping when the queue is empty. Up
+       to `prefetch' (by default, `limit') unacked messages are sent
+       ahead. Once a message arrives, we wait up to `max_wait' seconds
+       for more to fill out a batch of `limit', and the whole batch is
+       acked at once.
+
+       With `drain', only the messages that are on the queue when we
+       start are handled (or as many as arrive before we've waited
+       `sleep_time' seconds for one)."""
+    chan = get_channel()
+    prefetch = prefetch or amqp_prefetch or limit
+    if max_wait is None:
+        max_wait = amqp_max_wait
+
+    countdown = None
+    if drain:
+        name, countdown, consumers = chan.queue_declare(queue, passive = True)
+        if not countdown:
+            return
+
+    pending = []
+    chan.basic_qos(0, prefetch, False)
+    consumer_tag = chan.basic_consume(queue, callback = pending.append)
+
+    try:
+        while countdown != 0:
+            while not pending:
+                if not _wait_for_delivery(chan,
+                                          sleep_time if drain else None):
+                    return
+
+            want = limit if countdown is None else min(limit, countdown)
+            deadline = time.time() + max_wait
+            while len(pending) < want:
+                timeout = deadline - time.time()
+                if timeout <= 0 or not _wait_for_delivery(chan, timeout):
+                    break
+
+            items = pending[:want]
+            del pending[:want]
+            if countdown is not None:
+                countdown -= len(items)
+
+            g.reset_caches()
+
+            try:
+                count_str = ''
+                if countdown is not None:
+                    count_str = '(%d remaining)' % countdown
+                if verbose:
+                    print "%s: %d items %s" % (queue, len(items), count_str)
+                callback(items, chan)
+
+                if ack:
+                    # acks everything up to and including the last one
+                    chan.basic_ack(items[-1].delivery_tag, multiple = True)
+
+                # flush any log messages printed by the callback
+                sys.stdout.flush()
+            except:
+                for item in items:
+                    # explicitly reject the items that we've not processed
+                    chan.basic_reject(item.delivery_tag, requeue = True)
+                raise
+    finally:
+        chan.basic_cancel(consumer_tag)
+        # hand back anything that was sent ahead but not handled
+        # (including anything still on its way to us)
+        chan.basic_recover(requeue = True)
+
 def empty_queue(queue):
     """debug function to completely erase the contents of a queue"""
     chan = get_channel()
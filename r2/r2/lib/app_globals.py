@@ -23,7 +23,7 @@ from __future__ import with_statement
 from pylons import config
 import pytz, os, logging, sys, socket, re, subprocess, random
 from datetime import timedelta, datetime
-from r2.lib.cache import LocalCache, SelfEmptyingCache
+from r2.lib.cache import LocalCache, SelfEmptyingCache, LRUCache
 from r2.lib.cache import CMemcache
 from r2.lib.cache import HardCache, MemcacheChain, MemcacheChain, HardcacheChain
 from r2.lib.cache import CassandraCache, CassandraCacheChain
@@ -54,11 +54,19 @@ class Globals(object):
                  'max_sr_images',
                  'num_serendipity',
                  'sr_dropdown_threshold',
+                 'local_cache_max_size',
+                 'local_cache_max_bytes',
+                 'amqp_prefetch',
+                 'amqp_worker_threads',
+                 'amqp_worker_max_size',
+                 'rising_max_per_sr',
                  ]
 
     float_props = ['min_promote_bid',
                    'max_promote_bid',
                    'usage_sampling',
+                   'query_coalesce_window',
+                   'amqp_max_wait',
                    ]
 
     bool_props = ['debug', 'translator',
@@ -68,6 +76,7 @@ class Globals(object):
                   'uncompressedJS',
                   'enable_doquery',
                   'use_query_cache',
+                  'pack_query_cache',
                   'write_query_queue',
                   'css_killswitch',
                   'db_create_tables',
@@ -75,6 +84,9 @@ class Globals(object):
                   'exception_logging',
                   'amqp_logging',
                   'read_only_mode',
+                  'lazy_comments',
+                  'lru_local_cache',
+                  'amqp_consume',
                   ]
 
     tuple_props = ['memcaches',
@@ -138,8 +150,6 @@ class Globals(object):
         # to cache_chains (closed around by reset_caches) so that they
         # can properly reset their local components
 
-        localcache_cls = (SelfEmptyingCache if self.running_as_script
-                          else LocalCache)
         num_mc_clients = self.num_mc_clients
 
         self.cache_chains = []
@@ -176,7 +186,7 @@ class Globals(object):
         self.dbm = self.load_db_params(global_conf)
 
         # can't do this until load_db_params() has been called
-        self.hardcache = HardcacheChain((localcache_cls(),
+        self.hardcache = HardcacheChain((self.make_localcache(),
                                          self.memcache,
                                          HardCache(self)),
                                         cache_negative_results = True)
@@ -299,15 +309,26 @@ class Globals(object):
             self.log.error("reddit app %s:%s started %s at %s" % (self.reddit_host, self.reddit_pid,
                                                                   self.short_version, datetime.now()))
 
+    def make_localcache(self):
+        """The cache at the front of each cache chain"""
+        if getattr(self, 'lru_local_cache', False):
+            kw = {}
+            if getattr(self, 'local_cache_max_size', None):
+                kw['max_size'] = self.local_cache_max_size
+            if getattr(self, 'local_cache_max_bytes', None):
+                kw['max_bytes'] = self.local_cache_max_bytes
+            return LRUCache(**kw)
+        elif self.running_as_script:
+            return SelfEmptyingCache()
+        else:
+            return LocalCache()
+
     def init_memcached(self, caches, **kw):
         return self.init_cass_cache(None, caches, None, memcached_kw = kw)
 
     def init_cass_cache(self, cluster, caches, cassandra_seeds,
                    memcached_kw = {}, cassandra_kw = {}):
-        localcache_cls = (SelfEmptyingCache if self.running_as_script
-                          else LocalCache)
-
-        pmc_chain = (localcache_cls(),)
+        pmc_chain = (self.make_localcache(),)
 
         # if caches, append
         if caches:
@@ -0,0 +1,50 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is Reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+#
+# All portions of the code written by CondeNet are Copyright (c) 2006-2010
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+"""
+Micro-benchmarks for the hot paths in r2. Each module compares the
+current implementation with the one it replaced on synthetic data, and
+is meant to be run with paster, e.g.:
+
+  paster run run.ini r2/lib/benchmarks/comment_tree_rebuild.py -c "run()"
+"""
+import time
+
+def best_of(fn, repeat = 3):
+    """Runs fn() `repeat' times and returns (best time in seconds,
+    result of the last run)"""
+    best = None
+    res = None
+    for x in xrange(repeat):
+        before = time.time()
+        res = fn()
+        elapsed = time.time() - before
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, res
+
+def report(name, old_time, new_time, same = None):
+    speedup = old_time / new_time if new_time else float('inf')
+    check = ''
+    if same is not None:
+        check = '  results %s' % ('match' if same else 'DIFFER')
+    print ('%-30s old %9.4fs  new %9.4fs  %7.1fx%s'
+           % (name, old_time, new_time, speedup, check))
@@ -0,0 +1,91 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is Reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+#
+# All portions of the code written by CondeNet are Copyright (c) 2006-2010
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+"""
+Compares inserting into and deleting from a CachedResults listing
+with merge_tuples()/remove_tuples() against the old chain, dedup and
+re-sort.
+"""
+import itertools
+import random
+
+from r2.lib.benchmarks import best_of, report
+from r2.lib.db.operators import desc
+from r2.lib.db.queries import merge_tuples, remove_tuples, precompute_limit
+from r2.lib.utils import UniqueIterator
+
+def old_insert_tuples(data, t):
+    data = itertools.chain(t, data)
+    data = UniqueIterator(data, key = lambda x: x[0])
+    data = sorted(data, key=lambda x: x[1:], reverse=True)
+    data = list(data)
+    return data[:precompute_limit]
+
+def old_remove_tuples(data, fnames):
+    return filter(lambda x: x[0] not in fnames, data)
+
+def make_listing(size, rand):
+    # a 'hot' listing: (fullname, hot, epoch)
+    data = [('t3_%d' % i, round(rand.uniform(0, 5000), 7),
+             1280000000 + rand.randint(0, 86400 * 30))
+            for i in xrange(size)]
+    data.sort(key = lambda x: x[1:], reverse = True)
+    return data
+
+def run(size = precompute_limit, batches = (1, 10, 100), rounds = 100):
+    rand = random.Random(1)
+    sort = [desc('_hot'), desc('_date')]
+    data = make_listing(size, rand)
+
+    for k in batches:
+        # half of every batch is already in the listing (a vote on a
+        # listed link) and half is new
+        inserts = []
+        for x in xrange(rounds):
+            old = [(t[0], round(rand.uniform(0, 5000), 7), t[2])
+                   for t in rand.sample(data, k // 2)]
+            new = [('t3_new%d' % rand.randint(0, 10 ** 9),
+                    round(rand.uniform(0, 5000), 7),
+                    1280000000 + rand.randint(0, 86400 * 30))
+                   for y in xrange(k - k // 2)]
+            inserts.append(old + new)
+
+        def _old():
+            return [old_insert_tuples(data, t) for t in inserts]
+        def _new():
+            return [merge_tuples(data, t, sort, limit = precompute_limit)
+                    for t in inserts]
+        old_time, old_res = best_of(_old)
+        new_time, new_res = best_of(_new)
+        report('insert %d into %d' % (k, size), old_time, new_time,
+               same = (old_res == new_res))
+
+        deletes = [set(t[0] for t in rand.sample(data, k))
+                   for x in xrange(rounds)]
+        old_time, old_res = best_of(
+            lambda: [old_remove_tuples(data, f) for f in deletes])
+        new_time, new_res = best_of(
+            lambda: [remove_tuples(data, f) for f in deletes])
+        report('delete %d from %d' % (k, size), old_time, new_time,
+               same = (old_res == new_res))
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,108 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is Reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+#
+# All portions of the code written by CondeNet are Copyright (c) 2006-2010
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+"""
+Compares the old quadratic rebuild of a link's comment tree with
+compute_link_comments() on synthetic threads of different shapes.
+"""
+import random
+
+from r2.lib.benchmarks import best_of, report
+from r2.lib.comment_tree import compute_link_comments
+
+class FakeComment(object):
+    def __init__(self, _id, parent_id):
+        self._id = _id
+        self.parent_id = parent_id
+
+def flat_thread(size):
+    return [FakeComment(i, None) for i in xrange(1, size + 1)]
+
+def deep_thread(size):
+    return [FakeComment(i, i - 1 if i > 1 else None)
+            for i in xrange(1, size + 1)]
+
+def bushy_thread(size, seed = 1):
+    # each new comment replies to a random earlier comment, or starts
+    # a new top-level thread 10% of the time
+    rand = random.Random(seed)
+    comments = []
+    for i in xrange(1, size + 1):
+        if i == 1 or rand.random() < .1:
+            p_id = None
+        else:
+            p_id = rand.randint(1, i - 1)
+        comments.append(FakeComment(i, p_id))
+    return comments
+
+shapes = dict(flat = flat_thread, deep = deep_thread, bushy = bushy_thread)
+
+def old_compute_link_comments(comments):
+    """The rebuild as it was before compute_link_comments: a BFS for
+    the depths, then a separate BFS from every comment to count its
+    children"""
+    cids = [c._id for c in comments]
+
+    comment_tree = {}
+    for cm in comments:
+        p_id = cm.parent_id
+        comment_tree.setdefault(p_id, []).append(cm._id)
+
+    depth = {}
+    level = 0
+    cur_level = comment_tree.get(None, ())
+    while cur_level:
+        next_level = []
+        for cm_id in cur_level:
+            depth[cm_id] = level
+            next_level.extend(comment_tree.get(cm_id, ()))
+        cur_level = next_level
+        level += 1
+
+    num_children = {}
+    for cm_id in cids:
+        num = 0
+        todo = [cm_id]
+        while todo:
+            more = comment_tree.get(todo.pop(0), ())
+            num += len(more)
+            todo.extend(more)
+        num_children[cm_id] = num
+
+    return cids, comment_tree, depth, num_children
+
+def run(sizes = (1000, 10000, 100000), max_old_size = 10000):
+    """The old rebuild is quadratic on deep threads, so it's skipped
+    for sizes over max_old_size"""
+    for size in sizes:
+        for name, shape in sorted(shapes.iteritems()):
+            comments = shape(size)
+            new_time, new = best_of(lambda: compute_link_comments(comments))
+            label = '%s %d' % (name, size)
+            if size > max_old_size and name != 'flat':
+                print '%-30s new %9.4fs  (old skipped)' % (label, new_time)
+                continue
+            old_time, old = best_of(
+                lambda: old_compute_link_comments(comments), repeat = 1)
+            report(label, old_time, new_time, same = (old == new))
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,67 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is Reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+#
+# All portions of the code written by CondeNet are Copyright (c) 2006-2010
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+"""
+Compares looking up links by id with one OR branch per id (what
+tdb_sql.fetch_query used to do) against the chunked = ANY(array)
+lookups, both for building the statement and for running it against
+the configured databases.
+"""
+import random
+
+import sqlalchemy as sa
+
+from r2.lib.benchmarks import best_of, report
+from r2.lib.db import tdb_sql
+from r2.models import Link
+
+def old_select(table, id_col, ids):
+    return sa.select([table], sa.or_(*[id_col == i for i in ids]))
+
+def new_select(table, id_col, ids):
+    return sa.select([table], id_col == sa.func.any(sa.bindparam('ids', ids)))
+
+def old_fetch(table, id_col, ids):
+    return old_select(table, id_col, ids).execute().fetchall()
+
+def run(sizes = (10, 100, 10000)):
+    read_table = lambda: tdb_sql.get_thing_table(Link._type_id)[0]
+    table = read_table()
+    id_col = table.c.thing_id
+    max_id = sa.select([sa.func.max(id_col)]).execute().scalar() or 0
+
+    rand = random.Random(1)
+    for size in sizes:
+        ids = [rand.randint(1, max(max_id, size)) for x in xrange(size)]
+
+        old_time, x = best_of(lambda: str(old_select(table, id_col, ids)))
+        new_time, x = best_of(lambda: str(new_select(table, id_col, ids)))
+        report('%d ids, compile' % size, old_time, new_time)
+
+        old_time, old = best_of(lambda: old_fetch(table, id_col, ids))
+        new_time, (new, single) = best_of(lambda: tdb_sql.fetch_query(
+                table, id_col, ids, read_table))
+        report('%d ids, fetch' % size, old_time, new_time,
+               sorted(r.thing_id for r in old) ==
+               sorted(r.thing_id for r in new))
+
+if __name__ == '__main__':
+    run()
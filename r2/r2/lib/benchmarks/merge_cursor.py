@@ -0,0 +1,138 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is Reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+#
+# All portions of the code written by CondeNet are Copyright (c) 2006-2010
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+"""
+Compares merging Merge sub-queries one cursor and one item at a time
+(what MergeCursor used to do) against running them concurrently and
+merging them with a heap, on synthetic cursors that sleep to stand in
+for the round trip to each database.
+"""
+import random
+import time
+
+from r2.lib.benchmarks import best_of, report
+from r2.lib.db import operators
+from r2.lib.db.thing import MultiCursor, MergeCursor, NotFound
+
+class OldMergeCursor(MultiCursor):
+    def _execute(self, cursors, sorts):
+        #a "pair" is a (cursor, item, done) tuple
+        def safe_next(c):
+            try:
+                #hack to keep searching even if fetching a thing returns notfound
+                while True:
+                    try:
+                        return [c, c.fetchone(), False]
+                    except NotFound:
+                        #skips the broken item
+                        pass
+            except StopIteration:
+                return c, None, True
+
+        def undone(pairs):
+            return [p for p in pairs if not p[2]]
+
+        pairs = undone(safe_next(c) for c in cursors)
+
+        while pairs:
+            #only one query left, just dump it
+            if len(pairs) == 1:
+                c, item, done = pair = pairs[0]
+                while not done:
+                    yield item
+                    c, item, done = safe_next(c)
+                    pair[:] = c, item, done
+            else:
+                #by default, yield the first item
+                yield_pair = pairs[0]
+                for s in sorts:
+                    col = s.col
+                    #sort direction?
+                    max_fn = min if isinstance(s, operators.asc) else max
+
+                    #find the max (or min) val
+                    vals = [(getattr(i[1], col), i) for i in pairs]
+                    max_pair = vals[0]
+                    all_equal = True
+                    for pair in vals[1:]:
+                        if all_equal and pair[0] != max_pair[0]:
+                            all_equal = False
+                        max_pair = max_fn(max_pair, pair, key=lambda x: x[0])
+
+                    if not all_equal:
+                        yield_pair = max_pair[1]
+                        break
+
+                c, item, done = yield_pair
+                yield item
+                yield_pair[:] = safe_next(c)
+
+            pairs = undone(pairs)
+        raise StopIteration
+
+class FakeThing(object):
+    def __init__(self, id, hot, date):
+        self._id = id
+        self._hot = hot
+        self._date = date
+
+class FakeCursor(object):
+    """a cursor over items that waits latency seconds before the
+    first one, as a query would"""
+    def __init__(self, items, latency):
+        self.items = iter(items)
+        self.latency = latency
+
+    def fetchone(self):
+        if self.latency:
+            time.sleep(self.latency)
+            self.latency = 0
+        return self.items.next()
+
+def make_lists(num_cursors, per_cursor, sorts):
+    rand = random.Random(1)
+    lists = []
+    for i in xrange(num_cursors):
+        items = [FakeThing((i, j), rand.random(), rand.random())
+                 for j in xrange(per_cursor)]
+        items.sort(key = lambda x: tuple(-getattr(x, s.col)
+                                          if isinstance(s, operators.desc)
+                                          else getattr(x, s.col)
+                                          for s in sorts))
+        lists.append(items)
+    return lists
+
+def run(latency = 0.02, per_cursor = 1000):
+    sorts = [operators.desc('_hot'), operators.desc('_date')]
+    for num_cursors in (2, 4, 8):
+        lists = make_lists(num_cursors, per_cursor, sorts)
+        old = lambda: [x._id for x in OldMergeCursor(
+                [FakeCursor(l, latency) for l in lists], sorts).fetchall()]
+        new = lambda: [x._id for x in MergeCursor(
+                [lambda l = l: FakeCursor(l, latency) for l in lists],
+                sorts).fetchall()]
+        old_time, old_res = best_of(old)
+        new_time, new_res = best_of(new)
+        report('%d cursors x %d' % (num_cursors, per_cursor),
+               old_time, new_time, old_res == new_res)
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,63 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is Reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+#
+# All portions of the code written by CondeNet are Copyright (c) 2006-2010
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+"""
+Compares interleaving the normalized hot lists of many subreddits (as
+on the front page of a user with lots of subscriptions) with numpy
+against the plain Python implementation.
+"""
+import random
+
+from r2.lib.benchmarks import best_of, report
+from r2.lib import normalized_hot
+from r2.lib.normalized_hot import max_items
+
+def make_hots(num_srs, rand, now = 1280000000):
+    # some subreddits are tiny, and every one has a few links that
+    # are too old to show
+    hots = []
+    for x in xrange(num_srs):
+        size = rand.choice((0, 5, 50, max_items, max_items + 50))
+        items = [('t3_%d_%d' % (x, i),
+                  round(rand.uniform(-100, 5000), 7),
+                  now - rand.randint(0, 86400 * 40))
+                 for i in xrange(size)]
+        items.sort(key = lambda t: t[1:], reverse = True)
+        hots.append(items)
+    return hots
+
+def run(sizes = (10, 100, 1000)):
+    if normalized_hot.numpy is None:
+        print 'numpy is not installed'
+        return
+
+    rand = random.Random(1)
+    age_limit = 1280000000 - 86400 * 30
+    for num_srs in sizes:
+        hots = make_hots(num_srs, rand)
+        old_time, old = best_of(lambda: normalized_hot._normalize_hot(
+                hots, age_limit))
+        new_time, new = best_of(lambda: normalized_hot._normalize_hot_numpy(
+                hots, age_limit))
+        report('%d subreddits' % num_srs, old_time, new_time, old == new)
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,87 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is Reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+#
+# All portions of the code written by CondeNet are Copyright (c) 2006-2010
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+"""
+Compares building a user's organic list by scanning every counted link
+(what cached_organic_links did on each cache miss) with merging the
+precomputed per-subreddit pools, for a few synthetic subscription
+distributions.
+"""
+import random
+
+from r2.lib.benchmarks import best_of, report
+from r2.lib.organic import _build_pools, _merge_pools, organic_max_length
+
+def make_link_counts(num_links, num_srs, rand):
+    # subreddit sizes roughly follow a power law, like the real ones
+    weights = [1. / (i + 1) for i in xrange(num_srs)]
+    total = sum(weights)
+    cumulative = []
+    acc = 0
+    for w in weights:
+        acc += w / total
+        cumulative.append(acc)
+
+    def pick_sr():
+        x = rand.random()
+        for sr_id, c in enumerate(cumulative):
+            if x <= c:
+                return sr_id
+        return num_srs - 1
+
+    return dict(('t3_%d' % i, (rand.randint(0, 1000), pick_sr()))
+                for i in xrange(num_links))
+
+def make_subscriptions(kind, num_users, num_srs, rand):
+    if kind == 'defaults':
+        return [tuple(range(20))] * num_users
+    elif kind == 'small':
+        size = lambda: rand.randint(1, 10)
+    elif kind == 'large':
+        size = lambda: rand.randint(50, 200)
+    return [tuple(sorted(rand.sample(xrange(num_srs), size())))
+            for x in xrange(num_users)]
+
+def old_organic(link_counts, sr_ids):
+    link_names = filter(lambda n: link_counts[n][1] in sr_ids,
+                        link_counts.keys())
+    link_names.sort(key = lambda n: (link_counts[n][0], n))
+    return link_names[:organic_max_length]
+
+def run(num_links = 20000, num_srs = 2000, num_users = 50):
+    rand = random.Random(1)
+    link_counts = make_link_counts(num_links, num_srs, rand)
+
+    pools_time, pools = best_of(lambda: _build_pools(link_counts))
+    print 'building pools for %d links: %.4fs' % (num_links, pools_time)
+
+    for kind in ('defaults', 'small', 'large'):
+        subs = make_subscriptions(kind, num_users, num_srs, rand)
+        old_time, old = best_of(lambda: [old_organic(link_counts, s)
+                                         for s in subs])
+        new_time, new = best_of(lambda: [
+                _merge_pools([pools[i] for i in s if i in pools])
+                for s in subs])
+        report('%d users, %s' % (num_users, kind), old_time, new_time,
+               old == new)
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,80 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is Reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+#
+# All portions of the code written by CondeNet are Copyright (c) 2006-2010
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+"""
+Compares building and compiling the select for every find_things,
+find_data and find_rels call (what tdb_sql used to do) against
+reusing the compiled selects in tdb_sql.query_cache, for the shapes
+of the link listings, comment pages and vote lookups.
+"""
+from copy import deepcopy
+
+from r2.lib.benchmarks import best_of, report
+from r2.lib.db import tdb_sql
+from r2.lib.db.operators import desc
+from r2.models import Account, Link, Comment, Vote
+
+def old_query(tables, sort, limit, constraints, build):
+    return str(build(tables, sort, limit, deepcopy(constraints)))
+
+def new_query(kind, tables, sort, limit, constraints, is_data, build):
+    compiled, params = tdb_sql.compiled_query(kind, tables, sort, limit,
+                                              constraints, is_data, build)
+    return str(compiled)
+
+def run(calls = 1000):
+    is_data = lambda key: not key.startswith('_')
+    link_tables = tdb_sql.get_thing_table(Link._type_id)
+    comment_tables = tdb_sql.get_thing_table(Comment._type_id)
+    LinkVote = Vote.rel(Account, Link)
+    vote_tables = tdb_sql.get_rel_table(LinkVote._type_id)
+
+    shapes = [
+        ('links by sr_id', 'find_data', link_tables, desc('_date'), 25,
+         lambda i: [Link.c.sr_id == (i, i + 1), Link.c._deleted == False,
+                    Link.c._spam == False],
+         tdb_sql._find_data),
+        ('comments by link_id', 'find_data', comment_tables, None, None,
+         lambda i: [Comment.c.link_id == i], tdb_sql._find_data),
+        ('votes by thing1/thing2', 'find_rels', vote_tables, None, None,
+         lambda i: [LinkVote.c._thing1_id == i,
+                    LinkVote.c._thing2_id == (i, i + 1, i + 2)],
+         tdb_sql._find_rels),
+        ]
+
+    for name, kind, tables, sort, limit, rules, build in shapes:
+        def old():
+            for i in xrange(calls):
+                q = old_query(tables, sort, limit, rules(i), build)
+            return q
+        def new():
+            for i in xrange(calls):
+                q = new_query(kind, tables, sort, limit, rules(i), is_data,
+                              build)
+            return q
+        old_time, x = best_of(old)
+        new_time, x = best_of(new)
+        report('%s, %d calls' % (name, calls), old_time, new_time)
+
+    print tdb_sql.query_cache_stats
+
+if __name__ == '__main__':
+    run()
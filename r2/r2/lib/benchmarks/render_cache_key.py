@@ -0,0 +1,191 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is Reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+#
+# All portions of the code written by CondeNet are Copyright (c) 2006-2010
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+"""
+Times generating (and hashing, as _read_cache and _write_cache do) the
+render cache keys of a synthetic 100 link listing with the old
+CachedTemplate.cache_key and the current one. Pass profile = True to
+run() for a cProfile breakdown of the current implementation.
+
+run_real() does the same for the newest links in the db, wrapped as a
+listing page wraps them, and reports how many of their keys could be
+reused.
+"""
+from datetime import datetime, timedelta
+from hashlib import md5
+import random
+
+from pylons import c, g
+
+from r2.lib.benchmarks import best_of, report
+from r2.lib.wrapped import Wrapped, CachedVariable, make_cachable, hash_key
+
+class FakeTemplate(object):
+    hash = 'd41d8cd98f00b204e9800998ecf8427e'
+
+class FakeLink(object):
+    cache_ignore = set(['score', 'voting_score', 'display_score',
+                        'timesince', 'votehash'])
+
+    def __init__(self, i, rand):
+        self._fullname = 't3_%d' % i
+        self._spam = False
+        self.reported = 0
+        self.title = u'link number %d \u2013 %s' % (i, 'x' * rand.randint(10, 200))
+        self.url = 'http://example.com/%d/%s' % (i, 'y' * rand.randint(0, 80))
+        self.domain = 'example.com'
+        self.author_id = rand.randint(1, 10000)
+        self.sr_id = rand.randint(1, 500)
+        self._date = datetime(2010, 1, 1) + timedelta(seconds = i)
+        self.num_comments = rand.randint(0, 2000)
+        self.over_18 = rand.random() < .1
+        self.likes = rand.choice((True, False, None))
+        self.saved = self.hidden = self.clicked = False
+        self.thumbnail = '/static/noimage.png'
+        self.voting_score = [1, 2, 3]
+
+    @staticmethod
+    def wrapped_cache_key(wrapped, style):
+        return [wrapped._fullname, wrapped._spam, wrapped.reported]
+
+class BenchWrapped(Wrapped):
+    cachable = True
+
+    def template(self, style = 'html'):
+        return FakeTemplate
+
+def make_listing(rand, num_links = 100):
+    res = []
+    for i in xrange(num_links):
+        link = FakeLink(i, rand)
+        w = BenchWrapped(link)
+        # the props the builder and add_props copy onto the wrapper
+        for k in ('_fullname', 'title', 'url', 'domain', 'author_id',
+                  'sr_id', 'num_comments', 'over_18', 'likes', 'saved',
+                  'hidden', 'clicked', 'thumbnail', 'voting_score'):
+            getattr(w, k)
+        w.num = i + 1
+        w.rowstyle = 'odd' if i % 2 else 'even'
+        w.timesince = CachedVariable("timesince")
+        w.votehash = CachedVariable("votehash")
+        res.append(w)
+    return res
+
+def old_cache_key(self, attr, style, *a):
+    template_hash = getattr(self.template(style), "hash",
+                            id(self.__class__))
+    keys = [c.user_is_loggedin, c.user_is_admin, c.domain_prefix,
+            style, c.cname, c.lang, c.site.path,
+            template_hash, g.markdown_backend]
+    keys = [make_cachable(x, *a) for x in keys]
+    for i, l in enumerate(self.lookups):
+        if hasattr(l, "wrapped_cache_key"):
+            setattr(self, "lookup%d_cache_key" % i,
+                    ''.join(map(repr, l.wrapped_cache_key(self, style))))
+    auto_keys = [(k,  make_cachable(v, attr, style, *a))
+                 for k, v in self.cachable_attrs()]
+    keys.append(repr(auto_keys))
+    keys.extend(make_cachable(x) for x in a)
+    key = "<%s:[%s]>" % (self.__class__.__name__, u''.join(keys))
+    # once for the get_multi and again for the set_multi
+    md5(key).hexdigest()
+    return md5(key).hexdigest()
+
+def new_cache_key(self, attr, style):
+    key = self.cache_key(attr, style)
+    hash_key(key)
+    return hash_key(key)
+
+def time_keys(fn, listings, times = 1):
+    def keys():
+        listing = listings.pop()
+        for x in xrange(times):
+            res = [fn(w, None, 'html') for w in listing]
+        return res
+    return best_of(keys)[0]
+
+def run(repeat = 3, profile = False):
+    rand = random.Random(1)
+    make = lambda: [make_listing(rand) for x in xrange(repeat)]
+
+    # the first key of a listing, and the repeated keys for listings
+    # whose things are keyed again (e.g. by an enclosing template)
+    for name, times in (('100 links, first key', 1),
+                        ('100 links, keyed 3 times', 3)):
+        old_time = time_keys(old_cache_key, make(), times)
+        new_time = time_keys(new_cache_key, make(), times)
+        report(name, old_time, new_time)
+
+    if profile:
+        import cProfile, pstats
+        listing = make_listing(rand)
+        prof = cProfile.Profile()
+        prof.runcall(lambda: [new_cache_key(w, None, 'html')
+                              for w in listing])
+        pstats.Stats(prof).sort_stats('cumulative').print_stats(15)
+
+class LoggedOutContext(object):
+    """enough of c for wrapping and keying a listing for a logged out
+    user"""
+    user_is_loggedin = user_is_admin = user_is_sponsor = False
+    cname = profilepage = False
+    domain_prefix = None
+    lang = 'en'
+    render_style = 'html'
+
+    def __getattr__(self, attr):
+        return None
+
+def real_listing(num_links):
+    from r2.lib.db.operators import desc
+    from r2.lib.pages.things import default_thing_wrapper
+    from r2.models import Link
+    from r2.models.builder import Builder
+
+    links = list(Link._query(sort = desc('_date'), limit = num_links,
+                             data = True))
+    return Builder(wrap = default_thing_wrapper()).wrap_items(links)
+
+def run_real(num_links = 100, repeat = 3):
+    from r2.models import FakeAccount, Default
+
+    context = LoggedOutContext()
+    context.user = FakeAccount()
+    context.site = Default
+    c._push_object(context)
+    try:
+        make = lambda: [real_listing(num_links) for x in xrange(repeat)]
+        for times in (1, 3):
+            old_time = time_keys(old_cache_key, make(), times)
+            new_time = time_keys(new_cache_key, make(), times)
+            report('%d real links, keyed %d times' % (num_links, times),
+                   old_time, new_time)
+
+        listing = real_listing(num_links)
+        for w in listing:
+            w.cache_key(None, 'html')
+        print '%d of %d keys can be reused' % (
+            sum('_cache_key' in w.__dict__ for w in listing), len(listing))
+    finally:
+        c._pop_object()
+
+if __name__ == '__main__':
+    run()
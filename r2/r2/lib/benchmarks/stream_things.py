@@ -0,0 +1,53 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is Reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+#
+# All portions of the code written by CondeNet are Copyright (c) 2006-2010
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+"""
+Compares walking a whole thing table with fetch_things2's keyset
+pages of chunk_size (re-running the query after every page and
+loading the things through the cache) against streaming it on a
+server-side cursor, in things per second.
+"""
+from r2.lib.benchmarks import best_of, report
+from r2.lib.db.operators import asc
+from r2.lib.utils import fetch_things2
+from r2.models import Account, Link
+
+def walk(query, stream, chunk_size):
+    return [x._id for x in fetch_things2(query(), chunk_size,
+                                         stream = stream)]
+
+def run(kinds = (Account, Link), data = True, chunk_size = 100,
+        batch_size = 1000, repeat = 1):
+    for kind in kinds:
+        query = lambda: kind._query(sort = asc('_date'), data = data)
+
+        old_time, old = best_of(lambda: walk(query, False, chunk_size),
+                                repeat)
+        new_time, new = best_of(lambda: walk(query, True, batch_size),
+                                repeat)
+        report('%s, %d things' % (kind.__name__, len(new)),
+               old_time, new_time, old == new)
+        print '    old %9.0f things/s  new %9.0f things/s' % (
+            len(old) / old_time if old_time else 0,
+            len(new) / new_time if new_time else 0)
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,145 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is Reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+#
+# All portions of the code written by CondeNet are Copyright (c) 2006-2010
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+"""
+Replays a synthetic stream of votes, like register_vote_q sees at
+peak, through the aggregation that Vote.vote_batch and handle_votes
+do. For each batch size it counts the score, karma, vote count and
+listing writes that the stream comes down to; a batch size of 1 is
+the old vote-at-a-time processing.
+
+The stream is generated from a seed, and can be saved with
+save_stream() and replayed with run(stream = load_stream(path)).
+"""
+from __future__ import with_statement
+import cPickle as pickle
+import random
+import time
+
+from r2.models.vote import VoteBatch, score_changes
+
+class FakeThing(object):
+    def __init__(self, _id, **kw):
+        self._id = _id
+        self.__dict__.update(kw)
+
+class FakeVote(object):
+    def __init__(self, name, valid_thing, valid_user):
+        self._name = name
+        self.valid_thing = valid_thing
+        self.valid_user = valid_user
+
+def make_stream(num_votes = 10000, num_users = 2000, num_links = 500,
+                num_srs = 50, seed = 1):
+    """(user id, link id, sr id, author id, dir) tuples. Votes are
+    skewed towards a few hot links, like they are on the front page"""
+    rand = random.Random(seed)
+    links = [(i, rand.randint(1, num_srs), rand.randint(1, num_users))
+             for i in xrange(num_links)]
+    stream = []
+    for x in xrange(num_votes):
+        link_id, sr_id, author_id = links[int(rand.paretovariate(1.2))
+                                          % num_links]
+        dir = rand.choice((True, True, True, False, None))
+        stream.append((rand.randint(1, num_users), link_id, sr_id,
+                       author_id, dir))
+    return stream
+
+def save_stream(stream, path):
+    with open(path, 'wb') as f:
+        pickle.dump(stream, f, pickle.HIGHEST_PROTOCOL)
+
+def load_stream(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+def replay(stream, batch_size):
+    """Returns the number of each kind of write that applying `stream'
+    in batches of `batch_size' takes"""
+    srs = {}
+    links = {}
+    users = {}
+    def get(d, _id, **kw):
+        if _id not in d:
+            d[_id] = FakeThing(_id, **kw)
+        return d[_id]
+
+    current = {}
+    writes = dict(votes = 0, scores = 0, karma = 0, counts = 0,
+                  listings = 0, user_listings = 0)
+    for start in xrange(0, len(stream), batch_size):
+        batch = stream[start:start + batch_size]
+
+        # only the last vote by a user on a link counts
+        latest = {}
+        for i, (uid, link_id, sr_id, author_id, dir) in enumerate(batch):
+            latest[(uid, link_id)] = i
+        batch = [batch[i] for i in sorted(latest.itervalues())]
+
+        votes = VoteBatch()
+        vote_srs = set()
+        for uid, link_id, sr_id, author_id, dir in batch:
+            sub = get(users, uid)
+            sr = get(srs, sr_id)
+            obj = get(links, link_id, _fullname = 't3_%d' % link_id,
+                      author_id = author_id)
+
+            amount = 1 if dir is True else 0 if dir is None else -1
+            oldamount = current.get((uid, link_id))
+            current[(uid, link_id)] = amount
+            up_change, down_change = score_changes(amount, oldamount or 0)
+
+            v = FakeVote(str(amount), True, uid != author_id)
+            votes.add(sub, obj, v, 'link', sr, oldamount is None, amount,
+                      up_change, down_change, True)
+            vote_srs.add(sr_id)
+
+        writes['votes'] += len(votes.votes)
+        writes['scores'] += sum(bool(ups) + bool(downs) for obj, ups, downs
+                                in votes.scores.itervalues())
+        writes['karma'] += sum(1 for sr, amount in votes.karma.itervalues()
+                               if amount)
+        writes['counts'] += len(votes.counts)
+        # the hot listing (plus the batched top/controversial ones) of
+        # each subreddit, and each voter's liked and disliked
+        writes['listings'] += len(vote_srs)
+        writes['user_listings'] += 2 * len(set(uid for uid, l, s, a, d
+                                               in batch))
+    return writes
+
+def run(stream = None, batch_sizes = (1, 10, 100, 500)):
+    if stream is None:
+        stream = make_stream()
+    print '%d votes' % len(stream)
+    kinds = ('votes', 'scores', 'karma', 'counts', 'listings',
+             'user_listings')
+    print '%-8s %s %9s' % ('batch', ' '.join('%13s' % k for k in kinds),
+                           'secs')
+    for batch_size in batch_sizes:
+        before = time.time()
+        writes = replay(stream, batch_size)
+        elapsed = time.time() - before
+        print '%-8d %s %9.4f' % (batch_size,
+                                 ' '.join('%13d' % writes[k] for k in kinds),
+                                 elapsed)
+
+if __name__ == '__main__':
+    run()
@@ -19,9 +19,14 @@
 # All portions of the code written by CondeNet are Copyright (c) 2006-2010
 # CondeNet, Inc. All Rights Reserved.
 ################################################################################
+from __future__ import with_statement
 from threading import local
 from hashlib import md5
+from time import time as _time
+import cPickle
 import pickle
+import sys
+import threading
 
 import pylibmc
 from _pylibmc import MemcachedError
@@ -387,6 +392,189 @@ class LocalCache(dict, CacheUtils):
     def flush_all(self):
         self.clear()
 
+    def fresh(self):
+        """An empty cache configured like this one (see
+        CacheChain.reset)"""
+        return self.__class__()
+
+# what the LRUCaches in this process have done. They're replaced for
+# every request (see CacheChain.reset), so they can't keep count
+# themselves
+lru_stats = dict(hits = 0, misses = 0, evictions = 0, expired = 0)
+_lru_stats_lock = threading.Lock()
+
+def _lru_count(what, n = 1):
+    with _lru_stats_lock:
+        lru_stats[what] += n
+
+class LRUCache(LocalCache):
+    """A LocalCache for long-running processes. It holds at most
+    `max_size' items taking up roughly `max_bytes' (going by the size
+    of their pickles), evicting the least recently used first, and it
+    honours the `time' that items are set with.
+
+    That doesn't include the items a CacheChain copies into it from
+    the caches behind it, as memcache doesn't say how long they have
+    left: those are kept without a time, until they're evicted or the
+    cache is reset, just as they would be in a LocalCache.
+
+    Items are kept in the dict as links of a circular doubly-linked
+    list, [prev, next, key, val, expires, size], most recently used
+    first."""
+    PREV, NEXT, KEY, VAL, EXPIRES, SIZE = range(6)
+
+    # like memcached, times longer than this are absolute timestamps
+    max_relative_time = 30 * 24 * 60 * 60
+
+    def __init__(self, max_size = 10 * 1000, max_bytes = 64 * 1024 * 1024):
+        LocalCache.__init__(self)
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        self._reset_list()
+
+    def _reset_list(self):
+        self.root = root = []
+        root[:] = [root, root, None, None, None, 0]
+        self.bytes = 0
+
+    def fresh(self):
+        return self.__class__(max_size = self.max_size,
+                              max_bytes = self.max_bytes)
+
+    @staticmethod
+    def _size(val):
+        try:
+            return len(cPickle.dumps(val, cPickle.HIGHEST_PROTOCOL))
+        except Exception:
+            return sys.getsizeof(val)
+
+    def _expires(self, time):
+        if not time:
+            return None
+        elif time > self.max_relative_time:
+            return time
+        return _time() + time
+
+    def _unlink(self, link):
+        prev, next = link[self.PREV], link[self.NEXT]
+        prev[self.NEXT] = next
+        next[self.PREV] = prev
+        dict.__delitem__(self, link[self.KEY])
+        self.bytes -= link[self.SIZE]
+
+    def _link_front(self, link):
+        root = self.root
+        first = root[self.NEXT]
+        link[self.PREV], link[self.NEXT] = root, first
+        first[self.PREV] = root[self.NEXT] = link
+
+    def _live(self, key):
+        """The link for key if it's there and hasn't expired"""
+        link = dict.get(self, key)
+        if link is None:
+            return None
+        expires = link[self.EXPIRES]
+        if expires is not None and expires <= _time():
+            self._unlink(link)
+            _lru_count('expired')
+            return None
+        return link
+
+    def get(self, key, default=None):
+        with self.lock:
+            link = self._live(key)
+            if link is None:
+                _lru_count('misses')
+                return default
+            _lru_count('hits')
+            # move it to the front
+            prev, next = link[self.PREV], link[self.NEXT]
+            prev[self.NEXT] = next
+            next[self.PREV] = prev
+            self._link_front(link)
+            val = link[self.VAL]
+        return default if val is None else val
+
+    def simple_get_multi(self, keys):
+        out = {}
+        for k in keys:
+            val = self.get(k)
+            if val is not None:
+                out[k] = val
+        return out
+
+    def _set(self, key, val, expires):
+        size = self._size(val)
+        with self.lock:
+            link = dict.get(self, key)
+            if link is not None:
+                self._unlink(link)
+
+            link = [None, None, key, val, expires, size]
+            dict.__setitem__(self, key, link)
+            self._link_front(link)
+            self.bytes += size
+
+            # evict from the back, but never the item we just set
+            root = self.root
+            evicted = 0
+            while (len(self) > 1 and (len(self) > self.max_size
+                                      or self.bytes > self.max_bytes)):
+                self._unlink(root[self.PREV])
+                evicted += 1
+            if evicted:
+                _lru_count('evictions', evicted)
+
+    def set(self, key, val, time = 0):
+        self._check_key(key)
+        self._set(key, val, self._expires(time))
+
+    def add(self, key, val, time = 0):
+        self._check_key(key)
+        with self.lock:
+            if self._live(key) is not None:
+                return False
+            self._set(key, val, self._expires(time))
+            return True
+
+    def delete(self, key):
+        with self.lock:
+            link = dict.get(self, key)
+            if link is not None:
+                self._unlink(link)
+
+    def delete_multi(self, keys):
+        for key in keys:
+            self.delete(key)
+
+    def _update(self, key, fn):
+        # changes the value of a live item, keeping its expiry
+        with self.lock:
+            link = self._live(key)
+            if link is not None:
+                self._set(key, fn(link[self.VAL]), link[self.EXPIRES])
+
+    def incr(self, key, delta=1, time=0):
+        self._update(key, lambda v: int(v) + delta)
+
+    def decr(self, key, amt=1):
+        self._update(key, lambda v: int(v) - amt)
+
+    def append(self, key, val, time = 0):
+        self._update(key, lambda v: str(v) + val)
+
+    def prepend(self, key, val, time = 0):
+        self._update(key, lambda v: val + str(v))
+
+    def replace(self, key, val, time = 0):
+        self._update(key, lambda v: val)
+
+    def flush_all(self):
+        with self.lock:
+            self.clear()
+            self._reset_list()
+
 class CacheChain(CacheUtils, local):
     def __init__(self, caches, cache_negative_results=False):
         self.caches = caches
@@ -428,7 +616,8 @@ class CacheChain(CacheUtils, local):
             val = c.get(key)
 
             if val is not None:
-                #update other caches
+                #update other caches (without a time, as we don't
+                #know how long the value has left)
                 for d in self.caches:
                     if c is d:
                         break # so we don't set caches later in the chain
@@ -499,7 +688,7 @@ class CacheChain(CacheUtils, local):
 
     def reset(self):
         # the first item in a cache chain is a LocalCache
-        self.caches = (self.caches[0].__class__(),) +  self.caches[1:]
+        self.caches = (self.caches[0].fresh(),) +  self.caches[1:]
 
 class MemcacheChain(CacheChain):
     pass
@@ -764,6 +953,9 @@ class SelfEmptyingCache(LocalCache):
     def __init__(self, max_size=10*1000):
         self.max_size = max_size
 
+    def fresh(self):
+        return self.__class__(self.max_size)
+
     def maybe_reset(self):
         if len(self) > self.max_size:
             self.clear()
@@ -25,88 +25,408 @@ from pylons import g
 from itertools import chain
 from utils import tup
 from cache import sgm
+from r2.lib import amqp
+from r2.lib.db.sorts import epoch_seconds
+
+# comment trees are stored in the permacache as a small index plus a
+# number of chunks. Every comment lives in the chunk picked by its id
+# (the root list lives in chunk 0), so adding a comment only rewrites
+# the index and the chunks of the new comment and its ancestors
+# instead of the whole tree.
+COMMENT_TREE_VERSION = 2
+
+# the number of comments we aim to have in each chunk
+COMMENT_TREE_CHUNK_SIZE = 1000
 
 def comments_key(link_id):
+    # the legacy key, which holds the whole tree as a single
+    # (cids, comment_tree, depth, num_children) tuple
     return 'comments_' + str(link_id)
 
+def comments_index_key(link_id):
+    return 'comments_tree_' + str(link_id)
+
+def comments_chunk_key(link_id, chunk):
+    return 'comments_tree_%s_%d' % (link_id, chunk)
+
 def lock_key(link_id):
     return 'comment_lock_' + str(link_id)
 
-def add_comment(comment):
-    with g.make_lock(lock_key(comment.link_id)):
-        add_comment_nolock(comment)
+class CommentTree(object):
+    """A link's comment tree as it is stored in the permacache.
+
+    Each chunk is a dict of `parents', `depth', `num_children' and
+    `sorts' (keyed by comment id) and `tree' (keyed by parent id).
+    `sorts' holds the (ups, downs, epoch seconds, deleted) of each
+    comment so that the builder can pick the comments to show without
+    loading them; trees written before it existed don't have it.
+    Chunks are only fetched when they are needed, and only the ones
+    that have been modified are written back by save()"""
+
+    def __init__(self, link_id, num_chunks, size, chunks = None):
+        self.link_id = link_id
+        self.num_chunks = num_chunks
+        self.size = size
+        self.chunks = chunks if chunks is not None else {}
+        self.dirty = set(self.chunks.keys())
+
+    @staticmethod
+    def _new_chunk():
+        return dict(parents = {}, depth = {}, num_children = {}, tree = {},
+                    sorts = {})
+
+    @staticmethod
+    def chunks_for_size(size):
+        return max(1, (size + COMMENT_TREE_CHUNK_SIZE - 1)
+                      / COMMENT_TREE_CHUNK_SIZE)
+
+    def chunk_for(self, cm_id):
+        # the list of top-level comments is keyed on None
+        return cm_id % self.num_chunks if cm_id else 0
+
+    def chunk(self, cm_id):
+        """Returns the (possibly not yet loaded) chunk that holds
+        cm_id. Raises a KeyError if the chunk has fallen out of the
+        permacache, which the callers treat as a corrupted tree"""
+        i = self.chunk_for(cm_id)
+        if i not in self.chunks:
+            chunk = g.permacache.get(comments_chunk_key(self.link_id, i))
+            if chunk is None:
+                raise KeyError("chunk %d of the comment tree for %s is missing"
+                               % (i, self.link_id))
+            self.chunks[i] = chunk
+        return self.chunks[i]
+
+    def load_all(self):
+        need = [i for i in xrange(self.num_chunks) if i not in self.chunks]
+        if need:
+            keys = dict((comments_chunk_key(self.link_id, i), i)
+                        for i in need)
+            found = g.permacache.get_multi(keys.keys())
+            if len(found) < len(need):
+                raise KeyError("%d chunks of the comment tree for %s are missing"
+                               % (len(need) - len(found), self.link_id))
+            for key, chunk in found.iteritems():
+                self.chunks[keys[key]] = chunk
+
+    @classmethod
+    def by_link(cls, link_id):
+        index = g.permacache.get(comments_index_key(link_id))
+        if not index or index.get('version') != COMMENT_TREE_VERSION:
+            return None
+        return cls(link_id, index['num_chunks'], index['size'])
+
+    @classmethod
+    def from_tuple(cls, link_id, r, sorts = None):
+        """Builds a tree from the (cids, comment_tree, depth,
+        num_children) tuple returned by load_link_comments, or stored
+        in the legacy single-key format. `sorts' optionally maps
+        comment ids to their (ups, downs, epoch seconds, deleted)"""
+        cids, comment_tree, depth, num_children = r
+        tree = cls(link_id, cls.chunks_for_size(len(cids)), len(cids))
+        tree.chunks = dict((i, cls._new_chunk())
+                           for i in xrange(tree.num_chunks))
+        tree.dirty = set(tree.chunks.keys())
+
+        for p_id, children in comment_tree.iteritems():
+            tree.chunks[tree.chunk_for(p_id)]['tree'][p_id] = list(children)
+            for cm_id in children:
+                chunk = tree.chunks[tree.chunk_for(cm_id)]
+                chunk['parents'][cm_id] = p_id
+
+        for cm_id in cids:
+            chunk = tree.chunks[tree.chunk_for(cm_id)]
+            # orphans (comments whose parent is missing) have no depth
+            chunk['depth'][cm_id] = depth.get(cm_id)
+            chunk['num_children'][cm_id] = num_children.get(cm_id, 0)
+            if sorts and cm_id in sorts:
+                chunk['sorts'][cm_id] = sorts[cm_id]
+
+        return tree
+
+    def set_sort_data(self, comments):
+        """Stores the values needed to sort each of the comments,
+        which must already be in the tree"""
+        for comment in comments:
+            i = self.chunk_for(comment._id)
+            sorts = self.chunk(comment._id).setdefault('sorts', {})
+            sorts[comment._id] = (comment._ups, comment._downs,
+                                  epoch_seconds(comment._date),
+                                  comment._deleted)
+            self.dirty.add(i)
+
+    def _all_sorts(self):
+        self.load_all()
+        sorts = {}
+        for chunk in self.chunks.itervalues():
+            sorts.update(chunk.get('sorts', {}))
+        return sorts
+
+    def sort_data(self):
+        """Returns {cm_id: (parent_id, ups, downs, epoch seconds,
+        deleted)} for every comment in the tree, or None if some
+        comments have no sort data"""
+        self.load_all()
+        res = {}
+        for chunk in self.chunks.itervalues():
+            parents = chunk['parents']
+            sorts = chunk.get('sorts', {})
+            if len(sorts) < len(parents):
+                return None
+            for cm_id, p_id in parents.iteritems():
+                res[cm_id] = (p_id,) + sorts[cm_id]
+        return res
 
-def add_comment_nolock(comment):
-    cm_id = comment._id
-    p_id = comment.parent_id
-    link_id = comment.link_id
+    def to_tuple(self):
+        """Reassembles the whole tree into the (cids, comment_tree,
+        depth, num_children) tuple that the builders expect"""
+        self.load_all()
+        comment_tree, depth, num_children = {}, {}, {}
+        for chunk in self.chunks.itervalues():
+            comment_tree.update((k, list(v))
+                                for k, v in chunk['tree'].iteritems())
+            depth.update(chunk['depth'])
+            num_children.update(chunk['num_children'])
+        cids = sorted(depth.keys())
+        return cids, comment_tree, depth, num_children
+
+    def __contains__(self, cm_id):
+        return cm_id in self.chunk(cm_id)['parents']
+
+    def add_comment(self, comment):
+        """Adds a comment to the tree, walking up its parent pointers
+        to update the child counts of its ancestors. Returns False if
+        the comment was already in the tree."""
+        cm_id = comment._id
+        p_id = comment.parent_id
+
+        if cm_id in self:
+            return False
+
+        # look everything up before changing anything so that a
+        # missing parent leaves the tree untouched
+        ancestors = []
+        a_id = p_id
+        while a_id:
+            ancestors.append(a_id)
+            a_id = self.chunk(a_id)['parents'][a_id]
+
+        chunk = self.chunk(cm_id)
+        chunk['parents'][cm_id] = p_id
+        chunk['depth'][cm_id] = len(ancestors)
+        chunk['num_children'][cm_id] = 0
+        self.dirty.add(self.chunk_for(cm_id))
+
+        self.chunk(p_id)['tree'].setdefault(p_id, []).append(cm_id)
+        self.dirty.add(self.chunk_for(p_id))
+
+        for a_id in ancestors:
+            self.chunk(a_id)['num_children'][a_id] += 1
+            self.dirty.add(self.chunk_for(a_id))
+
+        self.set_sort_data([comment])
+
+        self.size += 1
+        return True
+
+    def save(self):
+        # re-split the tree once the chunks have grown to twice their
+        # intended size. This rewrites every chunk, but only happens
+        # each time the tree doubles in size
+        if self.size > 2 * self.num_chunks * COMMENT_TREE_CHUNK_SIZE:
+            tree = self.from_tuple(self.link_id, self.to_tuple(),
+                                   self._all_sorts())
+            self.num_chunks, self.chunks, self.dirty = (tree.num_chunks,
+                                                        tree.chunks,
+                                                        tree.dirty)
+
+        chunks = dict((comments_chunk_key(self.link_id, i), self.chunks[i])
+                      for i in self.dirty)
+        if chunks:
+            g.permacache.set_multi(chunks)
+        # the index is written last so that readers never see a
+        # num_chunks that points at chunks that haven't been written
+        g.permacache.set(comments_index_key(self.link_id),
+                         dict(version = COMMENT_TREE_VERSION,
+                              num_chunks = self.num_chunks,
+                              size = self.size))
+        self.dirty = set()
+
+def migrate_link_comments(link_id):
+    """Converts a tree stored under the legacy single key to the
+    chunked format. Returns the new tree, or None if there was no
+    legacy tree to convert"""
+    key = comments_key(link_id)
+    r = g.permacache.get(key)
+    if not r:
+        return None
+    tree = CommentTree.from_tuple(link_id, r)
+    tree.save()
+    g.permacache.delete(key)
+    return tree
 
-    cids, comment_tree, depth, num_children = link_comments(link_id)
+def comment_tree(link_id):
+    """Returns the stored CommentTree for a link, migrating it from
+    the legacy format or building it from the db if needed"""
+    tree = CommentTree.by_link(link_id)
+    if tree is None:
+        # building a big tree can take longer than the lease
+        with g.make_lock(lock_key(link_id), renew = True):
+            tree = (CommentTree.by_link(link_id)
+                    or migrate_link_comments(link_id))
+            if tree is None:
+                tree = build_comment_tree(link_id)[0]
+                tree.save()
+    return tree
 
-    #make sure we haven't already done this before (which would happen
-    #if the tree isn't cached when you add a comment)
-    if comment._id in cids:
-        return
+def build_comment_tree(link_id):
+    """Builds a link's CommentTree, including the sort data, from the
+    db. Returns the tree and the tuple it was built from"""
+    comments = _query_link_comments(link_id)
+    r = compute_link_comments(comments)
+    tree = CommentTree.from_tuple(link_id, r)
+    tree.set_sort_data(comments)
+    return tree, r
 
-    #add to comment list
-    cids.append(comment._id)
+def add_comment(comment):
+    add_comments([comment])
 
-    #add to tree
-    comment_tree.setdefault(p_id, []).append(cm_id)
+def add_comments(comments):
+    """Adds a batch of comments that are all on the same link, with a
+    single lock acquisition and a single read and write of the tree"""
+    link_id = comments[0].link_id
+    assert all(cm.link_id == link_id for cm in comments)
+    with g.make_lock(lock_key(link_id)):
+        add_comments_nolock(link_id, comments)
 
-    #add to depth
-    depth[cm_id] = depth[p_id] + 1 if p_id else 0
+def add_comment_nolock(comment):
+    add_comments_nolock(comment.link_id, [comment])
 
-    #update children
-    num_children[cm_id] = 0
+def add_comments_nolock(link_id, comments):
+    tree = comment_tree(link_id)
 
-    #dfs to find the list of parents for the new comment
-    def find_parents():
-        stack = [cid for cid in comment_tree[None]]
-        parents = []
-        while stack:
-            cur_cm = stack.pop()
-            if cur_cm == cm_id:
-                return parents
-            elif comment_tree.has_key(cur_cm):
-                #make cur_cm the end of the parents list
-                parents = parents[:depth[cur_cm]] + [cur_cm]
-                for child in comment_tree[cur_cm]:
-                    stack.append(child)
+    #make sure we haven't already done this before (which would happen
+    #if the tree isn't cached when you add a comment). Sorting by id
+    #makes sure that parents that are in the same batch go in first.
+    #Comments that are already there just get their sort data
+    #refreshed (see update_comment_votes)
+    existing = []
+    changed = False
+    for comment in sorted(comments, key = lambda cm: cm._id):
+        if tree.add_comment(comment):
+            changed = True
+        else:
+            existing.append(comment)
+    if existing:
+        tree.set_sort_data(existing)
+        changed = True
+    if changed:
+        tree.save()
+
+def update_comment_votes(comments):
+    """Refreshes the sort data of comments that are already in their
+    links' trees, e.g. after they've been voted on or deleted. The
+    refresh goes through commentstree_q (see queue_comment_votes) so
+    that the trees are only ever locked and written by its consumer;
+    without amqp it's done in place.
+
+    Only the lazy CommentBuilder reads the sort data, so nothing is
+    done unless g.lazy_comments is on. Trees that were written while
+    it was off are rebuilt with link_comments(link_id, _update=True)
+    before turning it on, or their scores will be out of date"""
+    if not getattr(g, 'lazy_comments', False):
+        return
 
+    if g.amqp_host:
+        queue_comment_votes(comments)
+        return
 
-    #if this comment had a parent, find the parent's parents
-    if p_id:
-        for p_id in find_parents():
-            num_children[p_id] += 1
+    by_link = {}
+    for comment in tup(comments):
+        by_link.setdefault(comment.link_id, []).append(comment)
 
-    g.permacache.set(comments_key(link_id),
-                     (cids, comment_tree, depth, num_children))
+    for link_id, link_cms in by_link.iteritems():
+        with g.make_lock(lock_key(link_id)):
+            tree = CommentTree.by_link(link_id)
+            if tree is None:
+                # it'll get the current values when it gets built
+                continue
+            try:
+                link_cms = [cm for cm in link_cms if cm._id in tree]
+                if link_cms:
+                    tree.set_sort_data(link_cms)
+                    tree.save()
+            except KeyError:
+                # the next read of the tree will rebuild it
+                pass
+
+def queue_comment_votes(comments):
+    """Queues comments for commentstree_q, which refreshes the sort
+    data of the ones that are already in their trees"""
+    for fname in set(cm._fullname for cm in tup(comments)):
+        amqp.add_item('commentstree_q', fname)
+
+def backfill_key(link_id):
+    return 'comment_sort_backfill_' + str(link_id)
+
+def queue_sort_data_backfill(link):
+    """Has commentstree_q rebuild the tree of a link, along with its
+    sort data, if the tree was written before the sort data existed.
+    Only one message is sent per link every few minutes however many
+    page views ask for it, and nothing is locked or written here, so
+    it's safe to call while rendering"""
+    if g.amqp_host and g.cache.add(backfill_key(link._id), True, 300):
+        amqp.add_item('commentstree_q', link._fullname)
+
+def backfill_sort_data(link_id):
+    """The commentstree_q side of queue_sort_data_backfill"""
+    if link_comment_sort_data(link_id) is None:
+        link_comments(link_id, _update = True)
 
 def delete_comment(comment):
-    #nothing really to do here, atm
-    pass
+    update_comment_votes(comment)
+
+def link_comment_sort_data(link_id):
+    """Returns CommentTree.sort_data() for a link, or None if the tree
+    doesn't have it (yet)"""
+    tree = CommentTree.by_link(link_id)
+    if tree is None:
+        return None
+    try:
+        return tree.sort_data()
+    except KeyError:
+        return None
 
 def link_comments(link_id, _update=False):
-    key = comments_key(link_id)
-
-    r = g.permacache.get(key)
-
-    if r and not _update:
-        return r
-    else:
-        with g.make_lock(lock_key(link_id)):
-            r = load_link_comments(link_id)
-            g.permacache.set(key, r)
-        return r
-
-def load_link_comments(link_id):
+    if not _update:
+        tree = CommentTree.by_link(link_id)
+        if tree is None:
+            tree = comment_tree(link_id)
+        try:
+            return tree.to_tuple()
+        except KeyError:
+            # a chunk fell out of the cache; rebuild the whole thing
+            pass
+
+    with g.make_lock(lock_key(link_id), renew = True):
+        tree, r = build_comment_tree(link_id)
+        tree.save()
+    return r
+
+def _query_link_comments(link_id):
     from r2.models import Comment
     q = Comment._query(Comment.c.link_id == link_id,
                        Comment.c._deleted == (True, False),
                        Comment.c._spam == (True, False),
                        data = True)
-    comments = list(q)
+    return list(q)
+
+def load_link_comments(link_id):
+    return compute_link_comments(_query_link_comments(link_id))
+
+def compute_link_comments(comments):
+    """Builds the (cids, comment_tree, depth, num_children) tuple for
+    a list of comments (anything with an _id and a parent_id)"""
     cids = [c._id for c in comments]
 
     #make a tree
@@ -115,27 +435,37 @@ def load_link_comments(link_id):
         p_id = cm.parent_id
         comment_tree.setdefault(p_id, []).append(cm._id)
 
-    #calculate the depths
+    #calculate the depths in one pre-order pass over each subtree,
+    #then the number of children by walking that order backwards so
+    #that every comment is counted after its children. Only comments
+    #that can be reached from the top-level comments get a depth, but
+    #subtrees whose parent is missing still get their children counted
+    all_ids = set(cids)
     depth = {}
-    level = 0
-    cur_level = comment_tree.get(None, ())
-    while cur_level:
-        next_level = []
-        for cm_id in cur_level:
-            depth[cm_id] = level
-            next_level.extend(comment_tree.get(cm_id, ()))
-        cur_level = next_level
-        level += 1
-
-    #calc the number of children
+    order = []
+    for cm in comments:
+        if cm.parent_id is not None and cm.parent_id in all_ids:
+            continue
+        reachable = cm.parent_id is None
+        stack = [(cm._id, 0)]
+        while stack:
+            cm_id, level = stack.pop()
+            if reachable:
+                depth[cm_id] = level
+            order.append(cm_id)
+            children = comment_tree.get(cm_id)
+            if children:
+                level += 1
+                stack.extend((child, level) for child in children)
+
     num_children = {}
-    for cm_id in cids:
+    for cm_id in reversed(order):
+        children = comment_tree.get(cm_id)
         num = 0
-        todo = [cm_id]
-        while todo:
-            more = comment_tree.get(todo.pop(0), ())
-            num += len(more)
-            todo.extend(more)
+        if children:
+            num = len(children)
+            for child in children:
+                num += num_children[child]
         num_children[cm_id] = num
 
     return cids, comment_tree, depth, num_children
@@ -0,0 +1,189 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is Reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+#
+# All portions of the code written by CondeNet are Copyright (c) 2006-2010
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+"""
+A compact encoding for the lists of (fullname, *sort_cols) tuples that
+CachedResults keeps in the query cache. Instead of a pickled list of
+tuples, a listing is stored column by column:
+
+  header       magic, version, number of rows and of sort columns
+  codes        one struct code per sort column ('q' for ints, 'd' for
+               floats, including the epoch seconds of dates)
+  prefixes     the distinct fullname prefixes (e.g. 't3_'), and one
+               byte per row indexing into them
+  ids          the base-36 thing ids, comma separated
+  columns      each sort column as packed little-endian 64-bit values
+
+Every part decodes with a single C-level call (str.split or
+struct.unpack), and the row tuples themselves are only built as the
+listing is iterated. Anything that isn't a packed string (i.e. the
+pickled lists written before this existed) is passed through
+unchanged by unpack_results, so both formats can live in the cache at
+the same time.
+"""
+import re
+import struct
+
+MAGIC = 'QC'
+VERSION = 1
+
+_header = struct.Struct('<2sBIB')
+_max_int = 2 ** 63 - 1
+_max_prefixes = 255
+
+_fullname_re = re.compile('^([a-z][0-9a-z]*_)([0-9a-z]+)$')
+
+def _col_code(vals):
+    if all(isinstance(v, (int, long)) and not isinstance(v, bool)
+           and -_max_int <= v <= _max_int for v in vals):
+        return 'q'
+    elif all(isinstance(v, (int, long, float)) and not isinstance(v, bool)
+             for v in vals):
+        return 'd'
+    return None
+
+def _pack_str(s):
+    return struct.pack('<I', len(s)) + s
+
+def _unpack_str(packed, offset):
+    length, = struct.unpack_from('<I', packed, offset)
+    offset += 4
+    return packed[offset:offset + length], offset + length
+
+def pack_results(data):
+    """Returns the packed form of a list of (fullname, *sort_cols)
+    tuples, or None if they can't be packed (in which case the list
+    should be stored as it is)"""
+    if not data:
+        return None
+
+    nrows = len(data)
+    ncols = len(data[0]) - 1
+    if ncols > 255 or any(len(t) != ncols + 1 for t in data):
+        return None
+
+    prefixes = {}
+    prefix_idx = []
+    ids = []
+    for t in data:
+        m = _fullname_re.match(t[0]) if isinstance(t[0], str) else None
+        if not m:
+            return None
+        prefix, id36 = m.groups()
+        if prefix not in prefixes:
+            if len(prefixes) == _max_prefixes:
+                return None
+            prefixes[prefix] = len(prefixes)
+        prefix_idx.append(prefixes[prefix])
+        ids.append(id36)
+
+    codes = []
+    columns = []
+    for i in xrange(1, ncols + 1):
+        vals = [t[i] for t in data]
+        code = _col_code(vals)
+        if code is None:
+            return None
+        codes.append(code)
+        columns.append(struct.pack('<%d%s' % (nrows, code), *vals))
+
+    prefix_list = sorted(prefixes, key = prefixes.get)
+    return ''.join([_header.pack(MAGIC, VERSION, nrows, ncols),
+                    ''.join(codes),
+                    _pack_str(','.join(prefix_list)),
+                    struct.pack('<%dB' % nrows, *prefix_idx),
+                    _pack_str(','.join(ids))]
+                   + columns)
+
+def unpack_results(value):
+    """Returns a PackedResults for a packed listing, and anything else
+    (a legacy list, or None) as it is"""
+    if isinstance(value, str) and value.startswith(MAGIC):
+        return PackedResults(value)
+    return value
+
+class PackedResults(object):
+    """A read-only sequence of (fullname, *sort_cols) tuples over a
+    packed listing. The columns are unpacked the first time that any
+    row is needed, and rows are built one at a time"""
+    def __init__(self, packed):
+        magic, version, nrows, ncols = _header.unpack_from(packed)
+        if version != VERSION:
+            raise ValueError("unknown packed listing version %r" % version)
+        self.packed = packed
+        self.length = nrows
+        self.ncols = ncols
+        self._columns = None
+
+    def _unpack(self):
+        packed, nrows = self.packed, self.length
+        offset = _header.size
+        codes = packed[offset:offset + self.ncols]
+        offset += self.ncols
+
+        prefixes, offset = _unpack_str(packed, offset)
+        prefixes = prefixes.split(',')
+        prefix_idx = struct.unpack_from('<%dB' % nrows, packed, offset)
+        offset += nrows
+        ids, offset = _unpack_str(packed, offset)
+
+        columns = [[prefixes[i] for i in prefix_idx], ids.split(',')]
+        for code in codes:
+            fmt = '<%d%s' % (nrows, code)
+            columns.append(struct.unpack_from(fmt, packed, offset))
+            offset += struct.calcsize(fmt)
+        self._columns = columns
+        return columns
+
+    def _row(self, columns, i):
+        return (columns[0][i] + columns[1][i],) + tuple(c[i] for c in
+                                                        columns[2:])
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        columns = self._columns or self._unpack()
+        if isinstance(i, slice):
+            return [self._row(columns, j)
+                    for j in xrange(*i.indices(self.length))]
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError(i)
+        return self._row(columns, i)
+
+    def __iter__(self):
+        if not self.length:
+            return
+        columns = self._columns or self._unpack()
+        for i in xrange(self.length):
+            yield self._row(columns, i)
+
+    def __getstate__(self):
+        # no need to pickle the unpacked columns
+        return dict(packed = self.packed)
+
+    def __setstate__(self, state):
+        self.__init__(state['packed'])
+
+    def __repr__(self):
+        return '<PackedResults %d rows>' % self.length
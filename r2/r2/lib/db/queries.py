@@ -3,18 +3,24 @@ from r2.models import Message, Inbox, Subreddit, ModContribSR, ModeratorInbox
 from r2.lib.db.thing import Thing, Merge
 from r2.lib.db.operators import asc, desc, timeago
 from r2.lib.db import query_queue
+from r2.lib.db.packed_results import pack_results, unpack_results
 from r2.lib.normalized_hot import expire_hot
 from r2.lib.db.sorts import epoch_seconds
 from r2.lib.utils import fetch_things2, tup, UniqueIterator, set_last_modified
 from r2.lib import utils
 from r2.lib.solrsearch import DomainSearchQuery
 from r2.lib import amqp, sup
-from r2.lib.comment_tree import add_comment, link_comments
+from r2.lib.comment_tree import add_comments, link_comments
+from r2.lib.comment_tree import update_comment_votes, backfill_sort_data
 
 import cPickle as pickle
 
 from datetime import datetime
+from operator import itemgetter
 import itertools
+import heapq
+import threading
+import time
 
 from pylons import g
 query_cache = g.permacache
@@ -92,6 +98,111 @@ def make_batched_time_query(sr, sort, time, preflight_check = True):
 
     return q
 
+def tuple_sort_key(sort):
+    """Returns a key function for the (fullname, *sort_cols) tuples of
+       a listing with the given sort. The sort columns are all
+       numeric (dates are stored as epoch seconds), so desc columns
+       are just negated."""
+    descs = [not isinstance(s, asc) for s in sort]
+    def _key(t):
+        return tuple(-v if d else v for v, d in zip(t[1:], descs))
+    return _key
+
+def _bisect_left(data, t, sort):
+    """bisect.bisect_left for a listing ordered by `sort'. When all of
+       the columns go the same way we can compare the tuples' sort
+       columns directly rather than calling tuple_sort_key"""
+    lo, hi = 0, len(data)
+    if all(isinstance(s, desc) for s in sort):
+        vals = t[1:]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if data[mid][1:] > vals:
+                lo = mid + 1
+            else:
+                hi = mid
+    elif all(isinstance(s, asc) for s in sort):
+        vals = t[1:]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if data[mid][1:] < vals:
+                lo = mid + 1
+            else:
+                hi = mid
+    else:
+        key = tuple_sort_key(sort)
+        k = key(t)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if key(data[mid]) < k:
+                lo = mid + 1
+            else:
+                hi = mid
+    return lo
+
+# merge_tuples picks between two ways of doing each of its steps. Both
+# cutoffs come from timing the two ways against each other on 100 and
+# precompute_limit (1000) entry 'hot' listings like the ones in
+# benchmarks/cached_results.py, under CPython 2.7.
+
+# up to this many stale tuples are deleted by index, and more with a
+# single filtering pass (remove_tuples). Deleting by index stopped
+# being cheaper at about 5 stale tuples on 100 entries and about 10
+# on 1000.
+max_indexed_removes = 4
+
+# new tuples are bisected in one at a time while there are at least
+# this many stored tuples for each of them, and merged in with timsort
+# otherwise. Bisecting stopped being cheaper at about 1 new tuple per
+# 20 stored on 100 entries and 1 per 30 on 1000.
+bisect_insert_ratio = 40
+
+def merge_tuples(data, tuples, sort, limit = None):
+    """Inserts `tuples' into `data', which must already be ordered by
+       `sort', replacing any stored tuples with the same fullnames.
+       New tuples go in front of stored ones with the same sort
+       values, and earlier tuples in front of later ones. Returns the
+       new list; `data' isn't modified."""
+    new = list(UniqueIterator(tuples, key = itemgetter(0)))
+    fnames = set(t[0] for t in new)
+
+    data = list(data)
+    names = map(itemgetter(0), data)
+    stale = fnames.intersection(names)
+    if len(stale) > max_indexed_removes:
+        data = remove_tuples(data, stale)
+    elif stale:
+        for i in sorted((names.index(name) for name in stale),
+                        reverse = True):
+            del data[i]
+
+    if len(new) * bisect_insert_ratio <= len(data):
+        # inserting in reverse puts earlier tuples in front of later
+        # ones with the same sort values
+        new.sort(key = tuple_sort_key(sort))
+        for t in reversed(new):
+            data.insert(_bisect_left(data, t, sort), t)
+    else:
+        # for big batches it's cheaper to let timsort merge them in,
+        # since the stored data is already one sorted run
+        data = new + data
+        if all(isinstance(s, desc) for s in sort):
+            data.sort(key = itemgetter(slice(1, None)), reverse = True)
+        elif all(isinstance(s, asc) for s in sort):
+            data.sort(key = itemgetter(slice(1, None)))
+        else:
+            data.sort(key = tuple_sort_key(sort))
+
+    if limit is not None:
+        del data[limit:]
+    return data
+
+def remove_tuples(data, fnames):
+    """Returns `data' without the tuples for `fnames', or `data'
+       itself if none of them are in it"""
+    new = [t for t in data if t[0] not in fnames]
+    return data if len(new) == len(data) else new
+
 class CachedResults(object):
     """Given a query returns a list-like object that will lazily look up
     the query from the persistent cache. """
@@ -154,7 +265,7 @@ class CachedResults(object):
         cached = query_cache.get_multi([cr.iden for cr in unfetched],
                                        allow_local = not force)
         for cr in unfetched:
-            cr.data = cached.get(cr.iden) or []
+            cr.data = unpack_results(cached.get(cr.iden)) or []
             cr._fetched = True
 
     def make_item_tuple(self, item):
@@ -206,38 +317,59 @@ class CachedResults(object):
     def _insert_tuples(self, t):
         self.fetch()
 
-        # insert the new items, remove the duplicates (keeping the one
-        # being inserted over the stored value if applicable), and
-        # sort the result
-        data = itertools.chain(t, self.data)
-        data = UniqueIterator(data, key = lambda x: x[0])
-        data = sorted(data, key=lambda x: x[1:], reverse=True)
-        data = list(data)
-        data = data[:precompute_limit]
+        # insert the new items, replacing the stored values if
+        # applicable, keeping the result sorted
+        self.data = merge_tuples(self.data, t, self.sort,
+                                 limit = precompute_limit)
 
-        self.data = data
-
-        query_cache.set(self.iden, self.data)
+        self._store()
 
     def delete(self, items):
         """Deletes an item from the cached data."""
         self.fetch()
         fnames = set(self.filter(x)._fullname for x in tup(items))
 
-        data = filter(lambda x: x[0] not in fnames,
-                      self.data)
+        data = remove_tuples(self.data, fnames)
 
-        if data != self.data:
+        if data is not self.data:
             self.data = data
-            query_cache.set(self.iden, self.data)
+            self._store()
         
+    def apply_changes(self, insert_items = (), delete_items = ()):
+        """Deletes and then inserts items (see can_insert) with a
+           single write to the cache."""
+        self.fetch()
+        data = self.data
+
+        if delete_items:
+            fnames = set(self.filter(x)._fullname for x in delete_items)
+            data = remove_tuples(data, fnames)
+
+        if insert_items:
+            data = merge_tuples(data,
+                                [self.make_item_tuple(item)
+                                 for item in insert_items],
+                                self.sort, limit = precompute_limit)
+
+        if data is not self.data:
+            self.data = data
+            self._store()
+
     def update(self):
         """Runs the query and stores the result in the cache. It also stores
         the columns relevant to the sort to make merging with other
         results faster."""
         self.data = [self.make_item_tuple(i) for i in self.query]
         self._fetched = True
-        query_cache.set(self.iden, self.data)
+        self._store()
+
+    def _store(self):
+        """Writes self.data to the query cache, packed (see
+        r2.lib.db.packed_results) if pack_query_cache is on."""
+        data = self.data
+        if getattr(g, 'pack_query_cache', False):
+            data = pack_results(data) or data
+        query_cache.set(self.iden, data)
 
     def __repr__(self):
         return '<CachedResults %s %s>' % (self.query._rules, self.query._sort)
@@ -265,29 +397,44 @@ class MergedCachedResults(object):
         # make sure they're all the same
         assert all(r.sort == self.sort for r in results[1:])
 
+        self._data = None
+
+    def _merge(self):
+        """Lazily merges the (already sorted) listings. Each tuple is
+           decorated with its sort key and the index of its listing,
+           so that ties keep the order of the listings and the tuples
+           themselves never have to be compared."""
+        key = tuple_sort_key(self.sort)
+        def decorated(i, cr):
+            for t in cr.data:
+                yield key(t), i, t
+        merged = heapq.merge(*[decorated(i, cr)
+                               for i, cr in enumerate(self.cached_results)])
+
         # if something is 'top' for the year *and* for today, it would
-        # appear in both listings, so we need to filter duplicates
-        all_items = UniqueIterator((item for cr in results
-                                    for item in cr.data),
-                                   key = lambda x: x[0])
-        all_items = sorted(all_items, cmp=self._thing_cmp)
-        self.data = list(all_items)
-
-    def _thing_cmp(self, t1, t2):
-        for i, s in enumerate(self.sort):
-            # t1 and t2 are tuples of (fullname, *sort_cols), so we
-            # can get the value to compare right out of the tuple
-            v1, v2 = t1[i + 1], t2[i + 1]
-            if v1 != v2:
-                return cmp(v1, v2) if isinstance(s, asc) else cmp(v2, v1)
-        #they're equal
-        return 0
+        # appear in both listings, so we need to filter duplicates. The
+        # copy we keep is the one from the first listing it's in (as
+        # when the listings were concatenated and then sorted), even
+        # if another one's sort columns put it higher
+        first = {}
+        for i, cr in enumerate(self.cached_results):
+            for t in cr.data:
+                first.setdefault(t[0], i)
+        return UniqueIterator((t for k, i, t in merged if first[t[0]] == i),
+                              key = itemgetter(0))
+
+    @property
+    def data(self):
+        if getattr(self, '_data', None) is None:
+            self._data = list(self._merge())
+        return self._data
 
     def __repr__(self):
         return '<MergedCachedResults %r>' % (self.cached_results,)
 
     def __iter__(self):
-        for x in self.data:
+        data = getattr(self, '_data', None)
+        for x in (self._merge() if data is None else data):
             yield x[0]
 
 def make_results(query, filter = filter_identity):
@@ -544,33 +691,137 @@ def get_unread_inbox(user):
                          get_unread_messages(user),
                          get_unread_selfreply(user))
 
+class QueryCoalescer(object):
+    """Collects the changes that add_queries makes to cached queries
+       and applies them from the amqp worker thread in batches, so
+       that a listing updated many times in quick succession (say, the
+       hot page of a busy subreddit) is fetched and stored once per
+       batch rather than once per update.
+
+       Only the latest change to each fullname in a listing is kept:
+       inserting replaces whatever was stored for it and deleting
+       removes it, so applying just the last one has the same result.
+       Queries that have to be rerun are only queued once per batch.
+
+       A batch is flushed as soon as the worker gets to it, or after
+       `window' seconds if that's set, to give changes more of a chance
+       to pile up."""
+    def __init__(self, window = 0):
+        self.window = window
+        self.lock = threading.Lock()
+        self.scheduled = False
+        # iden -> [query, {fullname: (seq, is_insert, item)}, rerun]
+        self.pending = {}
+        self.order = []
+        self.seq = 0
+        self.stats = dict(updates = 0,   # changes asked for
+                          writes = 0,    # fetch/store cycles done
+                          merged = 0,    # changes that shared a cycle
+                          reruns = 0,    # queries sent to the queue
+                          reruns_merged = 0)
+
+    def add(self, q, insert_items = None, delete_items = None):
+        if insert_items and q.can_insert():
+            items, is_insert = tup(insert_items), True
+        elif delete_items and q.can_delete():
+            items, is_insert = tup(delete_items), False
+        else:
+            items, is_insert = None, None
+
+        with self.lock:
+            if q.iden not in self.pending:
+                self.pending[q.iden] = [q, {}, False]
+                self.order.append(q.iden)
+            pending = self.pending[q.iden]
+
+            if items is None:
+                if pending[2]:
+                    self.stats['reruns_merged'] += 1
+                pending[2] = True
+            else:
+                self.stats['updates'] += 1
+                if pending[1]:
+                    self.stats['merged'] += 1
+                for item in items:
+                    self.seq += 1
+                    fname = q.filter(item)._fullname
+                    pending[1][fname] = (self.seq, is_insert, item)
+
+            schedule = not self.scheduled
+            self.scheduled = True
+
+        # outside the lock, since the worker may run the flush inline
+        if schedule:
+            self._schedule()
+
+    def _schedule(self):
+        if self.window:
+            t = threading.Timer(self.window, worker.do, [self.flush])
+            t.setDaemon(True)
+            t.start()
+        else:
+            worker.do(self.flush)
+
+    def flush(self):
+        """Applies the pending changes. `scheduled' stays set until it's
+           done, so that with several worker threads only one flush
+           runs at a time and the batches of a query are applied in
+           order; changes that come in meanwhile get a flush of their
+           own afterwards."""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            order, self.order = self.order, []
+
+        try:
+            for iden in order:
+                q, changes, rerun = pending[iden]
+                query_cache.reset()
+                try:
+                    self._apply(q, changes, rerun)
+                except:
+                    import traceback
+                    print traceback.format_exc()
+        finally:
+            with self.lock:
+                self.scheduled = bool(self.pending)
+                again = self.scheduled
+            if again:
+                self._schedule()
+
+    def _apply(self, q, changes, rerun):
+        if rerun:
+            log.debug('Adding precomputed query %s' % q)
+            query_queue.add_query(q)
+            with self.lock:
+                self.stats['reruns'] += 1
+
+        if changes:
+            changes = sorted(changes.itervalues())
+            inserts = [item for seq, is_insert, item in changes if is_insert]
+            deletes = [item for seq, is_insert, item in changes
+                       if not is_insert]
+
+            with make_lock("add_query(%s)" % q.iden):
+                q.fetch(force=True)
+                log.debug("Inserting %s and deleting %s in query %s"
+                          % (inserts, deletes, q))
+                q.apply_changes(inserts, deletes)
+            with self.lock:
+                self.stats['writes'] += 1
+
+coalescer = QueryCoalescer(window = getattr(g, 'query_coalesce_window', 0))
+
 def add_queries(queries, insert_items = None, delete_items = None):
     """Adds multiple queries to the query queue. If insert_items or
        delete_items is specified, the query may not need to be
-       recomputed against the database."""
+       recomputed against the database. The changes are batched up
+       by the coalescer."""
     if not g.write_query_queue:
         return
 
-    def _add_queries():
-        for q in queries:
-            query_cache.reset()
-            if not isinstance(q, CachedResults):
-                continue
-
-            with make_lock("add_query(%s)" % q.iden):
-                if insert_items and q.can_insert():
-                    q.fetch(force=True)
-                    log.debug("Inserting %s into query %s" % (insert_items, q))
-                    q.insert(insert_items)
-                elif delete_items and q.can_delete():
-                    q.fetch(force=True)
-                    log.debug("Deleting %s from query %s" % (delete_items, q))
-                    q.delete(delete_items)
-                else:
-                    log.debug('Adding precomputed query %s' % q)
-                    query_queue.add_query(q)
-    # let the amqp worker handle this
-    worker.do(_add_queries)
+    for q in queries:
+        if isinstance(q, CachedResults):
+            coalescer.add(q, insert_items, delete_items)
 
 #can be rewritten to be more efficient
 def all_queries(fn, obj, *param_lists):
@@ -631,7 +882,7 @@ def new_comment(comment, inbox_rels):
         amqp.add_item('new_comment', comment._fullname)
         if not g.amqp_host:
             l = Link._byID(comment.link_id,data=True)
-            add_comment_tree(comment, l)
+            add_comments_tree([comment], l)
 
     # note that get_all_comments() is updated by the amqp process
     # r2.lib.db.queries.run_new_comments
@@ -655,14 +906,33 @@ def new_subreddit(sr):
 
 
 def new_vote(vote):
-    user = vote._thing1
-    item = vote._thing2
-
-    if not isinstance(item, Link):
-        return
-
-    if vote.valid_thing and not item._spam and not item._deleted:
-        sr = item.subreddit_slow
+    new_votes([vote])
+
+def new_votes(votes):
+    """Updates the listings affected by a batch of votes, with one
+       add_queries per listing (rather than per vote)"""
+    by_sr = {}
+    by_user = {}
+    for vote in votes:
+        user = vote._thing1
+        item = vote._thing2
+
+        if not isinstance(item, Link):
+            continue
+
+        if vote.valid_thing and not item._spam and not item._deleted:
+            sr = item.subreddit_slow
+            by_sr.setdefault(sr._id, (sr, []))[1].append(item)
+
+        rels, liked, disliked = by_user.setdefault(user._id,
+                                                   (user, {}, {}, {}))[1:]
+        rels[vote.__class__] = vote
+        # we must update both because we don't know if it's a changed
+        # vote. only the last vote by a user on a link counts
+        liked[item._id] = (vote._name == '1', vote)
+        disliked[item._id] = (vote._name == '-1', vote)
+
+    for sr, items in by_sr.itervalues():
         # don't do 'new', because that was done by new_link
         results = [get_links(sr, 'hot', 'all')]
 
@@ -674,23 +944,23 @@ def new_vote(vote):
                 q = make_batched_time_query(sr, sort, time)
                 results.append(q)
 
-        add_queries(results, insert_items = item)
+        add_queries(results, insert_items = items)
 
         sr.last_valid_vote = datetime.now(g.tz)
         sr._commit()
 
-    vote._fast_query_timestamp_touch(user)
-    
-    #must update both because we don't know if it's a changed vote
-    if vote._name == '1':
-        add_queries([get_liked(user)], insert_items = vote)
-        add_queries([get_disliked(user)], delete_items = vote)
-    elif vote._name == '-1':
-        add_queries([get_liked(user)], delete_items = vote)
-        add_queries([get_disliked(user)], insert_items = vote)
-    else:
-        add_queries([get_liked(user)], delete_items = vote)
-        add_queries([get_disliked(user)], delete_items = vote)
+    for user, rels, liked, disliked in by_user.itervalues():
+        for vote in rels.itervalues():
+            vote._fast_query_timestamp_touch(user)
+
+        for q, changes in ((get_liked(user), liked),
+                           (get_disliked(user), disliked)):
+            inserts = [v for insert, v in changes.itervalues() if insert]
+            deletes = [v for insert, v in changes.itervalues() if not insert]
+            if inserts:
+                add_queries([q], insert_items = inserts)
+            if deletes:
+                add_queries([q], delete_items = deletes)
 
 def new_message(message, inbox_rels):
     from r2.lib.comment_tree import add_message
@@ -854,7 +1124,7 @@ def clear_reports(things):
 def add_all_ban_report_srs():
     """Adds the initial spam/reported pages to the report queue"""
     q = Subreddit._query(sort = asc('_date'))
-    for sr in fetch_things2(q):
+    for sr in fetch_things2(q, 1000, stream = True):
         add_queries([get_spam_links(sr),
                      #get_spam_comments(sr),
                      get_reported_links(sr),
@@ -864,7 +1134,7 @@ def add_all_ban_report_srs():
 def add_all_srs():
     """Adds every listing query for every subreddit to the queue."""
     q = Subreddit._query(sort = asc('_date'))
-    for sr in fetch_things2(q):
+    for sr in fetch_things2(q, 1000, stream = True):
         add_queries(all_queries(get_links, sr, ('hot', 'new'), ['all']))
         add_queries(all_queries(get_links, sr, ('top', 'controversial'), db_times.keys()))
         add_queries([get_spam_links(sr),
@@ -893,15 +1163,9 @@ def update_user(user):
 
 def add_all_users():
     q = Account._query(sort = asc('_date'))
-    for user in fetch_things2(q):
+    for user in fetch_things2(q, 1000, stream = True):
         update_user(user)
 
-def add_comment_tree(comment, link):
-    #update the comment cache
-    add_comment(comment)
-    #update last modified
-    set_last_modified(link, 'comments')
-
 # amqp queue processing functions
 
 def run_new_comments():
@@ -918,30 +1182,56 @@ def run_new_comments():
 
     amqp.handle_items('newcomments_q', _run_new_comments, limit=100)
 
-def run_commentstree():
-    """Add new incoming comments to their respective comments trees"""
+def add_comments_tree(comments, link):
+    #update the comment cache
+    add_comments(comments)
+    #update last modified
+    set_last_modified(link, 'comments')
+
+def run_commentstree(limit = 1):
+    """Add new incoming comments to their respective comments trees,
+       and refresh the sort data of the ones that were queued again
+       after a vote or delete (see update_comment_votes). Links are
+       queued to have their sort data backfilled (see
+       queue_sort_data_backfill).
+       With a limit > 1 the comments are grouped by link, so that each
+       tree is locked, read and written once per batch"""
 
     def _run_commentstree(msgs, chan):
+        start = time.time()
         fnames = [msg.body for msg in msgs]
-        comments = Comment._by_fullname(fnames, data=True, return_dict=False)
+        things = Thing._by_fullname(fnames, data=True, return_dict=False)
+        comments = [t for t in things if isinstance(t, Comment)]
+
+        for link_id in set(t._id for t in things if isinstance(t, Link)):
+            backfill_sort_data(link_id)
 
         links = Link._byID(set(cm.link_id for cm in comments),
                            data=True,
                            return_dict=True)
 
-        # add the comment to the comments-tree
+        by_link = {}
         for comment in comments:
-            l = links[comment.link_id]
+            by_link.setdefault(comment.link_id, []).append(comment)
+
+        # add the comments to the comments-trees
+        for link_id, link_cms in by_link.iteritems():
+            l = links[link_id]
             try:
-                add_comment_tree(comment, l)
+                add_comments_tree(link_cms, l)
             except KeyError:
                 # Hackity hack. Try to recover from a corrupted
                 # comment tree
                 print "Trying to fix broken comments-tree."
                 link_comments(l._id, _update=True)
-                add_comment_tree(comment, l)
+                add_comments_tree(link_cms, l)
 
-    amqp.handle_items('commentstree_q', _run_commentstree, limit=1)
+        elapsed = time.time() - start
+        print ("commentstree_q: %d comments on %d links in %.2fs (%.1f/s)"
+               % (len(comments), len(by_link), elapsed,
+                  len(comments) / max(elapsed, 0.001)))
+
+    amqp.handle_items('commentstree_q', _run_commentstree, limit=limit)
 
 
 #def run_new_links():
@@ -1010,49 +1300,70 @@ def get_likes(user, items):
     return res
 
 def handle_vote(user, thing, dir, ip, organic, cheater = False):
-    from r2.lib.db import tdb_sql
-    from sqlalchemy.exc import IntegrityError
-    try:
-        v = Vote.vote(user, thing, dir, ip, organic, cheater = cheater)
-    except (tdb_sql.CreationError, IntegrityError):
-        g.log.error("duplicate vote for: %s" % str((user, thing, dir)))
-        return
-
-    # keep track of upvotes in the hard cache by subreddit
-    sr_id = getattr(thing, "sr_id", None)
-    if (sr_id and dir > 0 and getattr(thing, "author_id", None) != user._id
-        and v.valid_thing):
-        now = datetime.now(g.tz).strftime("%Y/%m/%d")
-        g.hardcache.add("subreddit_vote-%s_%s_%s" % (now, sr_id, user._id),
-                        sr_id, time = 86400 * 7) # 1 week for now
-
-    if isinstance(thing, Link):
-        new_vote(v)
-        if v.valid_thing:
-            expire_hot(thing.subreddit_slow)
-
-        #update the modified flags
-        set_last_modified(user, 'liked')
-        if user._id == thing.author_id:
-            set_last_modified(user, 'overview')
-            set_last_modified(user, 'submitted')
-            #update sup listings
-            sup.add_update(user, 'submitted')
-
-            #update sup listings
-            if dir:
-                sup.add_update(user, 'liked')
-            elif dir is False:
-                sup.add_update(user, 'disliked')
-
-    elif isinstance(thing, Comment):
-        #update last modified
-        if user._id == thing.author_id:
-            set_last_modified(user, 'overview')
-            set_last_modified(user, 'commented')
-            #update sup listings
-            sup.add_update(user, 'commented')
-
+    handle_votes([(user, thing, dir, ip, organic, cheater)])
+
+def handle_votes(votes):
+    """Applies a batch of (user, thing, dir, ip, organic, cheater)
+       votes (see Vote.vote_batch) and then does the per-subreddit,
+       per-user and per-listing bookkeeping once for the batch"""
+    applied = Vote.vote_batch(votes)
+
+    now = datetime.now(g.tz).strftime("%Y/%m/%d")
+    expire_srs = {}
+    modified = set()
+    updates = set()
+    comments = []
+    for user, thing, v in applied:
+        # keep track of upvotes in the hard cache by subreddit
+        sr_id = getattr(thing, "sr_id", None)
+        if (sr_id and v._name == '1'
+            and getattr(thing, "author_id", None) != user._id
+            and v.valid_thing):
+            g.hardcache.add("subreddit_vote-%s_%s_%s" % (now, sr_id, user._id),
+                            sr_id, time = 86400 * 7) # 1 week for now
+
+        if isinstance(thing, Link):
+            if v.valid_thing:
+                sr = thing.subreddit_slow
+                expire_srs[sr._id] = sr
+
+            #update the modified flags
+            modified.add((user, 'liked'))
+            if user._id == thing.author_id:
+                modified.add((user, 'overview'))
+                modified.add((user, 'submitted'))
+                #update sup listings
+                updates.add((user, 'submitted'))
+
+                #update sup listings
+                if v._name == '1':
+                    updates.add((user, 'liked'))
+                elif v._name == '-1':
+                    updates.add((user, 'disliked'))
+
+        elif isinstance(thing, Comment):
+            comments.append(thing)
+
+            #update last modified
+            if user._id == thing.author_id:
+                modified.add((user, 'overview'))
+                modified.add((user, 'commented'))
+                #update sup listings
+                updates.add((user, 'commented'))
+
+    new_votes([v for user, thing, v in applied])
+
+    for sr in expire_srs.itervalues():
+        expire_hot(sr)
+
+    for user, action in modified:
+        set_last_modified(user, action)
+    for user, action in updates:
+        sup.add_update(user, action)
+
+    #update the sort data in the comment trees
+    if comments:
+        update_comment_votes(comments)
 
 def process_votes(drain = False, limit = 100):
 
@@ -1073,9 +1384,8 @@ def process_votes(drain = False, limit = 100):
         users = Account._byID(uids, data = True, return_dict = True)
         things = Thing._by_fullname(tids, data = True, return_dict = True)
 
-        for uid, tid, dir, ip, organic, cheater in to_do:
-            handle_vote(users[uid], things[tid], dir, ip, organic,
-                        cheater = cheater)
+        handle_votes([(users[uid], things[tid], dir, ip, organic, cheater)
+                      for uid, tid, dir, ip, organic, cheater in to_do])
 
     amqp.handle_items('register_vote_q', _handle_votes, limit = limit,
                       drain = drain)
@@ -1089,7 +1399,7 @@ def catch_up_batch_queries():
     sr_q = Subreddit._query(sort=desc('_downs'),
                             data=True)
     dayago = utils.timeago('1 day')
-    for sr in fetch_things2(sr_q):
+    for sr in fetch_things2(sr_q, 1000, stream = True):
         if hasattr(sr, 'last_valid_vote') and sr.last_valid_vote > dayago:
             # if we don't know when the last vote was, it couldn't
             # have been today
@@ -19,10 +19,14 @@
 # All portions of the code written by CondeNet are Copyright (c) 2006-2010
 # CondeNet, Inc. All Rights Reserved.
 ################################################################################
+from __future__ import with_statement
 from datetime import datetime
 import cPickle as pickle
 from copy import deepcopy
+import itertools
 import random
+import sys
+import threading
 
 import sqlalchemy as sa
 from sqlalchemy.databases import postgres
@@ -38,6 +42,11 @@ log_format = logging.Formatter('sql: %(message)s')
 
 max_val_len = 1000
 
+# how many ids fetch_query looks up per statement, and how many of
+# those statements it runs at once
+fetch_chunk_size = 1000
+fetch_threads = 4
+
 transactions = TransSet()
 
 BigInteger = postgres.PGBigInteger
@@ -456,6 +465,32 @@ def make_relation(rel_type_id, thing1_id, thing2_id, name, date=None):
         raise CreationError, "Relation exists (%s, %s, %s)" % (name, thing1_id, thing2_id)
         
 
+def make_relations(rel_type_id, rels):
+    """Inserts many (thing1_id, thing2_id, name, date) relations with
+    a single statement and returns their ids, in the same order. If
+    any of them already exist, none of them are inserted."""
+    table = get_rel_table(rel_type_id, action = 'write')[0]
+    transactions.add_engine(table.bind)
+
+    values = []
+    params = {}
+    for i, (thing1_id, thing2_id, name, date) in enumerate(rels):
+        values.append('(:t1_%d, :t2_%d, :name_%d, :date_%d)' % (i, i, i, i))
+        params.update({'t1_%d' % i: thing1_id,
+                       't2_%d' % i: thing2_id,
+                       'name_%d' % i: name,
+                       'date_%d' % i: date or datetime.now(g.tz)})
+
+    s = sa.text('INSERT INTO %s (thing1_id, thing2_id, name, date) '
+                'VALUES %s RETURNING rel_id' % (table.name, ', '.join(values)),
+                bind = table.bind)
+    try:
+        return [r.rel_id for r in s.execute(**params).fetchall()]
+    except sa.exceptions.SQLError, e:
+        if not 'IntegrityError' in e.message:
+            raise
+        raise CreationError, "Relations exist (%s)" % (rels,)
+
 def set_rel_props(rel_type_id, rel_id, **props):
     t = get_rel_table(rel_type_id, action = 'write')[0]
 
@@ -490,7 +525,7 @@ def py2db(val, return_kind=False):
 
 def db2py(val, kind):
     if kind == 'bool':
-        val = True if val is 't' else False
+        val = True if val == 't' else False
     elif kind == 'num':
         try:
             val = int(val)
@@ -503,30 +538,62 @@ def db2py(val, kind):
 
     return val
 
-#TODO i don't need type_id
-def set_data(table, type_id, thing_id, **vals):
-    s = sa.select([table.c.key], sa.and_(table.c.thing_id == thing_id))
-
-    transactions.add_engine(table.bind)
-    keys = [x.key for x in s.execute().fetchall()]
-
-    i = table.insert(values = dict(thing_id = thing_id))
-    u = table.update(sa.and_(table.c.thing_id == thing_id,
-                             table.c.key == sa.bindparam('key')))
-
-    inserts = []
-    for key, val in vals.iteritems():
+def _data_rows(rows):
+    """Returns a select of the (thing_id, key, value, kind) rows to
+    write to a data table, along with its bind params"""
+    selects = []
+    params = {}
+    for i, (thing_id, key, val) in enumerate(rows):
         val, kind = py2db(val, return_kind=True)
+        # the rows of the union have to agree on the column types
+        if isinstance(val, float):
+            val = repr(val)
+        elif isinstance(val, (int, long)):
+            val = str(val)
+        # typed, since a lone row's params would otherwise be left
+        # 'unknown' by postgres before 10
+        selects.append('SELECT CAST(:id_%d AS bigint) AS thing_id, '
+                       'CAST(:key_%d AS varchar) AS key, '
+                       'CAST(:value_%d AS varchar) AS value, '
+                       'CAST(:kind_%d AS varchar) AS kind' % (i, i, i, i))
+        params.update({'id_%d' % i: thing_id,
+                       'key_%d' % i: key,
+                       'value_%d' % i: val,
+                       'kind_%d' % i: kind})
+    return ' UNION ALL '.join(selects), params
+
+def set_data_multi(table, type_id, data):
+    """Sets the data props of many things, given as {thing_id: {key:
+    val}}. Keys that exist are updated and the rest are inserted, all
+    in one round trip to the db."""
+    rows = [(thing_id, key, val)
+            for thing_id, vals in data.iteritems()
+            for key, val in vals.iteritems()]
+    if not rows:
+        return
 
-        #TODO one update?
-        if key in keys:
-            u.execute(key = key, value = val, kind = kind)
-        else:
-            inserts.append({'key':key, 'value':val, 'kind': kind})
+    transactions.add_engine(table.bind)
+    values, params = _data_rows(rows)
+    stmts = ['UPDATE %(table)s SET value = v.value, kind = v.kind '
+             'FROM (%(values)s) AS v '
+             'WHERE %(table)s.thing_id = v.thing_id '
+             'AND %(table)s.key = v.key',
+             'INSERT INTO %(table)s (thing_id, key, value, kind) '
+             'SELECT v.thing_id, v.key, v.value, v.kind '
+             'FROM (%(values)s) AS v '
+             'WHERE NOT EXISTS (SELECT 1 FROM %(table)s AS d '
+             'WHERE d.thing_id = v.thing_id AND d.key = v.key)']
+    stmts = [stmt % dict(table = table.name, values = values)
+             for stmt in stmts]
+    # other dbs (e.g. sqlite in the tests) take one statement at a time
+    if table.bind.dialect.name == 'postgres':
+        stmts = ['; '.join(stmts)]
+    for stmt in stmts:
+        sa.text(stmt, bind = table.bind).execute(**params)
 
-    #do one insert
-    if inserts:
-        i.execute(*inserts)
+#TODO i don't need type_id
+def set_data(table, type_id, thing_id, **vals):
+    set_data_multi(table, type_id, {thing_id: vals})
 
 def incr_data_prop(table, type_id, thing_id, prop, amount):
     t = table
@@ -536,23 +603,82 @@ def incr_data_prop(table, type_id, thing_id, prop, amount):
                  values={t.c.value : sa.cast(t.c.value, sa.Float) + amount})
     u.execute()
 
-def fetch_query(table, id_col, thing_id):
+def _fetch_chunk(table, id_col_name, ids):
+    id_col = table.c[id_col_name]
+    if len(ids) == 1:
+        where = id_col == ids[0]
+    elif table.bind.dialect.name == 'postgres':
+        # a single array param keeps the statement the same however
+        # many ids there are
+        where = id_col == sa.func.any(sa.bindparam('ids', ids))
+    else:
+        where = id_col.in_(ids)
+    return sa.select([table], where).execute().fetchall()
+
+def _fetch_chunks(work):
+    """runs _fetch_chunk(*args) for each args in work, up to
+    fetch_threads at a time, and returns all of the rows"""
+    results = [None] * len(work)
+    todo = list(enumerate(work))
+    errors = []
+    lock = threading.Lock()
+
+    def fetch():
+        while not errors:
+            with lock:
+                if not todo:
+                    return
+                i, args = todo.pop()
+            try:
+                results[i] = _fetch_chunk(*args)
+            except Exception:
+                errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target = fetch)
+               for x in xrange(min(fetch_threads, len(work)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return list(itertools.chain(*results))
+
+def fetch_query(table, id_col, thing_id, read_table = None):
     """pull the columns from the thing/data tables for a list or single
-    thing_id"""
+    thing_id. Long lists are fetched fetch_chunk_size ids at a time;
+    if read_table is given, it's called to pick the table to read
+    each chunk after the first from, and the chunks are fetched
+    concurrently"""
     single = False
 
     if not isinstance(thing_id, iters):
         single = True
         thing_id = (thing_id,)
-    
-    s = sa.select([table], sa.or_(*[id_col == tid
-                                    for tid in thing_id]))
-    r = s.execute().fetchall()
+
+    ids = list(set(thing_id))
+    chunks = [ids[i:i + fetch_chunk_size]
+              for i in xrange(0, len(ids), fetch_chunk_size)]
+
+    # the engines are threadlocal, so other threads wouldn't see the
+    # writes of a transaction this one is in the middle of
+    if len(chunks) > 1 and read_table and not transactions.trans:
+        # get_table looks at c, so pick the tables here rather than
+        # in the threads
+        work = [(table, id_col.name, chunks[0])]
+        work.extend((read_table(), id_col.name, chunk)
+                    for chunk in chunks[1:])
+        r = _fetch_chunks(work)
+    else:
+        r = []
+        for chunk in chunks:
+            r.extend(_fetch_chunk(table, id_col.name, chunk))
     return (r, single)
 
 #TODO specify columns to return?
-def get_data(table, thing_id):
-    r, single = fetch_query(table, table.c.thing_id, thing_id)
+def get_data(table, thing_id, read_table = None):
+    r, single = fetch_query(table, table.c.thing_id, thing_id, read_table)
 
     #if single, only return one storage, otherwise make a dict
     res = storage() if single else {}
@@ -571,17 +697,23 @@ def set_thing_data(type_id, thing_id, **vals):
     table = get_thing_table(type_id, action = 'write')[1]
     return set_data(table, type_id, thing_id, **vals)
 
+def set_thing_data_multi(type_id, data):
+    table = get_thing_table(type_id, action = 'write')[1]
+    return set_data_multi(table, type_id, data)
+
 def incr_thing_data(type_id, thing_id, prop, amount):
     table = get_thing_table(type_id, action = 'write')[1]
     return incr_data_prop(table, type_id, thing_id, prop, amount)    
 
 def get_thing_data(type_id, thing_id):
     table = get_thing_table(type_id)[1]
-    return get_data(table, thing_id)
+    return get_data(table, thing_id,
+                    lambda: get_thing_table(type_id)[1])
 
 def get_thing(type_id, thing_id):
     table = get_thing_table(type_id)[0]
-    r, single = fetch_query(table, table.c.thing_id, thing_id)
+    r, single = fetch_query(table, table.c.thing_id, thing_id,
+                            lambda: get_thing_table(type_id)[0])
 
     #if single, only return one storage, otherwise make a dict
     res = {} if not single else None
@@ -606,17 +738,23 @@ def set_rel_data(rel_type_id, thing_id, **vals):
     table = get_rel_table(rel_type_id, action = 'write')[3]
     return set_data(table, rel_type_id, thing_id, **vals)
 
+def set_rel_data_multi(rel_type_id, data):
+    table = get_rel_table(rel_type_id, action = 'write')[3]
+    return set_data_multi(table, rel_type_id, data)
+
 def incr_rel_data(rel_type_id, thing_id, prop, amount):
     table = get_rel_table(rel_type_id, action = 'write')[3]
     return incr_data_prop(table, rel_type_id, thing_id, prop, amount)
 
 def get_rel_data(rel_type_id, rel_id):
     table = get_rel_table(rel_type_id)[3]
-    return get_data(table, rel_id)
+    return get_data(table, rel_id,
+                    lambda: get_rel_table(rel_type_id)[3])
 
 def get_rel(rel_type_id, rel_id):
     r_table = get_rel_table(rel_type_id)[0]
-    r, single = fetch_query(r_table, r_table.c.rel_id, rel_id)
+    r, single = fetch_query(r_table, r_table.c.rel_id, rel_id,
+                            lambda: get_rel_table(rel_type_id)[0])
     
     res = {} if not single else None
     for row in r:
@@ -641,6 +779,91 @@ def del_rel(rel_type_id, rel_id):
     table.delete(table.c.rel_id == rel_id).execute()
     data_table.delete(data_table.c.thing_id == rel_id).execute()
 
+class QueryParam(object):
+    """Stands in for a value of a rule in the cached queries, and
+    becomes a bind param of the same name"""
+    def __init__(self, name):
+        self.name = name
+
+# (kind, tables, shape of the rules, sort, limit) -> compiled select
+query_cache = {}
+query_cache_size = 1000
+# kind -> dict(hits, misses)
+query_cache_stats = {}
+_query_cache_lock = threading.Lock()
+
+def _lval_shape(lval):
+    if isinstance(lval, operators.query_func):
+        return (lval.__class__.__name__, _lval_shape(lval.lval))
+
+def _rules_shape(ops):
+    """What the SQL for a list of rules depends on: everything but
+    the values being compared against"""
+    shape = []
+    for op in ops:
+        if isinstance(op, operators.BooleanOp):
+            shape.append((op.__class__.__name__, _rules_shape(op.ops)))
+        elif isinstance(op.rval, operators.timeago):
+            shape.append((op.__class__.__name__, op.lval_name,
+                          _lval_shape(op.lval), op.rval.interval))
+        else:
+            # None becomes IS NULL rather than a bind param
+            shape.append((op.__class__.__name__, op.lval_name,
+                          _lval_shape(op.lval),
+                          tuple(v is None for v in tup(op.rval))))
+    return tuple(shape)
+
+def _rule_values(constraints):
+    """(op, index in its rval, value) for every value to bind, in the
+    order they're named p0, p1, ..."""
+    for op in operators.op_iter(constraints):
+        if not isinstance(op.rval, operators.timeago):
+            for i, v in enumerate(tup(op.rval)):
+                if v is not None:
+                    yield op, i, v
+
+def _param_rules(constraints):
+    """A copy of the rules with QueryParams in place of their values"""
+    constraints = deepcopy(constraints)
+    for n, (op, i, v) in enumerate(list(_rule_values(constraints))):
+        rval = list(tup(op.rval))
+        rval[i] = QueryParam('p%d' % n)
+        op.rval = tuple(rval)
+    return constraints
+
+def compiled_query(kind, tables, sort, limit, constraints, is_data, build):
+    """Returns the compiled query build(tables, sort, limit,
+    constraints) would make and the params to execute it with, only
+    building and compiling it the first time a query of its shape is
+    made. is_data tells which rules are on data props, whose values
+    are compared as strings"""
+    key = (kind, tuple(id(t) for t in tables), _rules_shape(constraints),
+           tuple((s.__class__.__name__, s.col) for s in tup(sort or ())),
+           limit)
+
+    compiled = query_cache.get(key)
+    with _query_cache_lock:
+        stats = query_cache_stats.setdefault(kind, dict(hits = 0,
+                                                        misses = 0))
+        stats['hits' if compiled else 'misses'] += 1
+
+    if not compiled:
+        s = build(tables, sort, limit, _param_rules(constraints))
+        compiled = s.compile()
+        with _query_cache_lock:
+            if len(query_cache) >= query_cache_size:
+                query_cache.clear()
+            query_cache[key] = compiled
+
+    params = {}
+    for n, (op, i, v) in enumerate(_rule_values(constraints)):
+        params['p%d' % n] = str(py2db(v)) if is_data(op.lval_name) else v
+    return compiled, params
+
+def cached_query(*a):
+    compiled, params = compiled_query(*a)
+    return compiled.execute(**params)
+
 def sa_op(op):
     #if BooleanOp
     if isinstance(op, operators.or_):
@@ -667,6 +890,9 @@ def sa_op(op):
     if not rval:
         return '2+2=5'
     else:
+        rval = [sa.bindparam(v.name, type_ = getattr(op.lval, 'type', None))
+                if isinstance(v, QueryParam) else v
+                for v in rval]
         return sa.or_(*[fn(op.lval, v) for v in rval])
 
 def translate_sort(table, column_name, lval = None, rewrite_name = True):
@@ -745,7 +971,12 @@ def translate_thing_value(rval):
 #will assume parameters start with a _ for consistency
 def find_things(type_id, get_cols, sort, limit, constraints):
     table = get_thing_table(type_id)[0]
-    constraints = deepcopy(constraints)
+    r = cached_query('find_things', (table,), sort, limit, constraints,
+                     lambda key: False, _find_things)
+    return Results(r, lambda(row): row if get_cols else row.thing_id)
+
+def _find_things(tables, sort, limit, constraints):
+    table, = tables
 
     s = sa.select([table.c.thing_id.label('thing_id')])
     
@@ -765,8 +996,7 @@ def find_things(type_id, get_cols, sort, limit, constraints):
     if limit:
         s = s.limit(limit)
 
-    r = s.execute()
-    return Results(r, lambda(row): row if get_cols else row.thing_id)
+    return s
 
 def translate_data_value(alias, op):
     lval = op.lval
@@ -781,13 +1011,19 @@ def translate_data_value(alias, op):
         
     #convert the rval to db types
     #convert everything to strings for pg8.3
-    op.rval = tuple(str(py2db(v)) for v in tup(op.rval))
+    op.rval = tuple(v if isinstance(v, QueryParam) else str(py2db(v))
+                    for v in tup(op.rval))
 
 #TODO sort by data fields
 #TODO sort by id wants thing_id
 def find_data(type_id, get_cols, sort, limit, constraints):
-    t_table, d_table = get_thing_table(type_id)
-    constraints = deepcopy(constraints)
+    tables = get_thing_table(type_id)
+    r = cached_query('find_data', tables, sort, limit, constraints,
+                     lambda key: not key.startswith('_'), _find_data)
+    return Results(r, lambda(row): row if get_cols else row.thing_id)
+
+def _find_data(tables, sort, limit, constraints):
+    t_table, d_table = tables
 
     used_first = False
     s = None
@@ -842,15 +1078,17 @@ def find_data(type_id, get_cols, sort, limit, constraints):
     if limit:
         s = s.limit(limit)
 
-    r = s.execute()
-
-    return Results(r, lambda(row): row if get_cols else row.thing_id)
+    return s
 
 
 def find_rels(rel_type_id, get_cols, sort, limit, constraints):
     tables = get_rel_table(rel_type_id)
+    r = cached_query('find_rels', tables, sort, limit, constraints,
+                     lambda key: not key.startswith('_'), _find_rels)
+    return Results(r, lambda (row): (row if get_cols else row.rel_id))
+
+def _find_rels(tables, sort, limit, constraints):
     r_table, t1_table, t2_table, d_table = tables
-    constraints = deepcopy(constraints)
 
     t1_table, t2_table = t1_table.alias(), t2_table.alias()
 
@@ -914,8 +1152,60 @@ def find_rels(rel_type_id, get_cols, sort, limit, constraints):
     if limit:
         s = s.limit(limit)
 
-    r = s.execute()
-    return Results(r, lambda (row): (row if get_cols else row.rel_id))
+    return s
+
+stream_batch_size = 1000
+
+def stream_query(kind, tables, sort, constraints, is_data, build,
+                 batch_size = stream_batch_size):
+    """Runs a find_* query without a limit and yields the ids it
+    returns in lists of up to batch_size. On postgres the rows are
+    read on a named (server-side) cursor, so the whole table is never
+    held in memory at once"""
+    compiled, params = compiled_query(kind, tables, sort, None,
+                                      constraints, is_data, build)
+    engine = tables[0].bind
+
+    if engine.dialect.name != 'postgres':
+        r = compiled.execute(**params)
+        while True:
+            rows = r.fetchmany(batch_size)
+            if not rows:
+                break
+            yield [row[0] for row in rows]
+        return
+
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor('stream_%x' % random.getrandbits(32))
+        cursor.execute(str(compiled), compiled.construct_params(params))
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield [row[0] for row in rows]
+        cursor.close()
+    finally:
+        # named cursors live in a transaction; end it before the
+        # connection goes back to the pool
+        conn.rollback()
+        conn.close()
+
+def stream_things(type_id, sort, constraints, batch_size = stream_batch_size):
+    return stream_query('find_things', get_thing_table(type_id)[:1], sort,
+                        constraints, lambda key: False, _find_things,
+                        batch_size)
+
+def stream_data(type_id, sort, constraints, batch_size = stream_batch_size):
+    return stream_query('find_data', get_thing_table(type_id), sort,
+                        constraints, lambda key: not key.startswith('_'),
+                        _find_data, batch_size)
+
+def stream_rels(rel_type_id, sort, constraints,
+                batch_size = stream_batch_size):
+    return stream_query('find_rels', get_rel_table(rel_type_id), sort,
+                        constraints, lambda key: not key.startswith('_'),
+                        _find_rels, batch_size)
 
 if logging.getLogger('sqlalchemy').handlers:
     logging.getLogger('sqlalchemy').handlers[0].formatter = log_format
@@ -23,8 +23,13 @@
 from __future__ import with_statement
 
 import new, sys, sha
+import heapq
+import threading
+from Queue import Queue
+from itertools import izip
 from datetime import datetime
 from copy import copy, deepcopy
+from contextlib import nested
 
 import operators
 import tdb_sql as tdb
@@ -33,7 +38,7 @@ from .. utils import iters, Results, tup, to36, Storage
 from r2.config import cache
 from r2.lib.cache import sgm
 from r2.lib.log import log_text
-from pylons import g
+from pylons import g, c
 
 
 class NotFound(Exception): pass
@@ -249,6 +254,46 @@ class DataThing(object):
 
             self._cache_myself()
 
+    @classmethod
+    def _commit_multi(cls, things):
+        """Commits many things of this class, writing all of their
+        dirty data props to the db at once"""
+        for t in things:
+            if not t._created:
+                t._create()
+
+        # take the locks in a consistent order so that two batches
+        # can't each be waiting on the other
+        things = sorted(things, key = lambda t: t._fullname)
+        locks = [g.make_lock('commit_' + t._fullname) for t in things]
+        with nested(*locks):
+            data = {}
+            for t in things:
+                if not t._sync_latest():
+                    continue
+
+                data_props = {}
+                thing_props = {}
+                for k, (old_val, new_val) in t._dirties.iteritems():
+                    if k.startswith('_'):
+                        thing_props[k[1:]] = new_val
+                    else:
+                        data_props[k] = new_val
+
+                if data_props:
+                    data[t._id] = data_props
+
+                if thing_props:
+                    t._set_props(t._type_id, t._id, **thing_props)
+
+            if data:
+                cls._set_data_multi(cls._type_id, data)
+
+            for t in things:
+                t._dirties.clear()
+
+            cache.set_multi(dict((t._cache_key(), t) for t in things))
+
     @classmethod
     def _load_multi(cls, need):
         need = tup(need)
@@ -361,6 +406,24 @@ class DataThing(object):
         else:
             return filter(None, (bases.get(i) for i in ids))
 
+    @classmethod
+    def _byID_nocache(cls, ids, data=False):
+        """Builds the things with the given ids straight from the db,
+        neither reading nor writing the cache. Returns them in the
+        order of ids, skipping any that don't exist."""
+        items = cls._get_item(cls._type_id, ids)
+        datas = cls._get_data(cls._type_id, ids) if data else {}
+
+        things = []
+        for i in ids:
+            if i in items:
+                thing = cls._build(i, items[i])
+                if data:
+                    thing._t.update(datas.get(i, {}))
+                    thing._loaded = True
+                things.append(thing)
+        return things
+
     @classmethod
     def _byID36(cls, id36s, return_dict = True, **kw):
 
@@ -482,6 +545,7 @@ class Thing(DataThing):
     _set_props = staticmethod(tdb.set_thing_props)
     _get_data = staticmethod(tdb.get_thing_data)
     _set_data = staticmethod(tdb.set_thing_data)
+    _set_data_multi = staticmethod(tdb.set_thing_data_multi)
     _get_item = staticmethod(tdb.get_thing)
     _incr_data = staticmethod(tdb.incr_thing_data)
     _type_prefix = 't'
@@ -601,6 +665,7 @@ def Relation(type1, type2, denorm1 = None, denorm2 = None):
         _set_props = staticmethod(tdb.set_rel_props)
         _get_data = staticmethod(tdb.get_rel_data)
         _set_data = staticmethod(tdb.set_rel_data)
+        _set_data_multi = staticmethod(tdb.set_rel_data_multi)
         _get_item = staticmethod(tdb.get_rel)
         _incr_data = staticmethod(tdb.incr_rel_data)
         _type_prefix = Relation._type_prefix
@@ -707,6 +772,20 @@ def Relation(type1, type2, denorm1 = None, denorm2 = None):
             #know it's deleted. save -> unsave, hide -> unhide
             self._name = 'un' + self._name
 
+        @classmethod
+        def _create_multi(cls, rels):
+            """Inserts the rows for many new relations at once. They
+               still need to be _commit()ed to save their data."""
+            rels = [r for r in rels if not r._created]
+            if not rels:
+                return
+            ids = tdb.make_relations(cls._type_id,
+                                     [(r._thing1_id, r._thing2_id, r._name,
+                                       r._date) for r in rels])
+            for r, id in zip(rels, ids):
+                r._id = id
+                r._created = True
+
         @classmethod
         def _fast_query_timestamp_touch(cls, thing1):
             assert thing1._loaded
@@ -917,6 +996,9 @@ class Query(object):
     def _cursor(*a, **kw):
         raise NotImplementedError
 
+    def _stream(*a, **kw):
+        raise NotImplementedError
+
     def _iden(self):
         i = str(self._sort) + str(self._kind) + str(self._limit)
         if self._rules:
@@ -1014,6 +1096,21 @@ class Things(Query):
 
         return Results(c, row_fn, True)
 
+    def _stream(self, batch_size = tdb.stream_batch_size):
+        """Yields the things the query matches in lists of up to
+        batch_size, ignoring its limit and the cache"""
+        params = (self._kind._type_id,
+                  self._sort,
+                  self._rules,
+                  batch_size)
+        if self._use_data:
+            batches = tdb.stream_data(*params)
+        else:
+            batches = tdb.stream_things(*params)
+
+        for ids in batches:
+            yield self._kind._byID_nocache(ids, self._data)
+
 def load_things(rels, load_data=False):
     rels = tup(rels)
     kind = rels[0].__class__
@@ -1059,6 +1156,16 @@ class Relations(Query):
                           constraints = self._rules)
         return Results(c, self._make_rel, True)
 
+    def _stream(self, batch_size = tdb.stream_batch_size):
+        """Yields the relations the query matches in lists of up to
+        batch_size, ignoring its limit and the cache"""
+        for ids in tdb.stream_rels(self._kind._type_id, self._sort,
+                                   self._rules, batch_size):
+            rels = self._kind._byID_nocache(ids, self._data)
+            if rels and self._eager_load:
+                load_things(rels, self._thing_data)
+            yield rels
+
 class MultiCursor(object):
     def __init__(self, *execute_params):
         self._execute_params = execute_params
@@ -1076,61 +1183,192 @@ class MultiCursor(object):
 
         return [i for i in self._cursor]
 
-class MergeCursor(MultiCursor):
-    def _execute(self, cursors, sorts):
-        #a "pair" is a (cursor, item, done) tuple
-        def safe_next(c):
+merge_threads = 4
+merge_chunk_size = 100
+
+def _fetch_chunk(cursor, n):
+    """returns the next n items of cursor, skipping the ones that raise
+    NotFound. Fewer than n means the cursor is done"""
+    items = []
+    if isinstance(cursor, Results) and cursor.do_batch:
+        while len(items) < n:
+            rows = cursor.rp.fetchmany(n - len(items))
+            if not rows:
+                break
             try:
-                #hack to keep searching even if fetching a thing returns notfound
-                while True:
+                items.extend(cursor._fetch(rows))
+            except NotFound:
+                #load them one at a time to skip the broken ones
+                for row in rows:
                     try:
-                        return [c, c.fetchone(), False]
+                        items.extend(cursor._fetch([row]))
                     except NotFound:
-                        #skips the broken item
                         pass
-            except StopIteration:
-                return c, None, True
-
-        def undone(pairs):
-            return [p for p in pairs if not p[2]]
-
-        pairs = undone(safe_next(c) for c in cursors)
-
-        while pairs:
-            #only one query left, just dump it
-            if len(pairs) == 1:
-                c, item, done = pair = pairs[0]
-                while not done:
-                    yield item
-                    c, item, done = safe_next(c)
-                    pair[:] = c, item, done
-            else:
-                #by default, yield the first item
-                yield_pair = pairs[0]
-                for s in sorts:
-                    col = s.col
-                    #sort direction?
-                    max_fn = min if isinstance(s, operators.asc) else max
-
-                    #find the max (or min) val
-                    vals = [(getattr(i[1], col), i) for i in pairs]
-                    max_pair = vals[0]
-                    all_equal = True
-                    for pair in vals[1:]:
-                        if all_equal and pair[0] != max_pair[0]:
-                            all_equal = False
-                        max_pair = max_fn(max_pair, pair, key=lambda x: x[0])
-
-                    if not all_equal:
-                        yield_pair = max_pair[1]
-                        break
-
-                c, item, done = yield_pair
-                yield item
-                yield_pair[:] = safe_next(c)
-
-            pairs = undone(pairs)
-        raise StopIteration
+        return items
+
+    while len(items) < n:
+        try:
+            items.append(cursor.fetchone())
+        except NotFound:
+            pass
+        except StopIteration:
+            break
+    return items
+
+def _current_obj(proxy):
+    try:
+        return proxy._current_obj()
+    except TypeError:
+        #nothing registered for this thread
+        return None
+
+class _Inline(object):
+    """a job that runs in the calling thread when its result is asked
+    for"""
+    def __init__(self, fn):
+        self.fn = fn
+
+    def result(self):
+        return self.fn()
+
+class _Pooled(object):
+    """a job that has been handed to a _MergePool"""
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = self.exc_info = None
+
+    def result(self):
+        self.done.wait()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+class _MergePool(object):
+    """num_threads daemon threads, started on first use and shared by
+    every MergeCursor in the process. When they're all busy, jobs run
+    inline instead of waiting on other requests' queries"""
+    def __init__(self, num_threads):
+        self.num_threads = num_threads
+        self.idle = 0
+        self.started = False
+        self.lock = threading.Lock()
+        self.jobs = Queue()
+        self.local = threading.local()
+
+    def _start(self):
+        for x in xrange(self.num_threads):
+            t = threading.Thread(target = self._run)
+            t.setDaemon(True)
+            t.start()
+        self.idle = self.num_threads
+        self.started = True
+
+    def _run(self):
+        self.local.in_pool = True
+        while True:
+            fn, envs, job = self.jobs.get()
+            for proxy, obj in envs:
+                proxy._push_object(obj)
+            try:
+                job.value = fn()
+            except Exception:
+                job.exc_info = sys.exc_info()
+            finally:
+                for proxy, obj in envs:
+                    proxy._pop_object()
+                with self.lock:
+                    self.idle += 1
+                job.done.set()
+
+    def submit(self, fn):
+        # the engines are threadlocal, so other threads wouldn't see the
+        # writes of a transaction this one is in the middle of; and a
+        # merge within a merge mustn't wait on its own pool
+        if (tdb.transactions.trans
+            or getattr(self.local, 'in_pool', False)):
+            return _Inline(fn)
+
+        with self.lock:
+            if not self.started:
+                self._start()
+            if not self.idle:
+                return _Inline(fn)
+            self.idle -= 1
+
+        # the queries look at g and c, so give the thread this one's
+        envs = [(proxy, _current_obj(proxy)) for proxy in (g, c)]
+        envs = [(proxy, obj) for proxy, obj in envs if obj is not None]
+        job = _Pooled()
+        self.jobs.put((fn, envs, job))
+        return job
+
+merge_pool = _MergePool(merge_threads)
+
+def _stream(first, chunk_size, submit):
+    """yields the items of a cursor chunk_size at a time. first is the
+    job that opens the cursor and fetches its first chunk, and returns
+    (cursor, items). Each following chunk is fetched with submit()
+    while the previous one is being consumed"""
+    cursor, items = first.result()
+    while True:
+        more = None
+        if len(items) == chunk_size:
+            more = submit(lambda: _fetch_chunk(cursor, chunk_size))
+        for item in items:
+            yield item
+        if more is None:
+            return
+        items = more.result()
+
+class _MergeKey(object):
+    """the values of an item's sort columns, compared in the direction
+    of each sort"""
+    __slots__ = ('vals', 'descs')
+
+    def __init__(self, vals, descs):
+        self.vals = vals
+        self.descs = descs
+
+    def __eq__(self, other):
+        return self.vals == other.vals
+
+    def __lt__(self, other):
+        for val, other_val, desc in izip(self.vals, other.vals, self.descs):
+            if val != other_val:
+                return val > other_val if desc else val < other_val
+        return False
+
+class MergeCursor(MultiCursor):
+    def _execute(self, cursor_fns, sorts, limit = None):
+        """merges the items of the cursors returned by cursor_fns, each
+        already sorted by sorts. The cursors are opened concurrently on
+        merge_pool and read in chunks of up to limit (or
+        merge_chunk_size) items as the merge needs them, and items
+        that raise NotFound are skipped"""
+        cols = [s.col for s in sorts]
+        descs = [not isinstance(s, operators.asc) for s in sorts]
+        cursor_fns = list(cursor_fns)
+        chunk_size = min(limit or merge_chunk_size, merge_chunk_size)
+        submit = merge_pool.submit if len(cursor_fns) > 1 else _Inline
+
+        def opener(fn):
+            def open_cursor():
+                cursor = fn()
+                return cursor, _fetch_chunk(cursor, chunk_size)
+            return open_cursor
+
+        def keyed(i, items):
+            for j, item in enumerate(items):
+                key = _MergeKey(tuple(getattr(item, col) for col in cols),
+                                descs)
+                #ties go to the earlier cursor, as they always have
+                yield key, i, j, item
+
+        firsts = [submit(opener(fn)) for fn in cursor_fns]
+        streams = [keyed(i, _stream(first, chunk_size, submit))
+                   for i, first in enumerate(firsts)]
+        for key, i, j, item in heapq.merge(*streams):
+            yield item
 
 class MultiQuery(Query):
     def __init__(self, queries, *rules, **kw):
@@ -1196,8 +1434,8 @@ class Merge(MultiQuery):
                       (q._sort for q in self._queries))):
             raise "The sorts should be the same"
 
-        return MergeCursor((q._cursor() for q in self._queries),
-                           self._sort)
+        return MergeCursor([q._cursor for q in self._queries],
+                           self._sort, self._limit)
 
 def MultiRelation(name, *relations):
     rels_tmp = {}
@@ -19,23 +19,185 @@
 # All portions of the code written by CondeNet are Copyright (c) 2006-2010
 # CondeNet, Inc. All Rights Reserved.
 ################################################################################
-
 from __future__ import with_statement
-from time import sleep
-from datetime import datetime
+from time import sleep, time
 from threading import local
+import itertools
+import os
+import random
+import socket
+import threading
 
 # thread-local storage for detection of recursive locks
 locks = local()
 
 class TimeoutExpired(Exception): pass
 
+# key prefix -> contention counters, for every lock taken in this
+# process. wait and hold are total seconds
+lock_stats = {}
+_stats_lock = threading.Lock()
+
+# the start of each kind of lock key used in r2, before the ids of
+# the things it protects. Any other key is counted as 'other', so that
+# lock_stats stays the same size however many things get locked
+known_prefixes = sorted(['commit_', 'comment_lock_', 'create_sr_',
+                         'message_conversations_lock_',
+                         'sr_messages_conversation_lock_',
+                         'edit_promo_campaign_lock_', 'lock_',
+                         'modify_sr_last_batch_query(', 'add_query(',
+                         'memoize_lock('],
+                        key = len, reverse = True)
+
+def key_prefix(key):
+    """The part of a lock key naming what it protects, without the
+    ids of the things: 'commit_t3_5' -> 'commit'"""
+    for prefix in known_prefixes:
+        if key.startswith(prefix):
+            return prefix.rstrip('_(')
+    return 'other'
+
+def _record(key, **kw):
+    prefix = key_prefix(key)
+    with _stats_lock:
+        stats = lock_stats.get(prefix)
+        if stats is None:
+            stats = lock_stats[prefix] = dict(acquired = 0, contended = 0,
+                                              timeouts = 0, renewed = 0,
+                                              capped = 0, lost = 0, wait = 0.,
+                                              max_wait = 0., hold = 0.,
+                                              max_hold = 0.)
+        for k, v in kw.iteritems():
+            stats[k] += v
+            if k in ('wait', 'hold'):
+                stats['max_' + k] = max(stats['max_' + k], v)
+
+def stats_report():
+    """lock_stats as lines of text, the most contended locks first"""
+    with _stats_lock:
+        stats = [(prefix, s.copy()) for prefix, s in lock_stats.iteritems()]
+    stats.sort(key = lambda (prefix, s): (-s['contended'], prefix))
+    lines = []
+    for prefix, s in stats:
+        acquired = s['acquired'] or 1
+        lines.append('%-30s acquired %d contended %d timeouts %d '
+                     'renewed %d capped %d lost %d '
+                     'wait avg %.3fs max %.3fs hold avg %.3fs max %.3fs'
+                     % (prefix, s['acquired'], s['contended'],
+                        s['timeouts'], s['renewed'], s['capped'], s['lost'],
+                        s['wait'] / acquired, s['max_wait'],
+                        s['hold'] / acquired, s['max_hold']))
+    return lines
+
+class _LocalLock(object):
+    """Hands a key to the threads of this process one at a time, so
+    that they queue here instead of all polling memcache"""
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.held = False
+        self.users = 0
+
+    def acquire(self, timeout):
+        with self.cond:
+            if not self.held:
+                self.held = True
+                return True, False
+            end = time() + timeout
+            while self.held:
+                remaining = end - time()
+                if remaining <= 0:
+                    return False, True
+                self.cond.wait(remaining)
+            self.held = True
+            return True, True
+
+    def release(self):
+        with self.cond:
+            self.held = False
+            self.cond.notify()
+
+# key -> _LocalLock, for the keys some thread in this process is
+# holding or waiting on
+_local_locks = {}
+_local_locks_lock = threading.Lock()
+
+def _local_lock(key):
+    with _local_locks_lock:
+        l = _local_locks.get(key)
+        if l is None:
+            l = _local_locks[key] = _LocalLock()
+        l.users += 1
+        return l
+
+def _local_unlock(key, l):
+    l.release()
+    with _local_locks_lock:
+        l.users -= 1
+        if not l.users:
+            del _local_locks[key]
+
+class _Renewer(threading.Thread):
+    """Extends the memcache lease of locks that are held for more
+    than half of it"""
+    def __init__(self):
+        threading.Thread.__init__(self, name = 'lock renewer')
+        self.setDaemon(True)
+        self.held = set()
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+
+    def add(self, lock):
+        with self.lock:
+            self.held.add(lock)
+        self.wake.set()
+
+    def remove(self, lock):
+        with self.lock:
+            self.held.discard(lock)
+
+    def run(self):
+        while True:
+            with self.lock:
+                held = list(self.held)
+            now = time()
+            next_check = now + 60
+            for lock in held:
+                if now >= lock.renew_at:
+                    lock.renew()
+                next_check = min(next_check, lock.renew_at)
+            self.wake.wait(max(next_check - time(), .01))
+            self.wake.clear()
+
+_renewer = None
+_renewer_lock = threading.Lock()
+
+def _renew_later(lock):
+    global _renewer
+    with _renewer_lock:
+        if _renewer is None or not _renewer.isAlive():
+            _renewer = _Renewer()
+            _renewer.start()
+    _renewer.add(lock)
+
+_token_ids = itertools.count()
+
 class MemcacheLock(object):
-    """A simple global lock based on the memcache 'add' command. We
-    attempt to grab a lock by 'adding' the lock name. If the response
-    is True, we have the lock. If it's False, someone else has it."""
+    """A global lock based on the memcache 'add' command. We attempt
+    to grab a lock by 'adding' the lock name. If the response is
+    True, we have the lock. If it's False, someone else has it.
+
+    Threads of the same process wait their turn on a local lock
+    before going to memcache, and memcache is retried with
+    exponential backoff and jitter. The lock is a lease of `time'
+    seconds, so a holder that hangs can't keep it forever. For long
+    critical sections, renew extends the lease in the background
+    while the lock is held, for up to `max_hold' seconds in all."""
+
+    min_delay = .01
+    max_delay = 1
 
-    def __init__(self, key, cache, time = 30, timeout = 30):
+    def __init__(self, key, cache, time = 30, timeout = 30, renew = False,
+                 max_hold = 600):
         # get a thread-local set of locks that we own
         self.locks = locks.locks = getattr(locks, 'locks', set())
 
@@ -43,34 +205,105 @@ class MemcacheLock(object):
         self.cache = cache
         self.time = time
         self.timeout = timeout
+        self.renew_leases = renew
+        self.max_hold = max_hold
         self.have_lock = False
+        self.local = None
+        # keeps the renewer from extending a lease that's being released
+        self.mutex = threading.Lock()
+        self.token = '%s-%s-%s' % (socket.gethostname(), os.getpid(),
+                                   _token_ids.next())
 
     def __enter__(self):
-        start = datetime.now()
+        start = time()
 
         #if this thread already has this lock, move on
         if self.key in self.locks:
             return
 
-        #try and fetch the lock, looping until it's available
-        while not self.cache.add(self.key, 1, time = self.time):
-            if (datetime.now() - start).seconds > self.timeout:
+        # wait behind the other threads of this process first
+        self.local = _local_lock(self.key)
+        acquired, contended = self.local.acquire(self.timeout)
+        if not acquired:
+            _local_unlock(self.key, self.local)
+            self.local = None
+            _record(self.key, contended = 1, timeouts = 1,
+                    wait = time() - start)
+            raise TimeoutExpired
+
+        #try and fetch the lock, backing off until it's available
+        delay = self.min_delay
+        while not self.cache.add(self.key, self.token, time = self.time):
+            contended = True
+            remaining = self.timeout - (time() - start)
+            if remaining <= 0:
+                _local_unlock(self.key, self.local)
+                self.local = None
+                _record(self.key, contended = 1, timeouts = 1,
+                        wait = time() - start)
                 raise TimeoutExpired
 
-            sleep(.1)
+            sleep(min(random.uniform(delay / 2, delay), remaining))
+            delay = min(delay * 2, self.max_delay)
 
         #tell this thread we have this lock so we can avoid deadlocks
         #of requests for the same lock in the same thread
         self.locks.add(self.key)
         self.have_lock = True
+        self.acquired_at = self.leased_at = time()
+        _record(self.key, acquired = 1, contended = int(contended),
+                wait = self.acquired_at - start)
+
+        if self.renew_leases:
+            self.renew_at = self.acquired_at + self.time / 2.
+            _renew_later(self)
+
+    def renew(self):
+        """Extends the lease by another `time' seconds, as long as
+        nobody else has taken the lock since it expired and it hasn't
+        been held for max_hold seconds"""
+        with self.mutex:
+            if not self.have_lock:
+                return False
+            if time() - self.acquired_at >= self.max_hold:
+                # let the lease run out
+                _record(self.key, capped = 1)
+                self.renew_at = float('inf')
+                return False
+            if self.cache.get(self.key) != self.token:
+                _record(self.key, lost = 1)
+                self.renew_at = float('inf')
+                return False
+            self.cache.set(self.key, self.token, time = self.time)
+            self.leased_at = time()
+            self.renew_at = self.leased_at + self.time / 2.
+        _record(self.key, renewed = 1)
+        return True
 
     def __exit__(self, type, value, tb):
         #only release the lock if we gained it in the first place
-        if self.have_lock:
-            self.cache.delete(self.key)
-            self.locks.remove(self.key)
+        if not self.have_lock:
+            return
+
+        if self.renew_leases:
+            _renewer.remove(self)
+
+        with self.mutex:
+            # if the lease ran out someone else may have the lock by
+            # now, so only delete it if it's still ours
+            if (time() - self.leased_at < self.time or
+                self.cache.get(self.key) == self.token):
+                self.cache.delete(self.key)
+            else:
+                _record(self.key, lost = 1)
+            self.have_lock = False
+
+        self.locks.remove(self.key)
+        _local_unlock(self.key, self.local)
+        self.local = None
+        _record(self.key, hold = time() - self.acquired_at)
 
 def make_lock_factory(cache):
-    def factory(key):
-        return MemcacheLock(key, cache)
+    def factory(key, **kw):
+        return MemcacheLock(key, cache, **kw)
     return factory
@@ -19,7 +19,11 @@
 # All portions of the code written by CondeNet are Copyright (c) 2006-2010
 # CondeNet, Inc. All Rights Reserved.
 ################################################################################
+from __future__ import with_statement
 from hashlib import md5
+from time import time as _now
+import sys
+import threading
 
 from r2.config import cache
 from r2.lib.filters import _force_utf8
@@ -29,7 +33,17 @@ from pylons import g
 
 make_lock = g.make_lock
 
-def memoize(iden, time = 0):
+def memoize(iden, time = 0, stale_time = None):
+    """Caches the results of the decorated function for `time'
+       seconds. Concurrent misses are serialised with a memcache lock.
+
+       If `stale_time' is given, results are instead kept for `time' +
+       `stale_time' seconds, and after the first `time' of those are
+       still returned while a single caller recomputes them (see
+       _memoize_stale)."""
+    if stale_time is not None:
+        return _memoize_stale(iden, time, stale_time)
+
     def memoize_fn(fn):
         from r2.lib.memoize import NoneResult
         def new_fn(*a, **kw):
@@ -68,6 +82,129 @@ def memoize(iden, time = 0):
         return new_fn
     return memoize_fn
 
+# iden -> counts of what the stale_time memoizes have done:
+#   hit        returned a fresh cached value
+#   stale      returned a stale value while someone else recomputes it
+#   miss       nothing was cached
+#   wait       waited on another thread's computation after a miss
+#   recompute  called the memoized function
+memoize_stats = {}
+_stats_lock = threading.Lock()
+
+def _count(iden, what):
+    with _stats_lock:
+        counts = memoize_stats.get(iden)
+        if counts is None:
+            counts = memoize_stats[iden] = dict(hit = 0, stale = 0, miss = 0,
+                                                wait = 0, recompute = 0)
+        counts[what] += 1
+
+class _Flight(object):
+    """A computation in progress that other threads can wait on"""
+    def __init__(self):
+        self.done = threading.Event()
+        self.res = None
+        self.exc_info = None
+
+# key -> _Flight, for the computations running in this process
+_flights = {}
+_flights_lock = threading.Lock()
+
+def _single_flight(key, fn):
+    """Calls fn() and returns (its result, True), unless another thread
+       in this process is already calling it for `key', in which case
+       waits for that call and returns (its result, False)"""
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+
+    if not leader:
+        flight.done.wait()
+        if flight.exc_info:
+            raise flight.exc_info[0], flight.exc_info[1], flight.exc_info[2]
+        return flight.res, False
+
+    try:
+        flight.res = fn()
+    except:
+        flight.exc_info = sys.exc_info()
+        raise
+    finally:
+        with _flights_lock:
+            del _flights[key]
+        flight.done.set()
+    return flight.res, True
+
+class StaleResult(object):
+    """what _memoize_stale caches: a result and the time it goes
+       stale. It has a type of its own so that it can't be mistaken
+       for a result cached by a plain memoize"""
+    def __init__(self, stale_at, res):
+        self.stale_at = stale_at
+        self.res = res
+
+def _memoize_stale(iden, time, stale_time, refresh_timeout = 30):
+    """memoize with stale-while-revalidate instead of a lock. Results
+       are cached as a StaleResult, under keys of their own so that
+       servers still running a plain memoize with the same iden (e.g.
+       during a deploy) don't read them, or overwrite them.
+
+       On a miss, the threads of a process share a single computation
+       (other processes will do their own). Once a result is stale
+       it's still returned to everyone but the one caller that
+       manages to `add' the refresh key, which recomputes it; nobody
+       sleeps on a lock."""
+    stale_iden = iden + '_swr'
+
+    def memoize_fn(fn):
+        def new_fn(*a, **kw):
+            update = kw.pop('_update', False)
+            key = make_key(stale_iden, *a, **kw)
+
+            def compute():
+                _count(iden, 'recompute')
+                res = fn(*a, **kw)
+                if res is None:
+                    res = NoneResult
+                cache.set(key, StaleResult(_now() + time, res),
+                          time = time + stale_time)
+                return res
+
+            cached = None if update else cache.get(key)
+
+            if not isinstance(cached, StaleResult):
+                # not cached
+                _count(iden, 'miss')
+                res, computed = _single_flight(key, compute)
+                if not computed:
+                    _count(iden, 'wait')
+            else:
+                res = cached.res
+                if cached.stale_at > _now():
+                    _count(iden, 'hit')
+                elif key in _flights:
+                    # a thread in this process is already on it
+                    _count(iden, 'stale')
+                else:
+                    refresh_key = 'memoize_refresh(%s)' % key
+                    if g.memcache.add(refresh_key, 1, time = refresh_timeout):
+                        try:
+                            res, computed = _single_flight(key, compute)
+                        finally:
+                            g.memcache.delete(refresh_key)
+                    else:
+                        _count(iden, 'stale')
+
+            if res == NoneResult:
+                res = None
+
+            return res
+
+        return new_fn
+    return memoize_fn
+
 @memoize('test')
 def test(x, y):
     import time
@@ -22,6 +22,7 @@
 """
 One-time use functions to migrate from one reddit-version to another
 """
+from __future__ import with_statement
 from r2.lib.promote import *
 
 def add_allow_top_to_srs():
@@ -403,3 +404,25 @@ def prime_url_cache(f, verbosity = 10000):
         if counter % verbosity == 0:
             print "%6d: %s" % (counter, line)
             print "--> doing %5.2f / s" % (float(counter) / (time.time() - start_time))
+
+def chunk_comment_trees(verbosity = 1000):
+    """Convert the comment trees stored under the legacy single
+       comments_<link_id> key into the chunked format. Trees that
+       aren't converted here are converted the first time they are
+       read"""
+    from pylons import g
+    from r2.models import Link
+    from r2.lib.db.operators import desc
+    from r2.lib.utils import fetch_things2
+    from r2.lib.comment_tree import migrate_link_comments, lock_key
+
+    l_q = Link._query(Link.c._spam == (True, False),
+                      Link.c._deleted == (True, False),
+                      sort=desc('_date'))
+
+    done = 0
+    for link in fetch_things2(l_q, verbosity):
+        with g.make_lock(lock_key(link._id), renew = True):
+            if migrate_link_comments(link._id):
+                done += 1
+    print 'Converted %d comment trees' % done
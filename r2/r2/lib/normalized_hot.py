@@ -30,10 +30,20 @@ from r2.lib.memoize import memoize
 from pylons import g
 
 from datetime import datetime, timedelta
+from operator import itemgetter
+import itertools
 import random
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 expire_delta = timedelta(minutes = 2)
 max_items = 150
+# like the precomputed listings in r2.lib.db.queries, the front page
+# only goes this deep
+max_results = 1000
 
 def access_key(sr):
     return sr.name + '_access'
@@ -76,10 +86,9 @@ def cached_query(query, sr):
 
     return res
 
-def get_hot(srs, only_fullnames = False):
-    """Get the (fullname, hotness, epoch_seconds) for the hottest
-       links in a subreddit. Use the query-cache to avoid some lookups
-       if we can."""
+def _get_hot_lists(srs):
+    """The (fullname, hotness, epoch_seconds) for the hottest links in
+       each subreddit, hottest first, without any age filtering."""
     from r2.lib.db.thing import Query
     from r2.lib.db.queries import CachedResults
 
@@ -90,7 +99,7 @@ def get_hot(srs, only_fullnames = False):
     cachedresults = filter(lambda q: isinstance(q, CachedResults), queries)
     CachedResults.fetch_multi(cachedresults)
 
-    for q in queries:
+    for sr, q in zip(srs, queries):
         if isinstance(q, Query):
             links = cached_query(q, sr)
             res = [(link._fullname, link._hot, epoch_seconds(link._date))
@@ -100,25 +109,32 @@ def get_hot(srs, only_fullnames = False):
             # CachedResults here, where it's storing tuples that look
             # exactly like the return-type we want, to make our
             # sorting a bit cheaper
-            res = list(q.data)
-
-        # remove any that are too old
-        age_limit = epoch_seconds(utils.timeago('%d days' % g.HOT_PAGE_AGE))
-        res = [(fname if only_fullnames else (fname, hot, date))
-               for (fname, hot, date) in res
-               if date > age_limit]
+            res = q.data
         ret.append(res)
 
     return ret
 
-@memoize('normalize_hot', time = g.page_cache_time)
-def normalized_hot_cached(sr_ids):
-    """Fetches the hot lists for each subreddit, normalizes the
-       scores, and interleaves the results."""
+def _age_limit():
+    return epoch_seconds(utils.timeago('%d days' % g.HOT_PAGE_AGE))
+
+def get_hot(srs, only_fullnames = False):
+    """Get the (fullname, hotness, epoch_seconds) for the hottest
+       links in a subreddit. Use the query-cache to avoid some lookups
+       if we can."""
+    # remove any that are too old
+    age_limit = _age_limit()
+    return [[(fname if only_fullnames else (fname, hot, date))
+             for (fname, hot, date) in res
+             if date > age_limit]
+            for res in _get_hot_lists(srs)]
+
+def _normalize_hot(hots, age_limit, limit = max_results):
+    """Normalizes the scores of the hot lists and interleaves them,
+       returning the fullnames of the first `limit' items."""
     results = []
-    srs = Subreddit._byID(sr_ids, return_dict = False)
-    hots = get_hot(srs)
     for items in hots:
+        # remove any that are too old
+        items = [x for x in items if x[2] > age_limit]
         if not items:
             continue
 
@@ -135,7 +151,57 @@ def normalized_hot_cached(sr_ids):
     results.sort(key = lambda x: x[1:], reverse = True)
 
     # and return the fullnames
-    return [l[0] for l in results]
+    return [l[0] for l in results[:limit]]
+
+def _normalize_hot_numpy(hots, age_limit, limit = max_results):
+    """The same as _normalize_hot, but with all of the hot lists
+       concatenated into arrays so that the age filtering,
+       normalization and sorting are done by numpy. Only the winning
+       rows are turned back into fullnames."""
+    hots = [items for items in hots if items]
+    if not hots:
+        return []
+
+    counts = numpy.array([len(items) for items in hots])
+    starts = numpy.concatenate(([0], numpy.cumsum(counts)[:-1]))
+    rows = list(itertools.chain(*hots))
+    hot = numpy.fromiter(itertools.imap(itemgetter(1), rows), float, len(rows))
+    date = numpy.fromiter(itertools.imap(itemgetter(2), rows), float,
+                          len(rows))
+
+    # drop the links that are too old, and then all but the first
+    # max_items of what's left in each subreddit
+    keep = date > age_limit
+    kept = numpy.cumsum(keep)
+    rank = kept - numpy.repeat(kept[starts] - keep[starts], counts)
+    keep &= rank <= max_items
+
+    # the hotness of the hottest remaining item in each subreddit
+    top_score = numpy.maximum.reduceat(numpy.where(keep, hot, -numpy.inf),
+                                       starts)
+    top_score = numpy.maximum(top_score, 1)
+    norm = hot / numpy.repeat(top_score, counts)
+
+    idx = numpy.flatnonzero(keep)
+    if limit is not None and len(idx) > limit:
+        # only the items at least as good as the limit'th best
+        # normalized score can make the cut
+        cutoff = numpy.partition(norm[idx], len(idx) - limit)[len(idx) - limit]
+        idx = idx[norm[idx] >= cutoff]
+
+    # sort by (normalized_hot, hot, date), descending. lexsort is
+    # stable, so ties keep their order like they do with list.sort
+    order = idx[numpy.lexsort((-date[idx], -hot[idx], -norm[idx]))]
+    return [rows[i][0] for i in order[:limit]]
+
+@memoize('normalize_hot', time = g.page_cache_time,
+         stale_time = g.page_cache_time)
+def normalized_hot_cached(sr_ids):
+    """Fetches the hot lists for each subreddit, normalizes the
+       scores, and interleaves the results."""
+    srs = Subreddit._byID(sr_ids, return_dict = False)
+    normalize = _normalize_hot_numpy if numpy else _normalize_hot
+    return normalize(_get_hot_lists(srs), _age_limit())
 
 def normalized_hot(sr_ids):
     sr_ids = list(sorted(sr_ids))
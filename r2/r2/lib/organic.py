@@ -20,13 +20,14 @@
 # CondeNet, Inc. All Rights Reserved.
 ################################################################################
 from r2.models import *
-from r2.lib.memoize import memoize
 from r2.lib.normalized_hot import get_hot
 from r2.lib import count
 from r2.lib.utils import UniqueIterator, timeago
 
-from pylons import c
+from pylons import g, c
 
+import heapq
+import itertools
 import random
 from time import time
 
@@ -37,12 +38,67 @@ organic_max_length= 50
 def keep_fresh_links(item):
     return (c.user_is_loggedin and c.user._id == item.author_id) or item.fresh
 
-@memoize('cached_organic_links', time = organic_lifetime)
+def _build_pools(link_counts, limit = organic_max_length):
+    """takes {fullname: (count, sr_id)} and returns {sr_id: [(count,
+    fullname), ...]} holding the `limit' least counted links of each
+    subreddit, in the order they should be shown"""
+    by_sr = {}
+    for name, (cnt, sr_id) in link_counts.iteritems():
+        by_sr.setdefault(sr_id, []).append((cnt, name))
+    return dict((sr_id, heapq.nsmallest(limit, pool))
+                for sr_id, pool in by_sr.iteritems())
+
+def _merge_pools(pools, limit = organic_max_length):
+    return [name for cnt, name
+            in itertools.islice(heapq.merge(*pools), limit)]
+
+# set_organic_pools is run every organic_lifetime by
+# scripts/organic.sh. Requests only read what it stores, which is kept
+# long enough for them to carry on with the last pools if it's late
+organic_pool_lifetime = 12 * organic_lifetime
+
+def _pool_key(sr_id):
+    return 'organic_pool_%d' % sr_id
+
+def _hot_key(sr_id):
+    return 'organic_hot_%d' % sr_id
+
+def set_organic_pools():
+    """Rebuilds the per-subreddit organic candidate lists from the
+    current link counts, along with the hottest links of each of
+    those subreddits to pick the up and coming link from"""
+    pools = _build_pools(count.get_link_counts())
+    srs = Subreddit._byID(pools.keys(), return_dict = False)
+    hots = dict((sr._id, fnames[:4])
+                for sr, fnames in zip(srs, get_hot(srs, True)))
+
+    old_ids = g.cache.get('organic_pool_sr_ids') or ()
+    stale = [key for i in old_ids if i not in pools
+             for key in (_pool_key(i), _hot_key(i))]
+    if stale:
+        g.cache.delete_multi(stale)
+
+    to_set = dict((_pool_key(i), p) for i, p in pools.iteritems())
+    to_set.update((_hot_key(i), h) for i, h in hots.iteritems())
+    g.cache.set_multi(to_set, time = organic_pool_lifetime)
+    g.cache.set('organic_pool_sr_ids', pools.keys(),
+                time = organic_pool_lifetime)
+    return pools
+
+def get_organic_pools(sr_ids):
+    """Returns the candidate pools of the subreddits and {sr_id:
+    hottest links} as set_organic_pools last stored them"""
+    found = g.cache.get_multi([_pool_key(i) for i in sr_ids] +
+                              [_hot_key(i) for i in sr_ids])
+    pools = [found[_pool_key(i)] for i in sr_ids if _pool_key(i) in found]
+    hots = dict((i, found[_hot_key(i)]) for i in sr_ids
+                if _hot_key(i) in found)
+    return pools, hots
+
 def cached_organic_links(*sr_ids):
-    sr_count = count.get_link_counts()
     #only use links from reddits that you're subscribed to
-    link_names = filter(lambda n: sr_count[n][1] in sr_ids, sr_count.keys())
-    link_names.sort(key = lambda n: sr_count[n][0])
+    pools, hots = get_organic_pools(sr_ids)
+    link_names = _merge_pools(pools)
 
     if not link_names and g.debug:
         q = All.get_links('new', 'all')
@@ -50,15 +106,17 @@ def cached_organic_links(*sr_ids):
         link_names = [x._fullname for x in q if x.promoted is None]
         g.log.debug('Used inorganic links')
 
-    #potentially add an up and coming link
-    if random.choice((True, False)) and sr_ids:
-        sr = Subreddit._byID(random.choice(sr_ids))
-        fnames = get_hot([sr], True)[0]
+    #potentially add an up and coming link. the list is no longer
+    #memoized, so seed the choice to keep it (and so the user's
+    #position in it) stable for organic_lifetime
+    rand = random.Random(hash((sr_ids, int(time() / organic_lifetime))))
+    if rand.choice((True, False)) and sr_ids:
+        fnames = hots.get(rand.choice(sr_ids))
         if fnames:
             if len(fnames) == 1:
                 new_item = fnames[0]
             else:
-                new_item = random.choice(fnames[1:4])
+                new_item = rand.choice(fnames[1:4])
             link_names.insert(0, new_item)
 
     return link_names
@@ -68,7 +68,7 @@ class RedditQueueMap(QueueMap):
         self._q('scraper_q')
         self._q('searchchanges_q', self_refer=True, durable=False)
         self._q('newcomments_q')
-        self._q('commentstree_q')
+        self._q('commentstree_q', self_refer=True)
         # this isn't in use until the spam_q plumbing is
         #self._q('newpage_q')
         self._q('register_vote_q', self_refer=True)
@@ -25,46 +25,94 @@ from r2.lib import utils
 from r2.lib import count
 
 from datetime import datetime
+from array import array
+import heapq
 
 cache = g.cache
 
+# how many links to keep in each subreddit's rising list. By default
+# they're all kept, as they are in the global list, so that paging
+# through a subreddit's rising listing doesn't run out early
+max_per_sr = getattr(g, 'rising_max_per_sr', None) or None
+
+def _sr_key(sr_id):
+    return 'rising_%d' % sr_id
+
+def _age_hours(cur_time, date):
+    age = cur_time - date
+    return (age.days * 86400 + age.seconds) / 3600 + 1
+
+def _top_by_sr(names, sr_ids, scores, limit = max_per_sr):
+    """returns {sr_id: [(fullname, score), ...]} holding the `limit'
+    (or, if that's None, all the) best scoring links of each
+    subreddit, best first"""
+    by_sr = {}
+    for i, sr_id in enumerate(sr_ids):
+        by_sr.setdefault(sr_id, []).append(i)
+
+    key = scores.__getitem__
+    if limit:
+        top = lambda idx: heapq.nlargest(limit, idx, key = key)
+    else:
+        top = lambda idx: sorted(idx, key = key, reverse = True)
+    return dict((sr_id, [(names[i], scores[i]) for i in top(idx)])
+                for sr_id, idx in by_sr.iteritems())
+
 def calc_rising():
-    sr_count = count.get_link_counts()
-    link_count = dict((k, v[0]) for k,v in sr_count.iteritems())
-    link_names = Link._by_fullname(sr_count.keys(), data=True)
+    """returns (rising, by_sr): the global list of (fullname, sr_id)
+    pairs ordered by score, and the per-subreddit top lists as
+    returned by _top_by_sr"""
+    # {fullname: (count, sr_id)}
+    link_counts = count.get_link_counts()
 
     #max is half the average of the top 10 counts
-    counts = link_count.values()
-    counts.sort(reverse=True)
+    counts = sorted((v[0] for v in link_counts.itervalues()), reverse=True)
     maxcount = sum(counts[:10]) / 20
-    
-    #prune the list
-    rising = [(n, link_names[n].sr_id)
-              for n in link_names.keys() if link_count[n] < maxcount]
 
-    cur_time = datetime.now(g.tz)
+    #prune the list before touching the db
+    names = [n for n, v in link_counts.iteritems() if v[0] < maxcount]
 
-    def score(pair):
-        name = pair[0]
-        link = link_names[name]
-        hours = (cur_time - link._date).seconds / 3600 + 1
-        return float(link._ups) / (max(link_count[name], 1) * hours)
+    # only _ups and _date are needed, both of which live on the thing
+    # itself, so skip loading the data props
+    links = Link._by_fullname(names, data = False)
+    names = [n for n in names if n in links]
 
-    def r(x):
-        return 1 if x > 0 else -1 if x < 0 else 0
+    cur_time = datetime.now(g.tz)
+    sr_ids = [link_counts[n][1] for n in names]
+    scores = array('d', (float(links[n]._ups) /
+                         (max(link_counts[n][0], 1) *
+                          _age_hours(cur_time, links[n]._date))
+                         for n in names))
+
+    order = sorted(xrange(len(names)), key = scores.__getitem__,
+                   reverse = True)
+    rising = [(names[i], sr_ids[i]) for i in order]
 
-    rising.sort(lambda x, y: r(score(y) - score(x)))
-    return rising
+    return rising, _top_by_sr(names, sr_ids, scores)
 
 def set_rising():
-    rising = calc_rising()
+    rising, by_sr = calc_rising()
+
+    # drop the lists of subreddits that have fallen out of rising
+    old_ids = cache.get('rising_sr_ids') or ()
+    stale = [_sr_key(i) for i in old_ids if i not in by_sr]
+    if stale:
+        cache.delete_multi(stale)
+
+    cache.set_multi(dict((_sr_key(i), l) for i, l in by_sr.iteritems()))
+    cache.set('rising_sr_ids', by_sr.keys())
     cache.set('rising', rising)
 
 def get_rising(sr):
     #get the sr_ids
     sr_ids = sr.rising_srs()
-    rising = cache.get('rising') or ()
-    if sr_ids:
-        return [p[0] for p in filter(lambda pair: pair[1] in sr_ids, rising)]
-    else:
-        return [p[0] for p in rising]
+    if not sr_ids:
+        return [p[0] for p in cache.get('rising') or ()]
+
+    lists = cache.get_multi([_sr_key(i) for i in sr_ids]).values()
+    if len(lists) == 1:
+        return [p[0] for p in lists[0]]
+
+    merged = heapq.merge(*[((-score, name) for name, score in l)
+                           for l in lists])
+    return [name for score, name in merged]
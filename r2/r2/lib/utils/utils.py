@@ -871,10 +871,25 @@ def fetch_things(t_class,since,until,batch_fn=None,
         q._after(t)
         things = list(q)
 
-def fetch_things2(query, chunk_size = 100, batch_fn = None, chunks = False):
+def fetch_things2(query, chunk_size = 100, batch_fn = None, chunks = False,
+                  stream = False):
     """Incrementally run query with a limit of chunk_size until there are
     no results left. batch_fn transforms the results for each chunk
-    before returning."""
+    before returning. With stream, the query is run once on a
+    server-side cursor and its things are built chunk_size at a time
+    straight from the db, bypassing the cache."""
+    if stream:
+        for items in query._stream(chunk_size):
+            if batch_fn:
+                items = batch_fn(items)
+
+            if chunks:
+                yield items
+            else:
+                for i in items:
+                    yield i
+        return
+
     orig_rules = deepcopy(query._rules)
     query._limit = chunk_size
     items = list(query)
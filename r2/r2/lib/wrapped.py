@@ -76,6 +76,121 @@ class StringTemplate(object):
         return self.update(d).template
 
 
+class StubResolver(object):
+    """
+    Substitutes the rendered content of cachable templates for their
+    CacheStubs in the primary template.
+
+    This gives the same output as running StringTemplate.update over
+    the content once per round of the render loop and then over the
+    whole page until it stops changing, but each piece of content is
+    split into literal text and variable names once and the page is
+    written out in a single pass.
+
+    found maps each stub name to a list of (round, content, kw), in
+    the order of the rounds of the render loop in which it was
+    rendered or fetched from the cache; kwargs are the arguments
+    passed to the primary render.
+    """
+    def __init__(self, found, kwargs):
+        self.kwargs = kwargs
+        self.found = dict((name, [(rnd, self.split(r), kw)
+                                  for rnd, r, kw in entries])
+                          for name, entries in found.iteritems())
+        self.expanding = set()
+
+    @staticmethod
+    def split(content):
+        """
+        Returns the text of a StringTemplate or string as a list
+        alternating between literal text and variable names
+        """
+        if isinstance(content, StringTemplate):
+            content = content.template
+        return StringTemplate.pattern2.split(content)
+
+    def _found_after(self, name, rnd):
+        for entry in self.found.get(name, ()):
+            if entry[0] > rnd:
+                return entry
+
+    def _write(self, parts, rnd, pre, kw, out, resolve):
+        """
+        Appends parts to out, which were added to the content of a
+        cached template in round rnd. Before anything else, variables
+        in pre are replaced (as when the content was finalize()d
+        with its own kw), then stubs of templates found in later
+        rounds. Otherwise, if resolve is set, variables in kw and then
+        the page wide kwargs and stubs are.
+        """
+        for i, part in enumerate(parts):
+            if not i % 2:
+                if part:
+                    out.append(part)
+            elif pre and part in pre:
+                self._write(self.split(pre[part]), rnd, None, kw, out,
+                            resolve)
+            else:
+                later = self._found_after(part, rnd)
+                if later:
+                    later_rnd, later_parts, later_kw = later
+                    self._write(later_parts, later_rnd, later_kw, kw, out,
+                                resolve)
+                elif resolve and kw and part in kw:
+                    self._resolve(self.split(kw[part]), out)
+                elif resolve:
+                    self._resolve_name(part, out)
+                else:
+                    out.append(StringTemplate.start_delim + part +
+                               StringTemplate.end_delim)
+
+    def _resolve(self, parts, out):
+        self._write(parts, float('inf'), None, None, out, True)
+
+    def _resolve_name(self, name, out):
+        # replacing a name with something that contains it would never
+        # have finished, so leave it be
+        if name in self.expanding:
+            out.append(StringTemplate.start_delim + name +
+                       StringTemplate.end_delim)
+            return
+
+        self.expanding.add(name)
+        if name in self.kwargs:
+            self._resolve(self.split(self.kwargs[name]), out)
+        elif name in self.found:
+            rnd, parts, kw = self.found[name][-1]
+            self._write(parts, rnd, None, kw, out, True)
+        else:
+            out.append(StringTemplate.start_delim + name +
+                       StringTemplate.end_delim)
+        self.expanding.discard(name)
+
+    def cached_content(self, name):
+        """
+        The latest content for the stub with the templates found in
+        later rounds filled in, which is what gets written to the
+        render cache.
+        """
+        rnd, parts, kw = self.found[name][-1]
+        out = []
+        self._write(parts, rnd, None, None, out, False)
+        return StringTemplate(u''.join(out))
+
+    def page(self, res):
+        """
+        The final page for the primary template's res: either its
+        rendered content or its own CacheStub.
+        """
+        out = []
+        if isinstance(res, CacheStub):
+            rnd, parts, kw = self.found[res.name][-1]
+            self._write(parts, rnd, None, None, out, True)
+        else:
+            self._resolve(self.split(res), out)
+        return u''.join(out)
+
+
 class CacheStub(object):
     """
     When using cached renderings, this class generates a stub based on
@@ -250,13 +365,16 @@ class Templated(object):
 
         # if this is the primary template, let the caching games begin
         if primary:
-            # updates will be the (self-updated) list of all of
-            # the cached templates that have been cached or
-            # rendered.
-            updates = {}
+            # found maps the stub names of all the cached templates
+            # that have been cached or rendered to their content, along
+            # with the round of the loop in which they were found
+            found = {}
+            # the cache key of each stub name
+            cache_keys = {}
             # to_cache is just the keys of the cached templates
             # that were not in the cache.
             to_cache = set([])
+            rnd = 0
             while c.render_tracker:
                 # copy and wipe the tracker.  It'll get repopulated if
                 # any of the subsequent render()s call cached objects.
@@ -268,11 +386,7 @@ class Templated(object):
                 # This dict cast will generate a new dict of cache_key
                 # to value
                 cached = self._read_cache(dict(current.values()))
-                # replacements will be a map of key -> rendered content
-                # for updateing the current set of updates
-                replacements = {}
 
-                new_updates = {}
                 # render items that didn't make it into the cached list
                 for key, (cache_key, others) in current.iteritems():
                     # unbundle the remaining args
@@ -284,54 +398,26 @@ class Templated(object):
                         r = item.render_nocache(attr, style)
                     else:
                         r = cached[cache_key]
-                    # store the unevaluated templates in
-                    # cached for caching
-                    replacements[key] = r.finalize(kw)
-                    new_updates[key] = (cache_key, (r, kw))
-                        
-                # update the updates so that when we can do the
-                # replacement in one pass.
-                
-                # NOTE: keep kw, but don't update based on them.
-                # We might have to cache these later, and we want
-                # to have things like $child present.
-                for k in updates.keys():
-                    cache_key, (value, kw) = updates[k]
-                    value = value.update(replacements)
-                    updates[k] = cache_key, (value, kw)
-
-                updates.update(new_updates)
-    
-            # at this point, we haven't touched res, but updates now
-            # has the list of all the updates we could conceivably
-            # want to make, and to_cache is the list of cache keys
-            # that we didn't find in the cache.
-
-            # cache content that was newly rendered
-            self._write_cache(dict((k, v)
-                                   for k, (v, kw) in updates.values()
-                                   if k in to_cache))
-    
-            # edge case: this may be the primary tempalte and cachable
-            if isinstance(res, CacheStub):
-                res = updates[res.name][1][0]
-                
-            # now we can update the updates to make use of their kw args.
-            updates = dict((k, v.finalize(kw))
-                           for k, (foo, (v, kw)) in updates.iteritems())
-
-            # update the response to use these values
-            # replace till we can't replace any more. 
-            npasses = 0
-            while True:
-                npasses += 1
-                r = res
-                res = res.update(kwargs).update(updates)
-                semi_final = res.finalize()
-                if r.finalize() == res.finalize():
-                    res = semi_final
-                    break
-                
+                    found.setdefault(key, []).append((rnd, r, kw))
+                    cache_keys[key] = cache_key
+                rnd += 1
+
+            # at this point, we haven't touched res, but found has the
+            # content of every stub we could conceivably need, and
+            # to_cache is the list of cache keys that we didn't find
+            # in the cache.
+            stubs = StubResolver(found, kwargs)
+
+            # cache content that was newly rendered (with its cached
+            # children filled in, but keeping $child and friends)
+            self._write_cache(dict((cache_key, stubs.cached_content(key))
+                                   for key, cache_key
+                                   in cache_keys.iteritems()
+                                   if cache_key in to_cache))
+
+            # fill in the stubs and the args passed in
+            res = stubs.page(res)
+
             # wipe out the render tracker object
             c.render_tracker = None
         elif not isinstance(res, CacheStub):
@@ -346,7 +432,7 @@ class Templated(object):
         if not keys:
             return
 
-        toset = dict((md5(key).hexdigest(), val)
+        toset = dict((hash_key(key), val)
                      for (key, val)
                      in keys.iteritems())
         g.rendercache.set_multi(toset)
@@ -354,7 +440,7 @@ class Templated(object):
     def _read_cache(self, keys):
         from pylons import g
 
-        ekeys = dict((md5(key).hexdigest(), key)
+        ekeys = dict((hash_key(key), key)
                      for key in keys)
         found = g.rendercache.get_multi(ekeys)
         return dict((ekeys[fkey], val)
@@ -400,6 +486,39 @@ def make_cachable(v, *a):
     else:
         raise Uncachable, "%s, %s" % (v, type(v))
 
+class RenderKey(str):
+    """
+    A render cache key that has already been hashed (as returned by
+    CachedTemplate.cache_key), so that _read_cache and _write_cache
+    don't md5 it a second time.
+    """
+    pass
+
+def hash_key(key):
+    if isinstance(key, RenderKey):
+        return key
+    return md5(key).hexdigest()
+
+class _Unfrozen(Exception): pass
+
+def _freeze(v):
+    """Returns a copy of v that compares equal to a later one only if v
+    hasn't changed in between, or raises _Unfrozen if there's no cheap
+    way of telling"""
+    if v.__class__ in _easy_cache_cls:
+        # the class too, as 1 == True but they render differently
+        return (v.__class__, v)
+    elif isinstance(v, (type, types.MethodType, CachedVariable)):
+        return v
+    elif isinstance(v, (tuple, list)):
+        return (v.__class__,) + tuple(_freeze(x) for x in v)
+    elif isinstance(v, set):
+        return (set, frozenset(_freeze(x) for x in v))
+    elif isinstance(v, dict):
+        return (dict, tuple(sorted((k, _freeze(x))
+                                   for k, x in v.iteritems())))
+    raise _Unfrozen
+
 class CachedTemplate(Templated):
     cachable = True
 
@@ -422,20 +541,43 @@ class CachedTemplate(Templated):
         # these values are needed to render any link on the site, and
         # a menu is just a set of links, so we best cache against
         # them.
-        keys = [c.user_is_loggedin, c.user_is_admin, c.domain_prefix,
+        keys = (c.user_is_loggedin, c.user_is_admin, c.domain_prefix,
                 style, c.cname, c.lang, c.site.path,
-                template_hash, g.markdown_backend]
-        keys = [make_cachable(x, *a) for x in keys]
+                template_hash, g.markdown_backend)
 
         # add all parameters sent into __init__, using their current value
-        auto_keys = [(k,  make_cachable(v, attr, style, *a))
-                     for k, v in self.cachable_attrs()]
-        
+        attrs = list(self.cachable_attrs())
+
+        # if none of the values (or the extra args) changed since the
+        # last call, neither did the key. Values that hold other
+        # templates or objects can't be compared cheaply, so those
+        # keys are never reused
+        try:
+            state = (keys, [(k, _freeze(v)) for k, v in attrs], attr,
+                     _freeze(a))
+        except _Unfrozen:
+            state = None
+        prev = self.__dict__.get('_cache_key')
+        if state is not None and prev is not None and prev[0] == state:
+            return prev[1]
+
+        fa = (attr, style) + a
+        parts = [self.__class__.__name__]
+        parts.extend(make_cachable(x, *a) for x in keys)
+        for k, v in attrs:
+            parts.append(k)
+            parts.append(make_cachable(v, *fa))
         # lastly, add anything else that was passed in.
-        keys.append(repr(auto_keys))
-        keys.extend(make_cachable(x) for x in a)
-        
-        return "<%s:[%s]>" % (self.__class__.__name__, u''.join(keys))
+        parts.extend(make_cachable(x) for x in a)
+
+        # make_cachable gives None for CachedVariables, which has to
+        # differ from u''
+        key = u'\0'.join(u'\1' if x is None else x for x in parts)
+        key = RenderKey(md5(key.encode('utf8')).hexdigest())
+
+        if state is not None:
+            self._cache_key = (state, key)
+        return key
 
 
 class Wrapped(CachedTemplate):
@@ -155,8 +155,10 @@ def apply_updates(user):
     pass
 
 def update_score(obj, up_change, down_change, new_valid_thing, old_valid_thing):
-     obj._incr('_ups',   up_change)
-     obj._incr('_downs', down_change)
+     if up_change:
+         obj._incr('_ups',   up_change)
+     if down_change:
+         obj._incr('_downs', down_change)
 
 def compute_votes(wrapper, item):
     wrapper.upvotes   = item._ups
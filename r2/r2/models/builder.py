@@ -32,12 +32,15 @@ import subreddit
 
 from r2.lib.wrapped import Wrapped
 from r2.lib import utils
-from r2.lib.db import operators
+from r2.lib.db import operators, sorts
 from r2.lib.cache import sgm
 from r2.lib.comment_tree import *
 from copy import deepcopy, copy
 
 import time
+import heapq
+import itertools
+from collections import deque
 from datetime import datetime,timedelta
 from admintools import compute_votes, admintools, ip_span
 
@@ -391,13 +394,23 @@ class QueryBuilder(Builder):
 
 class IDBuilder(QueryBuilder):
     def init_query(self):
-        names = list(tup(self.query))
-
         after = self.after._fullname if self.after else None
 
-        self.names = self._get_after(names,
-                                     after,
-                                     self.reverse)
+        if self.reverse:
+            self.names = self._get_after(tup(self.query), after, True)
+        else:
+            # cached listings (and merges of them) can be read lazily,
+            # so only pull out as many names as we end up needing
+            self.names = self._iter_after(tup(self.query), after)
+
+    @staticmethod
+    def _iter_after(l, after):
+        names = iter(l)
+        if after:
+            for name in names:
+                if name == after:
+                    break
+        return names
 
     @staticmethod
     def _get_after(l, after, reverse):
@@ -428,10 +441,13 @@ class IDBuilder(QueryBuilder):
                     last_item = None
                 slice_size = max(int(num_need * EXTRA_FACTOR), 1)
         else:
-            slice_size = len(names)
+            slice_size = None
             done = True
 
-        self.names, new_names = names[slice_size:], names[:slice_size]
+        if isinstance(names, (list, tuple)):
+            self.names, new_names = names[slice_size:], names[:slice_size]
+        else:
+            new_names = list(itertools.islice(names, slice_size))
         new_items = Thing._by_fullname(new_names, data = True, return_dict=False)
         return done, new_items
 
@@ -472,10 +488,101 @@ def empty_listing(*things):
     l.things = list(things)
     return Wrapped(l)
 
+class _Reversed(object):
+    """Wraps a sort key to invert its ordering in a heap"""
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+    def __ne__(self, other):
+        return self.key != other.key
+
+class CandidateQueue(object):
+    """The comments that a CommentBuilder could show next. Items come
+    out in the same order as from a stable sort on `key' of everything
+    added so far, i.e. equal keys come out in the order they were
+    added in, but each pop and extend is O(log n)"""
+    def __init__(self, items, key, reverse = False):
+        self.key = key
+        self.reverse = reverse
+        self.count = 0
+        self.heap = [self._entry(item) for item in items]
+        heapq.heapify(self.heap)
+
+    def _entry(self, item):
+        key = self.key(item)
+        if self.reverse:
+            key = _Reversed(key)
+        self.count += 1
+        return (key, self.count, item)
+
+    def extend(self, items):
+        for item in items:
+            heapq.heappush(self.heap, self._entry(item))
+
+    def pop(self):
+        return heapq.heappop(self.heap)[2]
+
+    def __len__(self):
+        return len(self.heap)
+
+    def leftovers(self):
+        """Returns whatever hasn't been popped as a deque, in order"""
+        self.heap.sort()
+        return deque(entry[2] for entry in self.heap)
+
+class CommentStub(object):
+    """A stand-in for a Comment built from the sort data kept in the
+    comment tree, with just enough of a Comment's interface for the
+    CommentBuilder to pick the comments to show, and for the "load
+    more comments" links to refer to the ones it doesn't"""
+    __slots__ = ('_id', 'parent_id', '_ups', '_downs', '_date', '_deleted')
+
+    def __init__(self, _id, parent_id, ups, downs, date, deleted):
+        self._id = _id
+        self.parent_id = parent_id
+        self._ups = ups
+        self._downs = downs
+        # seconds since the epoch, which sorts the same as Comment._date
+        self._date = date
+        self._deleted = deleted
+
+    @property
+    def _hot(self):
+        return sorts._hot(self._ups, self._downs, self._date)
+
+    @property
+    def _score(self):
+        return sorts.score(self._ups, self._downs)
+
+    @property
+    def _controversy(self):
+        return sorts.controversy(self._ups, self._downs)
+
+    @property
+    def _confidence(self):
+        return sorts.confidence(self._ups, self._downs)
+
+    @property
+    def _id36(self):
+        return utils.to36(self._id)
+
+    @property
+    def _fullname(self):
+        return (Comment._type_prefix + utils.to36(Comment._type_id) + '_'
+                + self._id36)
+
 class CommentBuilder(Builder):
     def __init__(self, link, sort, comment = None, context = None,
                  load_more=True, continue_this_thread=True,
-                 max_depth = MAX_RECURSION, **kw):
+                 max_depth = MAX_RECURSION, lazy = None, **kw):
         Builder.__init__(self, **kw)
         self.link = link
         self.comment = comment
@@ -483,6 +590,10 @@ class CommentBuilder(Builder):
         self.load_more = load_more
         self.max_depth = max_depth
         self.continue_this_thread = continue_this_thread
+        # in lazy mode only the comments that are shown get loaded
+        if lazy is None:
+            lazy = getattr(g, 'lazy_comments', False)
+        self.lazy = lazy
 
         if sort.col == '_date':
             self.sort_key = lambda x: x._date
@@ -512,9 +623,23 @@ class CommentBuilder(Builder):
             if not self.comment._id in depth:
                 g.log.error("Update didn't help. This is gonna end in tears.")
 
-        if cids:
+        sort_data = None
+        if self.lazy and cids:
+            sort_data = link_comment_sort_data(self.link._id)
+        lazy = (sort_data is not None
+                and all(cid in sort_data for cid in cids)
+                and all(cm._id in sort_data
+                        for cm in tup(self.comment or ())))
+
+        if lazy:
+            comments = set(CommentStub(cid, *sort_data[cid]) for cid in cids)
+        elif cids:
             comments = set(Comment._byID(cids, data = True, 
                                          return_dict = False))
+            if self.lazy and sort_data is None:
+                # the tree predates the sort data; have commentstree_q
+                # fill it in so that later page views can be lazy
+                queue_sort_data_backfill(self.link)
         else:
             comments = ()
 
@@ -535,7 +660,10 @@ class CommentBuilder(Builder):
 
         if isinstance(self.comment, utils.iters):
             candidates = []
-            candidates.extend(self.comment)
+            if lazy:
+                candidates.extend(comment_dict[cm._id] for cm in self.comment)
+            else:
+                candidates.extend(self.comment)
             dont_collapse.extend(cm._id for cm in self.comment)
             #assume the comments all have the same parent
             # TODO: removed by Chris to get rid of parent being sent
@@ -549,7 +677,7 @@ class CommentBuilder(Builder):
                 start_depth = depth[candidates[0].parent_id]
         #if permalink
         elif self.comment:
-            top = self.comment
+            top = comment_dict[self.comment._id] if lazy else self.comment
             dont_collapse.append(top._id)
             #add parents for context
             while self.context > 0 and top.parent_id:
@@ -571,14 +699,11 @@ class CommentBuilder(Builder):
             for k, v in depth.iteritems():
                 depth[k] = v - delta
 
-        def sort_candidates():
-            candidates.sort(key = self.sort_key, reverse = self.rev_sort)
-
         #find the comments
         num_have = 0
-        sort_candidates()
+        candidates = CandidateQueue(candidates, self.sort_key, self.rev_sort)
         while num_have < num and candidates:
-            to_add = candidates.pop(0)
+            to_add = candidates.pop()
             comments.remove(to_add)
             if to_add._deleted and not comment_tree.has_key(to_add._id):
                 pass
@@ -586,16 +711,29 @@ class CommentBuilder(Builder):
                 #add children
                 if comment_tree.has_key(to_add._id):
                     candidates.extend(comment_tree[to_add._id])
-                    sort_candidates()
                 items.append(to_add)
                 num_have += 1
             elif self.continue_this_thread:
                 #add the recursion limit
-                p_id = to_add.parent_id
-                w = Wrapped(MoreRecursion(self.link, 0,
-                                          comment_dict[p_id]))
-                w.children.append(to_add)
-                extra[p_id] = w
+                extra[to_add.parent_id] = to_add
+
+        if lazy:
+            #only now load the comments that are going to be shown,
+            #and the parents of the recursion limits
+            need = set(cm._id for cm in items)
+            need.update(extra.keys())
+            if need:
+                loaded = Comment._byID(need, data = True, return_dict = True)
+            else:
+                loaded = {}
+            items = [loaded[cm._id] for cm in items]
+        else:
+            loaded = comment_dict
+
+        for p_id, to_add in extra.items():
+            w = Wrapped(MoreRecursion(self.link, 0, loaded[p_id]))
+            w.children.append(to_add)
+            extra[p_id] = w
 
         wrapped = self.wrap_items(items)
 
@@ -636,8 +774,9 @@ class CommentBuilder(Builder):
 
         #put the remaining comments into the tree (the show more comments link)
         more_comments = {}
+        candidates = candidates.leftovers()
         while candidates:
-            to_add = candidates.pop(0)
+            to_add = candidates.popleft()
             direct_child = True
             #ignore top-level comments for now
             if not to_add.parent_id:
@@ -654,7 +793,7 @@ class CommentBuilder(Builder):
             mc2 = more_comments.get(p_id)
             if not mc2:
                 mc2 = MoreChildren(self.link, depth[to_add._id],
-                                   parent = comment_dict.get(p_id))
+                                   parent = loaded.get(p_id))
                 more_comments[p_id] = mc2
                 w_mc2 = Wrapped(mc2)
                 if p_id is None:
@@ -44,6 +44,78 @@ def score_changes(amount, old_amount):
     elif oa < 0 and a > 0: dc = oa; uc = a
     return uc, dc
 
+class VoteBatch(object):
+    """The score, karma and count changes from a batch of votes,
+       summed up per thing, author and subreddit so that each can be
+       written once (see Vote.vote_batch)"""
+    def __init__(self):
+        self.votes = []
+        # (obj fullname, new_valid_thing, old_valid_thing) -> [obj, ups, downs]
+        self.scores = {}
+        # (author_id, kind, sr_id) -> [sr, amount]
+        self.karma = {}
+        # sr_id -> [sr, number of new valid votes]
+        self.counts = {}
+        self.changes = {}
+
+    def add(self, sub, obj, v, kind, sr, is_new, amount,
+            up_change, down_change, old_valid_thing):
+        self.votes.append((sub, obj, v))
+        changes = []
+
+        if not (is_new and obj.author_id == sub._id and amount == 1):
+            # we don't do this if it's the author's initial automatic
+            # vote, because we checked it in with _ups == 1
+            key = (obj._fullname, v.valid_thing, old_valid_thing)
+            score = self.scores.setdefault(key, [obj, 0, 0])
+            score[1] += up_change
+            score[2] += down_change
+            changes.append((self.scores, key, (0, up_change, down_change)))
+
+        if v.valid_user:
+            key = (obj.author_id, kind, sr._id)
+            karma = self.karma.setdefault(key, [sr, 0])
+            karma[1] += up_change - down_change
+            changes.append((self.karma, key, (0, up_change - down_change)))
+
+        #update the sr's valid vote count
+        if (is_new and v.valid_thing and kind == 'link'
+            and sub._id != obj.author_id):
+            count = self.counts.setdefault(sr._id, [sr, 0])
+            count[1] += 1
+            changes.append((self.counts, sr._id, (0, 1)))
+
+        self.changes[id(v)] = changes
+
+    def discard(self, v):
+        """Takes back the changes from a vote that couldn't be saved"""
+        self.votes = [x for x in self.votes if x[2] is not v]
+        for d, key, deltas in self.changes.pop(id(v), ()):
+            for i, delta in enumerate(deltas):
+                if delta:
+                    d[key][i] -= delta
+
+    def write(self):
+        from admintools import update_score
+        from r2.lib.count import incr_counts
+
+        for (fullname, new_valid, old_valid), (obj, ups, downs) \
+                in self.scores.iteritems():
+            if ups or downs:
+                update_score(obj, ups, downs, new_valid, old_valid)
+
+        authors = Account._byID(set(a for a, k, s in self.karma),
+                                data = True)
+        for (author_id, kind, sr_id), (sr, amount) in self.karma.iteritems():
+            if amount:
+                authors[author_id].incr_karma(kind, sr, amount)
+
+        srs = []
+        for sr, num in self.counts.itervalues():
+            srs.extend([sr] * num)
+        if srs:
+            incr_counts(srs)
+
 class Vote(MultiRelation('vote',
                          Relation(Account, Link),
                          Relation(Account, Comment))):
@@ -123,6 +195,114 @@ class Vote(MultiRelation('vote',
 
         return v
 
+    @classmethod
+    def vote_batch(cls, votes):
+        """Like calling vote() on each of `votes', a list of (sub, obj,
+           dir, ip, organic, cheater), but with the writes batched up:
+           the old votes are looked up once per voter, the new vote
+           relations are inserted together, and each thing's score and
+           each author's karma are incremented once. If someone votes
+           on the same thing more than once in the batch, only their
+           last vote counts. Returns a list of (sub, obj, vote) for the
+           votes that were applied."""
+        from admintools import valid_user, valid_thing
+        from r2.lib.db import queries
+        from r2.lib.db.thing import CreationError
+        from sqlalchemy.exc import IntegrityError
+
+        # the last vote by each user on each thing
+        latest = {}
+        for i, (sub, obj, dir, ip, organic, cheater) in enumerate(votes):
+            latest[(sub._id, obj._fullname)] = i
+        votes = [votes[i] for i in sorted(latest.itervalues())]
+
+        by_sub = {}
+        for sub, obj, dir, ip, organic, cheater in votes:
+            by_sub.setdefault(sub._id, (sub, []))[1].append(obj)
+        oldvotes = {}
+        for sub, objs in by_sub.itervalues():
+            oldvotes.update(cls._fast_query(sub, objs, ['-1', '0', '1']))
+
+        batch = VoteBatch()
+        new_rels = {}
+        for sub, obj, dir, ip, organic, cheater in votes:
+            sr = obj.subreddit_slow
+            kind = obj.__class__.__name__.lower()
+            karma = sub.karma(kind, sr)
+
+            is_self_link = (kind == 'link'
+                            and hasattr(obj,'is_self')
+                            and obj.is_self)
+
+            amount = 1 if dir is True else 0 if dir is None else -1
+
+            oldvote = filter(None, (oldvotes.get((sub, obj, name))
+                                    for name in ('-1', '0', '1')))
+
+            is_new = False
+            if oldvote:
+                v = oldvote[0]
+                oldamount = int(v._name)
+                v._name = str(amount)
+
+                old_valid_thing = v.valid_thing
+                v.valid_thing = (valid_thing(v, karma, cheater = cheater)
+                                 and v.valid_thing)
+                v.valid_user = (v.valid_user
+                                and v.valid_thing
+                                and valid_user(v, sr, karma))
+            else:
+                is_new = True
+                oldamount = 0
+                v = cls(sub, obj, str(amount))
+                v.author_id = obj.author_id
+                v.sr_id = sr._id
+                v.ip = ip
+                old_valid_thing = v.valid_thing = \
+                                  valid_thing(v, karma, cheater = cheater)
+                v.valid_user = (v.valid_thing and valid_user(v, sr, karma)
+                                and not is_self_link)
+                if organic:
+                    v.organic = organic
+                new_rels.setdefault(v.__class__, []).append(v)
+
+            up_change, down_change = score_changes(amount, oldamount)
+            batch.add(sub, obj, v, kind, sr, is_new, amount,
+                      up_change, down_change, old_valid_thing)
+
+        # insert the new votes together. if any of them turn out to
+        # be duplicates, they're inserted one by one as they're
+        # committed below, and the duplicates dropped
+        for rel_cls, rels in new_rels.iteritems():
+            try:
+                rel_cls._create_multi(rels)
+            except CreationError:
+                pass
+
+        applied = []
+        for sub, obj, v in batch.votes:
+            try:
+                v._commit()
+            except (CreationError, IntegrityError):
+                g.log.error("duplicate vote for: %s" % str((sub, obj,
+                                                              v._name)))
+                batch.discard(v)
+                continue
+            applied.append((sub, obj, v))
+
+        g.cache.delete_multi([queries.prequeued_vote_key(sub, obj)
+                              for sub, obj, v in applied])
+        # the timestamps are kept per concrete relation (e.g. votes on
+        # links and on comments), so touch each one the voter used
+        touched = set()
+        for sub, obj, v in applied:
+            if (sub._id, v.__class__) not in touched:
+                touched.add((sub._id, v.__class__))
+                v._fast_query_timestamp_touch(sub)
+
+        batch.write()
+        return applied
+
     #TODO make this generic and put on multirelation?
     @classmethod
     def likes(cls, sub, obj):
@@ -0,0 +1,331 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is Reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+#
+# All portions of the code written by CondeNet are Copyright (c) 2006-2010
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+import os
+import pickle
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from unittest import TestCase
+
+from r2.lib import amqp
+
+def dead_pid():
+    p = subprocess.Popen([sys.executable, '-c', ''])
+    p.wait()
+    return p.pid
+
+class FakeMessage(object):
+    def __init__(self, body, delivery_tag):
+        self.body = body
+        self.delivery_tag = delivery_tag
+        self.delivery_info = dict(delivery_tag = delivery_tag)
+
+class FakeTransport(object):
+    def __init__(self):
+        # a socket that nothing is ever written to, for select()
+        self.sock, self._other = socket.socketpair()
+        self._read_buffer = ''
+
+class FakeConnection(object):
+    def __init__(self):
+        self.transport = FakeTransport()
+
+class FakeChannel(object):
+    """An in-memory stand-in for an amqplib channel to a broker with a
+    single queue. Deliveries are pushed to the consumer (up to the
+    prefetch count) and handed to its callback by wait()"""
+    def __init__(self, bodies):
+        self.connection = FakeConnection()
+        self.queue = deque(bodies)
+        self.method_queue = []
+        self.next_tag = 1
+        self.unacked = {}
+        self.acked = []
+        self.rejected = []
+        self.prefetch = None
+        self.consumer = None
+
+    def queue_declare(self, queue, passive = False):
+        return queue, len(self.queue), 0
+
+    def basic_qos(self, prefetch_size, prefetch_count, a_global):
+        self.prefetch = prefetch_count
+
+    def basic_consume(self, queue, callback = None):
+        self.consumer = callback
+        self._push()
+        return 'ctag'
+
+    def basic_cancel(self, consumer_tag):
+        self.consumer = None
+
+    def _push(self):
+        while (self.consumer and self.queue and
+               len(self.unacked) + len(self.method_queue) < self.prefetch):
+            msg = FakeMessage(self.queue.popleft(), self.next_tag)
+            self.next_tag += 1
+            self.method_queue.append(msg)
+
+    def wait(self):
+        msg = self.method_queue.pop(0)
+        self.unacked[msg.delivery_tag] = msg
+        self.consumer(msg)
+
+    def basic_ack(self, delivery_tag, multiple = False):
+        tags = [t for t in self.unacked
+                if t == delivery_tag or (multiple and t < delivery_tag)]
+        for t in sorted(tags):
+            self.acked.append(self.unacked.pop(t).body)
+        self._push()
+
+    def basic_recover(self, requeue = False):
+        # everything that's not been acked is sent again
+        msgs = self.unacked.values() + self.method_queue
+        self.unacked = {}
+        self.method_queue = []
+        for msg in sorted(msgs, key = lambda m: m.delivery_tag):
+            self.queue.append(msg.body)
+        self._push()
+
+    def basic_reject(self, delivery_tag, requeue):
+        msg = self.unacked.pop(delivery_tag)
+        self.rejected.append(msg.body)
+        if requeue:
+            self.queue.append(msg.body)
+
+class TestConsumeItems(TestCase):
+    def consume(self, chan, callback, **kw):
+        get_channel = amqp.get_channel
+        amqp.get_channel = lambda: chan
+        try:
+            amqp.consume_items('q', callback, drain = True, verbose = False,
+                               sleep_time = 0.01, max_wait = 0.01, **kw)
+        finally:
+            amqp.get_channel = get_channel
+
+    def test_batches(self):
+        chan = FakeChannel(range(25))
+        batches = []
+        def callback(msgs, c):
+            self.assertTrue(c is chan)
+            batches.append([m.body for m in msgs])
+        self.consume(chan, callback, limit = 10)
+
+        self.assertEqual(batches, [range(10), range(10, 20), range(20, 25)])
+        self.assertEqual(chan.acked, range(25))
+        self.assertEqual(chan.prefetch, 10)
+        self.assertEqual(chan.unacked, {})
+
+    def test_drain_stops_at_initial_count(self):
+        chan = FakeChannel(range(5))
+        seen = []
+        def callback(msgs, c):
+            seen.extend(m.body for m in msgs)
+            # new work arriving while we're draining
+            chan.queue.append('late')
+        self.consume(chan, callback, limit = 2, prefetch = 4)
+
+        self.assertEqual(seen, range(5))
+        # anything sent ahead but not handled goes back on the queue
+        self.assertEqual(list(chan.queue), ['late'] * 3)
+        self.assertEqual(chan.unacked, {})
+        self.assertEqual(chan.method_queue, [])
+
+    def test_reject_on_exception(self):
+        chan = FakeChannel(range(6))
+        def callback(msgs, c):
+            if msgs[0].body == 3:
+                raise ValueError
+        self.assertRaises(ValueError, self.consume, chan, callback,
+                          limit = 3, prefetch = 6)
+
+        self.assertEqual(chan.acked, [0, 1, 2])
+        self.assertEqual(sorted(chan.rejected), [3, 4, 5])
+        self.assertEqual(sorted(chan.queue), [3, 4, 5])
+        self.assertEqual(chan.consumer, None)
+
+    def test_empty_queue(self):
+        chan = FakeChannel([])
+        def callback(msgs, c):
+            self.fail()
+        self.consume(chan, callback, limit = 5)
+        self.assertEqual(chan.consumer, None)
+
+class TestWorker(TestCase):
+    def setUp(self):
+        self.events = []
+        self._add_item = amqp._add_item
+        amqp._add_item = (lambda routing_key, body, message_id = None:
+                              self.events.append(body))
+        # holds up the worker until it's set
+        self.go = threading.Event()
+        self.spill_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.go.set()
+        amqp._add_item = self._add_item
+        shutil.rmtree(self.spill_dir)
+
+    def stall(self, worker):
+        worker.do(self.go.wait)
+        # wait for it to be taken off the queue
+        while worker.q.qsize():
+            time.sleep(.001)
+
+    def test_queue_order(self):
+        w = amqp.Worker()
+        self.stall(w)
+        w.do(self.events.append, 'a')
+        w.publish('q', 'x')
+        w.publish('r', 'y')
+        w.do(self.events.append, 'b')
+        w.publish('q', 'z')
+        self.go.set()
+        w.join()
+        self.assertEqual(self.events, ['a', 'x', 'y', 'b', 'z'])
+
+    def test_consecutive_publishes_batched(self):
+        w = amqp.Worker()
+        publishes = []
+        publish = w._publish
+        def record(msgs):
+            publishes.append([body for key, body, id in msgs])
+            publish(msgs)
+        w._publish = record
+        self.stall(w)
+        for body in 'abc':
+            w.publish('q', body)
+        w.do(self.events.append, 'fn')
+        w.publish('q', 'd')
+        self.go.set()
+        w.join()
+        self.assertEqual(publishes, [['a', 'b', 'c'], ['d']])
+        self.assertEqual(w.stats()['done'], 6)
+
+    def test_publish_waits_for_earlier_batches(self):
+        w = amqp.Worker(num_threads = 4, batch_size = 1)
+        def slow():
+            time.sleep(.05)
+            self.events.append('slow')
+        w.do(slow)
+        w.publish('q', 'msg')
+        w.join()
+        self.assertEqual(self.events, ['slow', 'msg'])
+
+    def test_publish_from_worker_never_blocks(self):
+        w = amqp.Worker(max_size = 1)
+        def job():
+            for body in 'abc':
+                w.publish('q', body)
+        w.do(job)
+        self.assertTrue(w.drain(2))
+        self.assertEqual(sorted(self.events), ['a', 'b', 'c'])
+        self.assertTrue(w.stats()['inline'] >= 1)
+
+    def test_drop(self):
+        w = amqp.Worker(max_size = 1, when_full = 'drop')
+        self.stall(w)
+        for body in 'abc':
+            w.publish('q', body)
+        self.go.set()
+        w.join()
+        self.assertEqual(self.events, ['a'])
+        self.assertEqual(w.stats()['dropped'], 2)
+
+    def test_spill_and_drain(self):
+        w = amqp.Worker(max_size = 1, when_full = 'spill',
+                        spill_dir = self.spill_dir)
+        self.stall(w)
+        for body in 'abc':
+            w.publish('q', body)
+        self.assertEqual(w.stats()['spilled'], 2)
+        # the worker's still stuck, so what's queued is spilled too
+        self.assertFalse(w.drain(.05))
+        self.assertEqual(w.stats()['spilled'], 3)
+        self.assertEqual(self.events, [])
+
+        # as though it were left by a process that has since exited
+        os.rename(w._spill_file(), self.spill_path(dead_pid()))
+
+        # the next worker to start publishes them
+        w2 = self.unspill()
+        self.assertEqual(sorted(self.events), ['a', 'b', 'c'])
+        self.assertEqual(w2.stats()['unspilled'], 3)
+        self.assertEqual(os.listdir(self.spill_dir), [])
+
+    def spill_path(self, writer, claimer = None):
+        fname = 'amqp-%d.spill' % writer
+        if claimer is not None:
+            fname += '.%d' % claimer
+        return os.path.join(self.spill_dir, fname)
+
+    def write_spill(self, path, *records):
+        with open(path, 'wb') as f:
+            for r in records:
+                if isinstance(r, tuple):
+                    r = pickle.dumps(r, pickle.HIGHEST_PROTOCOL)
+                f.write(r)
+
+    def unspill(self):
+        w = amqp.Worker(spill_dir = self.spill_dir)
+        w.unspill_thread.join()
+        w.join()
+        return w
+
+    def test_unspill_live(self):
+        # still being written to, by us and by another running process
+        mine = self.spill_path(os.getpid())
+        running = self.spill_path(os.getppid())
+        claimed = self.spill_path(dead_pid(), os.getppid())
+        for path in (mine, running, claimed):
+            self.write_spill(path, ('q', 'x', None))
+        self.unspill()
+        self.assertEqual(self.events, [])
+        self.assertEqual(sorted(os.listdir(self.spill_dir)),
+                         sorted(os.path.basename(p)
+                                for p in (mine, running, claimed)))
+
+    def test_unspill_orphaned(self):
+        # a process died part way through publishing another's spill
+        self.write_spill(self.spill_path(dead_pid(), dead_pid()),
+                         ('q', 'a', None), ('q', 'b', None))
+        self.unspill()
+        self.assertEqual(self.events, ['a', 'b'])
+        self.assertEqual(os.listdir(self.spill_dir), [])
+
+    def test_unspill_corrupt(self):
+        good = pickle.dumps(('q', 'c', None), pickle.HIGHEST_PROTOCOL)
+        self.write_spill(self.spill_path(dead_pid()),
+                         ('q', 'a', None),
+                         # garbage, something that isn't a publish,
+                         # and a publish cut short by a crash
+                         '\x80\x02garbage', ('q', 'b'), ('q', 'c', None),
+                         good[:len(good) / 2])
+        w = self.unspill()
+        self.assertEqual(self.events, ['a', 'c'])
+        self.assertEqual(w.stats()['corrupt'], 3)
+        self.assertEqual(os.listdir(self.spill_dir), [])
@@ -0,0 +1,109 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is Reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+#
+# All portions of the code written by CondeNet are Copyright (c) 2006-2010
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+from unittest import TestCase
+
+from r2.lib import cache
+from r2.lib.cache import LRUCache, CacheChain, LocalCache
+
+class TestLRUCache(TestCase):
+    def setUp(self):
+        self.now = 1e9
+        self.saved = cache._time, cache.lru_stats.copy()
+        cache._time = lambda: self.now
+        for k in cache.lru_stats:
+            cache.lru_stats[k] = 0
+
+    def tearDown(self):
+        cache._time, stats = self.saved
+        cache.lru_stats.update(stats)
+
+    def test_max_size(self):
+        c = LRUCache(max_size = 3)
+        for k in 'abc':
+            c.set(k, k)
+        # a is now the most recently used
+        self.assertEqual(c.get('a'), 'a')
+        c.set('d', 'd')
+        self.assertEqual(c.get('b'), None)
+        self.assertEqual(sorted(c.simple_get_multi('abcd')), ['a', 'c', 'd'])
+        self.assertEqual(cache.lru_stats['evictions'], 1)
+
+    def test_max_bytes(self):
+        size = LRUCache._size('x' * 100)
+        c = LRUCache(max_bytes = size * 2)
+        c.set('a', 'x' * 100)
+        c.set('b', 'y' * 100)
+        self.assertEqual(c.bytes, size * 2)
+        c.set('c', 'z' * 100)
+        self.assertEqual(c.get('a'), None)
+        self.assertEqual(c.get('b'), 'y' * 100)
+        self.assertEqual(c.bytes, size * 2)
+
+        # too big to keep anything else, but it's kept itself
+        c.set('d', 'w' * 1000)
+        self.assertEqual(c.simple_get_multi('bcd').keys(), ['d'])
+        self.assertEqual(cache.lru_stats['evictions'], 3)
+
+        c.delete('d')
+        self.assertEqual(c.bytes, 0)
+
+    def test_time(self):
+        c = LRUCache()
+        c.set('a', 1, time = 10)
+        c.set('b', 2)
+        c.set('c', 3, time = self.now + 20)
+        self.now += 10
+        self.assertEqual(c.get('a'), None)
+        self.assertEqual(c.get('b'), 2)
+        self.assertEqual(c.get('c'), 3)
+        self.assertTrue(c.add('a', 4))
+
+        # updates keep the time they were set with
+        c.incr('c')
+        self.now += 10
+        self.assertEqual(c.get('c'), None)
+        self.assertEqual(c.get('a'), 4)
+        self.assertEqual(cache.lru_stats['expired'], 2)
+
+    def test_stats(self):
+        c = LRUCache()
+        c.set('a', 1)
+        c.get('a')
+        c.get('b')
+        # the stats outlive the cache
+        c = c.fresh()
+        c.get('a')
+        self.assertEqual(cache.lru_stats,
+                         dict(hits = 1, misses = 2, evictions = 0,
+                              expired = 0))
+
+    def test_chain(self):
+        local, behind = LRUCache(), LocalCache()
+        chain = CacheChain((local, behind))
+        behind.set('a', 1)
+        self.assertEqual(chain.get('a'), 1)
+        # copied forward without a time
+        self.assertEqual(local['a'][LRUCache.EXPIRES], None)
+
+        chain.set('b', 2, time = 10)
+        self.now += 10
+        self.assertEqual(local.get('b'), None)
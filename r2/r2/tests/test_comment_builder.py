@@ -0,0 +1,199 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is Reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+#
+# All portions of the code written by CondeNet are Copyright (c) 2006-2010
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+import random
+from collections import deque
+from copy import deepcopy
+from unittest import TestCase
+
+from r2.lib.db import operators
+from r2.models import builder
+from r2.models.builder import CandidateQueue, CommentBuilder
+
+class FakeComment(object):
+    def __init__(self, _id, parent_id, score, date, deleted = False):
+        self._id = _id
+        self._fullname = 't1_%d' % _id
+        self.parent_id = parent_id
+        self._score = score
+        self._date = date
+        self._deleted = deleted
+
+class FakeWrapped(object):
+    def __init__(self, cm):
+        self._id = cm._id
+        self._fullname = cm._fullname
+        self.parent_id = cm.parent_id
+        self.deleted = cm._deleted
+        self.collapsed = False
+
+class FakeMore(object):
+    def __init__(self, link, depth, parent = None):
+        self.parent_id = parent._id if parent else None
+        self.children = []
+        self.count = 0
+
+class FakeMoreChildren(FakeMore): pass
+class FakeMoreRecursion(FakeMore): pass
+
+class FakeListing(object):
+    def __init__(self, *things):
+        self.things = list(things)
+
+class OldQueue(object):
+    """How CommentBuilder.get_items kept its candidates before
+    CandidateQueue: a list, sorted again after every extend"""
+    def __init__(self, items, key, reverse = False):
+        self.key = key
+        self.reverse = reverse
+        self.items = list(items)
+        self.items.sort(key = key, reverse = reverse)
+
+    def extend(self, items):
+        self.items.extend(items)
+        self.items.sort(key = self.key, reverse = self.reverse)
+
+    def pop(self):
+        return self.items.pop(0)
+
+    def __len__(self):
+        return len(self.items)
+
+    def leftovers(self):
+        return deque(self.items)
+
+class FakeLink(object):
+    _id = 1
+
+class TestBuilder(CommentBuilder):
+    def wrap_items(self, items):
+        return [FakeWrapped(cm) for cm in items]
+
+def random_thread(size, rand):
+    comments = []
+    for i in xrange(1, size + 1):
+        if not comments or rand.random() < .2:
+            p_id = None
+        else:
+            p_id = rand.choice(comments)._id
+        # small ranges so that there are lots of ties
+        comments.append(FakeComment(i, p_id, rand.randint(-2, 3),
+                                    rand.randint(0, 20),
+                                    rand.random() < .05))
+    return comments
+
+def comment_tree(comments):
+    """What link_comments gives for these comments"""
+    cids = [cm._id for cm in comments]
+    cid_tree = {}
+    depth = {}
+    num_children = dict((cid, 0) for cid in cids)
+    by_id = dict((cm._id, cm) for cm in comments)
+    for cm in comments:
+        cid_tree.setdefault(cm.parent_id, []).append(cm._id)
+        depth[cm._id] = depth[cm.parent_id] + 1 if cm.parent_id else 0
+        p_id = cm.parent_id
+        while p_id:
+            num_children[p_id] += 1
+            p_id = by_id[p_id].parent_id
+    return cids, cid_tree, depth, num_children
+
+def shape(things):
+    """The tree get_items built, as lists and tuples"""
+    res = []
+    for t in things:
+        if isinstance(t, FakeMore):
+            res.append((t.__class__.__name__, t.parent_id, t.count,
+                        [cm._id for cm in t.children]))
+        else:
+            child = shape(t.child.things) if hasattr(t, 'child') else []
+            res.append((t._id, child))
+    return res
+
+class TestCandidateQueue(TestCase):
+    def setUp(self):
+        self.saved = dict((name, getattr(builder, name))
+                          for name in ('link_comments', 'Comment',
+                                       'MoreChildren', 'MoreRecursion',
+                                       'Wrapped', 'empty_listing',
+                                       'CandidateQueue'))
+        builder.MoreChildren = FakeMoreChildren
+        builder.MoreRecursion = FakeMoreRecursion
+        builder.Wrapped = lambda thing: thing
+        builder.empty_listing = FakeListing
+
+    def tearDown(self):
+        for name, value in self.saved.iteritems():
+            setattr(builder, name, value)
+
+    def get_items(self, comments, queue, sort, num, **kw):
+        tree = comment_tree(comments)
+        by_id = dict((cm._id, cm) for cm in comments)
+        class FakeComment(object):
+            @staticmethod
+            def _byID(ids, data = False, return_dict = True):
+                if return_dict:
+                    return dict((i, by_id[i]) for i in ids)
+                return [by_id[i] for i in ids]
+        builder.Comment = FakeComment
+        # the builder changes the tree it's given for permalinks
+        builder.link_comments = lambda link_id, _update = False: deepcopy(tree)
+        builder.CandidateQueue = queue
+        b = TestBuilder(FakeLink(), sort, lazy = False, **kw)
+        return shape(b.get_items(num))
+
+    def assertSameItems(self, comments, *a, **kw):
+        self.assertEqual(self.get_items(comments, OldQueue, *a, **kw),
+                         self.get_items(comments, CandidateQueue, *a, **kw))
+
+    def test_matches_stable_sort(self):
+        rand = random.Random(42)
+        sorts = (operators.desc('_date'), operators.asc('_date'),
+                 operators.desc('_score'), operators.asc('_score'))
+        for x in xrange(100):
+            comments = random_thread(rand.randint(1, 150), rand)
+            num = rand.randint(1, 60)
+            # at least 2, so that "load more comments" has room for the
+            # siblings below their (unshown) parent
+            max_depth = rand.randint(2, 6)
+            for sort in sorts:
+                self.assertSameItems(comments, sort, num,
+                                     max_depth = max_depth)
+
+                # a permalink, with some of its parents
+                cm = rand.choice(comments)
+                self.assertSameItems(comments, sort, num, comment = cm,
+                                     context = rand.randint(0, 3),
+                                     max_depth = max_depth)
+
+                # "load more comments" for a set of siblings
+                siblings = [s for s in comments
+                            if s.parent_id == cm.parent_id]
+                self.assertSameItems(comments, sort, num,
+                                     comment = siblings[:5],
+                                     max_depth = max_depth)
+
+    def test_ties_keep_insertion_order(self):
+        cms = [FakeComment(i, None, 0, 0) for i in xrange(10)]
+        q = CandidateQueue(cms[:5], lambda x: x._date, reverse = True)
+        q.extend(cms[5:])
+        self.assertEqual([q.pop() for x in xrange(3)], cms[:3])
+        self.assertEqual(list(q.leftovers()), cms[3:])
@@ -0,0 +1,151 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is Reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+#
+# All portions of the code written by CondeNet are Copyright (c) 2006-2010
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+from unittest import TestCase
+from datetime import datetime
+
+import r2.lib.comment_tree as comment_tree_mod
+from r2.lib.comment_tree import CommentTree, compute_link_comments
+
+class FakeComment(object):
+    def __init__(self, _id, parent_id, ups = 1):
+        self._id = _id
+        self.parent_id = parent_id
+        self._ups = ups
+        self._downs = 0
+        self._date = datetime(2010, 1, 1)
+        self._deleted = False
+
+class TestCommentTree(TestCase):
+    def setUp(self):
+        # 1 <- 2 <- 3 is a normal thread; 5 <- 6 hang off 4, which
+        # has been lost
+        self.comments = [FakeComment(1, None), FakeComment(2, 1),
+                         FakeComment(3, 2), FakeComment(5, 4),
+                         FakeComment(6, 5)]
+
+    def test_compute(self):
+        cids, comment_tree, depth, num_children = \
+            compute_link_comments(self.comments)
+        self.assertEqual(depth, {1: 0, 2: 1, 3: 2})
+        self.assertEqual(num_children, {1: 2, 2: 1, 3: 0, 5: 1, 6: 0})
+        self.assertEqual(comment_tree, {None: [1], 1: [2], 2: [3],
+                                        4: [5], 5: [6]})
+
+    def test_orphans(self):
+        r = compute_link_comments(self.comments)
+        tree = CommentTree.from_tuple(123, r)
+        cids, comment_tree, depth, num_children = tree.to_tuple()
+        self.assertEqual(cids, [1, 2, 3, 5, 6])
+        self.assertEqual(comment_tree, r[1])
+        self.assertEqual(depth[3], 2)
+        self.assertEqual(depth[5], None)
+        self.assertEqual(num_children[5], 1)
+        self.assertTrue(6 in tree)
+
+    def test_legacy_orphans(self):
+        # legacy tuples may lack the counts of orphans too
+        r = ([1, 5], {None: [1], 4: [5]}, {1: 0}, {1: 0})
+        tree = CommentTree.from_tuple(123, r)
+        self.assertEqual(tree.to_tuple(),
+                         ([1, 5], {None: [1], 4: [5]}, {1: 0, 5: None},
+                          {1: 0, 5: 0}))
+
+class TestAddComments(TestCase):
+    def setUp(self):
+        r = compute_link_comments([FakeComment(1, None)])
+        self.tree = CommentTree.from_tuple(123, r)
+        self.saves = []
+        self.tree.save = lambda: self.saves.append(True)
+        self._comment_tree = comment_tree_mod.comment_tree
+        comment_tree_mod.comment_tree = lambda link_id: self.tree
+
+    def tearDown(self):
+        comment_tree_mod.comment_tree = self._comment_tree
+
+    def test_refresh_existing(self):
+        # a queued vote on 1 arrives in the same batch as a new reply
+        comment_tree_mod.add_comments_nolock(
+            123, [FakeComment(2, 1), FakeComment(1, None, ups = 5)])
+        sort_data = self.tree.sort_data()
+        self.assertEqual(sort_data[1][:3], (None, 5, 0))
+        self.assertEqual(sort_data[2][:3], (1, 1, 0))
+        self.assertEqual(self.tree.to_tuple()[3], {1: 1, 2: 0})
+        self.assertEqual(len(self.saves), 1)
+
+    def test_refresh_only(self):
+        comment_tree_mod.add_comments_nolock(123, [FakeComment(1, None, 7)])
+        self.assertEqual(self.tree.sort_data()[1][1], 7)
+        self.assertEqual(len(self.saves), 1)
+
+class FakeLink(object):
+    def __init__(self, _id):
+        self._id = _id
+        self._fullname = 't3_%d' % _id
+
+class FakeG(object):
+    amqp_host = 'localhost'
+
+    def __init__(self, lazy_comments):
+        self.lazy_comments = lazy_comments
+        self.cache = self
+        self.keys = set()
+
+    def add(self, key, val, time = 0):
+        if key in self.keys:
+            return False
+        self.keys.add(key)
+        return True
+
+class FakeAmqp(object):
+    def __init__(self):
+        self.items = []
+
+    def add_item(self, routing_key, body):
+        self.items.append((routing_key, body))
+
+class TestQueueing(TestCase):
+    def setUp(self):
+        self._g, self._amqp = comment_tree_mod.g, comment_tree_mod.amqp
+        comment_tree_mod.amqp = self.amqp = FakeAmqp()
+
+    def tearDown(self):
+        comment_tree_mod.g, comment_tree_mod.amqp = self._g, self._amqp
+
+    def test_votes(self):
+        comment_tree_mod.g = FakeG(lazy_comments = True)
+        comment = FakeComment(1, None)
+        comment._fullname = 't1_1'
+        comment_tree_mod.update_comment_votes([comment, comment])
+        self.assertEqual(self.amqp.items, [('commentstree_q', 't1_1')])
+
+    def test_votes_not_lazy(self):
+        comment_tree_mod.g = FakeG(lazy_comments = False)
+        comment_tree_mod.update_comment_votes([FakeComment(1, None)])
+        self.assertEqual(self.amqp.items, [])
+
+    def test_backfill_once(self):
+        comment_tree_mod.g = FakeG(lazy_comments = True)
+        for x in xrange(3):
+            comment_tree_mod.queue_sort_data_backfill(FakeLink(10))
+        comment_tree_mod.queue_sort_data_backfill(FakeLink(11))
+        self.assertEqual(self.amqp.items, [('commentstree_q', 't3_10'),
+                                           ('commentstree_q', 't3_11')])
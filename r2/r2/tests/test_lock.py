@@ -0,0 +1,154 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is Reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+#
+# All portions of the code written by CondeNet are Copyright (c) 2006-2010
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+import threading
+import time
+from unittest import TestCase
+
+from r2.lib import lock
+from r2.lib.lock import MemcacheLock, TimeoutExpired, key_prefix
+
+# the cache methods take a `time' argument
+now = time.time
+
+class FakeCache(object):
+    """Enough of memcache for locks, with expiring keys"""
+    def __init__(self):
+        self.data = {}
+        self.adds = 0
+        self.mutex = threading.Lock()
+
+    def _live(self, key):
+        if key in self.data and self.data[key][1] <= now():
+            del self.data[key]
+        return key in self.data
+
+    def add(self, key, val, time = 0):
+        with self.mutex:
+            self.adds += 1
+            if self._live(key):
+                return False
+            self.set(key, val, time)
+            return True
+
+    def set(self, key, val, time = 0):
+        self.data[key] = (val, now() + (time or 1e9))
+
+    def get(self, key):
+        with self.mutex:
+            if self._live(key):
+                return self.data[key][0]
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+class TestMemcacheLock(TestCase):
+    def setUp(self):
+        self.cache = FakeCache()
+        lock.lock_stats.clear()
+
+    def stats(self, prefix = 'comment_lock'):
+        return lock.lock_stats[prefix]
+
+    def test_key_prefix(self):
+        self.assertEqual(key_prefix('commit_t3_5'), 'commit')
+        self.assertEqual(key_prefix('comment_lock_abc'), 'comment_lock')
+        self.assertEqual(key_prefix('sr_messages_conversation_lock_12'),
+                         'sr_messages_conversation_lock')
+        self.assertEqual(key_prefix('add_query(abc)'), 'add_query')
+        self.assertEqual(key_prefix('something_else_1'), 'other')
+
+    def test_acquire_release(self):
+        with MemcacheLock('comment_lock_1', self.cache):
+            self.assertTrue(self.cache.get('comment_lock_1'))
+            # taking it again in the same thread doesn't wait
+            with MemcacheLock('comment_lock_1', self.cache):
+                pass
+        self.assertEqual(self.cache.get('comment_lock_1'), None)
+        self.assertEqual(self.stats()['acquired'], 1)
+        self.assertEqual(self.stats()['contended'], 0)
+        self.assertTrue(lock.stats_report()[0].startswith('comment_lock'))
+
+    def test_local_threads_wait_locally(self):
+        order = []
+        def other():
+            with MemcacheLock('comment_lock_1', self.cache):
+                order.append('other')
+        with MemcacheLock('comment_lock_1', self.cache):
+            t = threading.Thread(target = other)
+            t.start()
+            time.sleep(.1)
+            order.append('first')
+            # the other thread queued up here rather than polling
+            self.assertEqual(self.cache.adds, 1)
+        t.join()
+        self.assertEqual(order, ['first', 'other'])
+        self.assertEqual(self.cache.adds, 2)
+        self.assertEqual(self.stats()['contended'], 1)
+
+    def test_backoff(self):
+        # held by another process until its lease runs out
+        self.cache.add('comment_lock_1', 'elsewhere', time = .3)
+        start = time.time()
+        with MemcacheLock('comment_lock_1', self.cache, timeout = 5):
+            waited = time.time() - start
+        self.assertTrue(.3 <= waited < 1.5)
+        # polling every 10ms would have taken ~30 tries
+        self.assertTrue(self.cache.adds < 15)
+
+    def test_timeout(self):
+        self.cache.add('comment_lock_1', 'elsewhere', time = 10)
+        l = MemcacheLock('comment_lock_1', self.cache, timeout = .2)
+        self.assertRaises(TimeoutExpired, l.__enter__)
+        self.assertEqual(self.stats()['timeouts'], 1)
+        # and the next thread isn't stuck behind it
+        l = MemcacheLock('comment_lock_1', self.cache, timeout = .1)
+        self.assertRaises(TimeoutExpired, l.__enter__)
+
+    def test_no_renewal_by_default(self):
+        with MemcacheLock('comment_lock_1', self.cache, time = .2):
+            time.sleep(.5)
+            self.assertEqual(self.cache.get('comment_lock_1'), None)
+        self.assertEqual(self.stats()['renewed'], 0)
+
+    def test_renewal(self):
+        with MemcacheLock('comment_lock_1', self.cache, time = .2,
+                          renew = True):
+            time.sleep(.5)
+            self.assertTrue(self.cache.get('comment_lock_1'))
+        self.assertTrue(self.stats()['renewed'] >= 2)
+        self.assertEqual(self.cache.get('comment_lock_1'), None)
+
+    def test_renewal_capped(self):
+        with MemcacheLock('comment_lock_1', self.cache, time = .2,
+                          renew = True, max_hold = .3):
+            time.sleep(.8)
+            self.assertEqual(self.cache.get('comment_lock_1'), None)
+        self.assertEqual(self.stats()['capped'], 1)
+
+    def test_release_checks_token(self):
+        with MemcacheLock('comment_lock_1', self.cache, time = .1):
+            time.sleep(.2)
+            # the lease ran out and someone else took the lock
+            self.assertTrue(self.cache.add('comment_lock_1', 'elsewhere',
+                                           time = 10))
+        self.assertEqual(self.cache.get('comment_lock_1'), 'elsewhere')
+        self.assertEqual(self.stats()['lost'], 1)
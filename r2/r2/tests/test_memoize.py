@@ -0,0 +1,87 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is Reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+#
+# All portions of the code written by CondeNet are Copyright (c) 2006-2010
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+from __future__ import with_statement
+from contextlib import contextmanager
+from unittest import TestCase
+
+from pylons import g
+
+from r2.lib import memoize
+from r2.lib.memoize import StaleResult
+
+class FakeCache(object):
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, val, time = 0):
+        self.data[key] = val
+
+    def add(self, key, val, time = 0):
+        if key in self.data:
+            return False
+        self.data[key] = val
+        return True
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+@contextmanager
+def no_lock(key):
+    yield
+
+class TestStaleMemoize(TestCase):
+    def setUp(self):
+        self.cache = FakeCache()
+        self.saved = (memoize.cache, memoize.make_lock,
+                      getattr(g, 'memcache', None))
+        memoize.cache = self.cache
+        memoize.make_lock = no_lock
+        g.memcache = self.cache
+
+    def tearDown(self):
+        memoize.cache, memoize.make_lock, g.memcache = self.saved
+
+    def test_keys(self):
+        # the same function memoized with and without stale_time, as
+        # it is on two servers in the middle of a deploy
+        calls = []
+        def fn(x):
+            calls.append(x)
+            return [x]
+        plain = memoize.memoize('test_iden', time = 60)(fn)
+        stale = memoize.memoize('test_iden', time = 60, stale_time = 60)(fn)
+
+        self.assertEqual(stale(1), [1])
+        self.assertEqual(plain(1), [1])
+        self.assertEqual(calls, [1, 1])
+        self.assertEqual(len(self.cache.data), 2)
+
+        # neither reads (or overwrites) the other's entry
+        self.assertEqual(stale(1), [1])
+        self.assertEqual(plain(1), [1])
+        self.assertEqual(calls, [1, 1])
+        kinds = sorted(isinstance(v, StaleResult)
+                       for v in self.cache.data.values())
+        self.assertEqual(kinds, [False, True])
@@ -0,0 +1,165 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is Reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+#
+# All portions of the code written by CondeNet are Copyright (c) 2006-2010
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+from __future__ import with_statement
+import threading
+import time
+from contextlib import contextmanager
+from unittest import TestCase
+
+from r2.lib.db import queries
+from r2.lib.db.operators import desc
+from r2.lib.db.queries import QueryCoalescer, MergedCachedResults
+
+class FakeItem(object):
+    def __init__(self, fullname):
+        self._fullname = fullname
+
+class FakeQuery(object):
+    """a cached query that records the batches applied to it, and can
+    be held in the middle of one"""
+    iden = 'fake'
+
+    def __init__(self):
+        self.items = set()
+        self.batches = []
+        self.hold = None
+        self.active = 0
+        self.overlapped = False
+
+    def can_insert(self):
+        return True
+
+    def can_delete(self):
+        return True
+
+    def filter(self, item):
+        return item
+
+    def fetch(self, force = False):
+        pass
+
+    def apply_changes(self, inserts, deletes):
+        self.active += 1
+        self.overlapped = self.overlapped or self.active > 1
+        if self.hold:
+            self.hold.wait()
+        self.items.update(i._fullname for i in inserts)
+        self.items.difference_update(i._fullname for i in deletes)
+        self.batches.append(([i._fullname for i in inserts],
+                             [i._fullname for i in deletes]))
+        self.active -= 1
+
+class FakeWorker(object):
+    def __init__(self):
+        self.jobs = []
+
+    def do(self, fn):
+        self.jobs.append(fn)
+
+class FakeCache(object):
+    def reset(self):
+        pass
+
+@contextmanager
+def no_lock(key):
+    yield
+
+class TestQueryCoalescer(TestCase):
+    def setUp(self):
+        self._patched = [(name, getattr(queries, name))
+                         for name in ('worker', 'make_lock', 'query_cache')]
+        self.worker = queries.worker = FakeWorker()
+        queries.make_lock = no_lock
+        queries.query_cache = FakeCache()
+        self.coalescer = QueryCoalescer()
+        self.q = FakeQuery()
+
+    def tearDown(self):
+        if self.q.hold:
+            self.q.hold.set()
+        for name, old in self._patched:
+            setattr(queries, name, old)
+
+    def test_merge(self):
+        a, b = FakeItem('t3_a'), FakeItem('t3_b')
+        self.coalescer.add(self.q, insert_items = [a, b])
+        self.coalescer.add(self.q, delete_items = a)
+        self.assertEqual(len(self.worker.jobs), 1)
+        self.worker.jobs.pop()()
+        self.assertEqual(self.q.batches, [(['t3_b'], ['t3_a'])])
+        self.assertEqual(self.coalescer.stats['merged'], 1)
+        self.assertFalse(self.coalescer.scheduled)
+
+    def test_overlapping_flushes(self):
+        # a delete that comes in while the insert's flush is still
+        # running mustn't be flushed alongside it (by another worker
+        # thread), or it could be applied first and the item would
+        # come back
+        item = FakeItem('t3_a')
+        self.coalescer.add(self.q, insert_items = item)
+        self.q.hold = threading.Event()
+        first = threading.Thread(target = self.worker.jobs.pop())
+        first.setDaemon(True)
+        first.start()
+        while not self.q.active:
+            time.sleep(0.001)
+
+        self.coalescer.add(self.q, delete_items = item)
+        self.assertEqual(self.worker.jobs, [])
+        self.q.hold.set()
+        first.join()
+
+        # the delete gets a flush of its own once the first is done
+        self.assertEqual(len(self.worker.jobs), 1)
+        self.worker.jobs.pop()()
+        self.assertEqual(self.q.batches, [(['t3_a'], []), ([], ['t3_a'])])
+        self.assertEqual(self.q.items, set())
+        self.assertFalse(self.q.overlapped)
+        self.assertFalse(self.coalescer.scheduled)
+        self.assertEqual(self.worker.jobs, [])
+
+class FakeResults(object):
+    def __init__(self, sort, data):
+        self.sort = sort
+        self.data = data
+
+class TestMergedCachedResults(TestCase):
+    def merge(self, *listings):
+        sort = [desc('_score'), desc('_date')]
+        return MergedCachedResults([FakeResults(sort, data)
+                                    for data in listings])
+
+    def test_order(self):
+        m = self.merge([('t3_a', 5, 10), ('t3_c', 2, 30), ('t3_e', 1, 0)],
+                       [('t3_b', 3, 0), ('t3_d', 2, 30), ('t3_f', 2, 20)])
+        # ties keep the order of the listings
+        self.assertEqual(list(m), ['t3_a', 't3_b', 't3_c', 't3_d', 't3_f',
+                                   't3_e'])
+
+    def test_duplicates(self):
+        # t3_b is in both (e.g. 'top' for today and for the year), with
+        # a better score in the second. The copy from the first is kept
+        m = self.merge([('t3_a', 5, 0), ('t3_b', 3, 0)],
+                       [('t3_b', 10, 0), ('t3_c', 4, 0), ('t3_a', 1, 0)])
+        self.assertEqual(list(m), ['t3_a', 't3_c', 't3_b'])
+        self.assertEqual(m.data, [('t3_a', 5, 0), ('t3_c', 4, 0),
+                                  ('t3_b', 3, 0)])
@@ -0,0 +1,184 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is Reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+#
+# All portions of the code written by CondeNet are Copyright (c) 2006-2010
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+from __future__ import with_statement
+import sqlite3
+from contextlib import contextmanager
+from copy import deepcopy
+from unittest import TestCase
+
+import sqlalchemy as sa
+
+from r2.lib.db import tdb_sql as tdb
+from r2.lib.db import thing
+from r2.lib.db.thing import DataThing
+
+def connect():
+    conn = sqlite3.connect(':memory:')
+    # hand back strs rather than unicode, as postgres does
+    conn.text_factory = str
+    return conn
+
+def make_data_table():
+    """an empty data table in an in-memory sqlite db"""
+    metadata = sa.MetaData(sa.create_engine('sqlite://', creator = connect))
+    table = tdb.get_data_table(metadata, 'test')
+    table.create()
+    return table
+
+class FakeCache(object):
+    """keeps copies, as memcache would"""
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key, allow_local = True):
+        return deepcopy(self.data.get(key))
+
+    def set(self, key, val):
+        self.data[key] = deepcopy(val)
+
+    def set_multi(self, vals):
+        for key, val in vals.iteritems():
+            self.set(key, val)
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+class FakeG(object):
+    def __init__(self):
+        self.locks = []
+
+    @contextmanager
+    def make_lock(self, key):
+        self.locks.append(key)
+        yield
+
+class DataTest(DataThing):
+    _type_id = 1
+    _type_prefix = 't'
+    _base_props = ('_ups',)
+    next_id = 100
+
+    def __init__(self, id = None, ups = 0, **attrs):
+        DataThing.__init__(self)
+        with self.safe_set_attr:
+            self._ups = ups
+            if id:
+                self._id = id
+                self._created = True
+        for k, v in attrs.iteritems():
+            setattr(self, k, v)
+
+    @classmethod
+    def _make_fn(cls, type_id, ups):
+        cls.next_id += 1
+        return cls.next_id
+
+class TestSetDataMulti(TestCase):
+    def setUp(self):
+        self.table = make_data_table()
+
+    def test_insert(self):
+        tdb.set_data_multi(self.table, 1,
+                           {1: dict(title = u'h\xe9llo', ups = 5,
+                                    ratio = 0.5, nsfw = True, gone = None,
+                                    obj = {'a': [1, 2]}),
+                            2: dict(title = 'two', big = 2L ** 40),
+                            3: {}})
+        self.assertEqual(tdb.get_data(self.table, [1, 2, 3]),
+                         {1: dict(title = u'h\xe9llo'.encode('utf8'), ups = 5,
+                                  ratio = 0.5, nsfw = True, gone = None,
+                                  obj = {'a': [1, 2]}),
+                          2: dict(title = 'two', big = 2L ** 40)})
+
+    def test_update(self):
+        tdb.set_data_multi(self.table, 1,
+                           {1: dict(title = 'one', ups = 5, nsfw = True),
+                            2: dict(title = 'two')})
+        tdb.set_data_multi(self.table, 1,
+                           {1: dict(ups = None, nsfw = False,
+                                    obj = (1, 'x')),
+                            2: dict(title = u'tw\xf6'.encode('utf8'),
+                                  ups = 1.5)})
+        self.assertEqual(tdb.get_data(self.table, [1, 2]),
+                         {1: dict(title = 'one', ups = None, nsfw = False,
+                                  obj = (1, 'x')),
+                          2: dict(title = u'tw\xf6'.encode('utf8'),
+                                  ups = 1.5)})
+        # updated keys aren't inserted again
+        count = sa.select([sa.func.count()], from_obj = [self.table])
+        self.assertEqual(count.execute().scalar(), 6)
+
+    def test_set_data(self):
+        tdb.set_data(self.table, 1, 7, a = 1)
+        tdb.set_data(self.table, 1, 7, a = 2, b = 'x')
+        self.assertEqual(tdb.get_data(self.table, 7), dict(a = 2, b = 'x'))
+
+class TestCommitMulti(TestCase):
+    def setUp(self):
+        self.table = make_data_table()
+        self.props = []
+        DataTest._set_data_multi = staticmethod(
+            lambda type_id, data: tdb.set_data_multi(self.table, type_id,
+                                                      data))
+        DataTest._set_props = staticmethod(
+            lambda type_id, id, **props: self.props.append((id, props)))
+        self._cache, self._g = thing.cache, thing.g
+        thing.cache, thing.g = FakeCache(), FakeG()
+
+    def tearDown(self):
+        thing.cache, thing.g = self._cache, self._g
+
+    def test_commit_multi(self):
+        old = DataTest(id = 36, title = 'old', score = 1)
+        DataTest._commit_multi([old])
+        old.score = 2
+        old._ups = 3
+        unchanged = DataTest(id = 5)
+        unchanged._dirties.clear()
+        new = DataTest(title = u'n\xe9w', nsfw = False)
+        DataTest._commit_multi([old, unchanged, new])
+
+        self.assertEqual(tdb.get_data(self.table, [36, 5, new._id]),
+                         {36: dict(title = 'old', score = 2),
+                          new._id: dict(title = u'n\xe9w'.encode('utf8'),
+                                        nsfw = False)})
+        self.assertEqual(self.props, [(36, dict(ups = 3))])
+        self.assertFalse(old._dirties or new._dirties)
+        for t in (old, unchanged, new):
+            self.assertEqual(thing.cache.get(t._cache_key())._t, t._t)
+        # the locks of the second commit are taken in fullname order
+        self.assertEqual(thing.g.locks[1:],
+                         ['commit_' + t._fullname for t in
+                          sorted((old, unchanged, new),
+                                 key = lambda t: t._fullname)])
+
+    def test_sync_latest(self):
+        t = DataTest(id = 9, a = 1)
+        DataTest._commit_multi([t])
+        # another process committed b since this copy was loaded
+        other = DataTest(id = 9, a = 1, b = 2)
+        other._dirties.clear()
+        thing.cache.set(t._cache_key(), other)
+        t.a = 3
+        DataTest._commit_multi([t])
+        self.assertEqual(tdb.get_data(self.table, 9), dict(a = 3))
+        self.assertEqual(t.b, 2)
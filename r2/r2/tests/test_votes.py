@@ -0,0 +1,143 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is Reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+#
+# All portions of the code written by CondeNet are Copyright (c) 2006-2010
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+from unittest import TestCase
+
+from pylons import g
+
+from r2.lib.db import queries
+from r2.lib import count
+from r2.models import admintools, Account, Link, Subreddit, Vote
+
+class Recorder(object):
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda *a, **kw: self.calls.append((name, a, kw))
+
+class TestVoteBatch(TestCase):
+    """Runs votes through handle_votes (Vote.vote_batch and new_votes)
+    with the database, cache and query queue replaced by recorders"""
+    def patch(self, obj, name, value):
+        if isinstance(obj, type):
+            # so that inherited attributes are restored by deleting
+            old = obj.__dict__.get(name)
+        else:
+            old = getattr(obj, name, None)
+        self._patched.append((obj, name, old))
+        setattr(obj, name, value)
+
+    def tearDown(self):
+        for obj, name, old in reversed(self._patched):
+            if old is None:
+                delattr(obj, name)
+            else:
+                setattr(obj, name, old)
+
+    def setUp(self):
+        self._patched = []
+        self.LinkVote = Vote.rel(Account, Link)
+
+        self.sr = Subreddit(name = 'test', id = 1)
+        self.users = dict((i, Account(name = 'user%d' % i, id = i))
+                          for i in (1, 2, 3))
+        self.links = dict((i, Link(title = 'link', url = 'http://x/%d' % i,
+                                   sr_id = 1, author_id = 3, id = i))
+                          for i in (10, 11))
+        for thing in self.users.values() + self.links.values():
+            thing._loaded = True
+
+        self.commits = []
+        self.touched = []
+        self.scores = []
+        self.queued = []
+        self.next_id = [100]
+
+        def by_id(things):
+            def _byID(cls, ids, *a, **kw):
+                if isinstance(ids, (int, long)):
+                    return things[ids]
+                return dict((i, things[i]) for i in ids)
+            return classmethod(_byID)
+
+        def create_multi(cls, rels):
+            for r in rels:
+                r._id = self.next_id[0]
+                r._created = True
+                self.next_id[0] += 1
+
+        def touch(cls, thing1):
+            self.touched.append((cls, thing1._id))
+
+        def add_queries(qs, insert_items = None, delete_items = None):
+            self.queued.append((len(qs), insert_items, delete_items))
+
+        self.patch(Account, '_byID', by_id(self.users))
+        self.patch(Link, '_byID', by_id(self.links))
+        self.patch(Subreddit, '_byID',
+                   classmethod(lambda cls, *a, **kw: self.sr))
+        self.patch(Subreddit, '_commit', lambda self, *a: None)
+        self.patch(Account, 'karma', lambda self, kind, sr = None: 1)
+        self.patch(Account, 'incr_karma', lambda *a: None)
+        self.patch(Vote, '_fast_query',
+                   classmethod(lambda cls, sub, objs, names: {}))
+        self.patch(self.LinkVote, '_create_multi', classmethod(create_multi))
+        self.patch(self.LinkVote, '_commit',
+                   lambda v: self.commits.append(v))
+        # only the concrete relation keeps a timestamp
+        self.patch(self.LinkVote, '_fast_query_timestamp_touch',
+                   classmethod(touch))
+        self.patch(admintools, 'update_score',
+                   lambda obj, up, down, new, old:
+                       self.scores.append((obj._id, up, down)))
+        self.patch(count, 'incr_counts', lambda srs: None)
+        self.patch(g, 'cache', Recorder())
+        self.patch(g, 'hardcache', Recorder())
+
+        self.patch(queries, 'add_queries', add_queries)
+        self.patch(queries, 'expire_hot', lambda sr: None)
+        self.patch(queries, 'set_last_modified', lambda *a: None)
+        self.patch(queries, 'sup', Recorder())
+
+    def test_handle_votes(self):
+        u1, u2 = self.users[1], self.users[2]
+        l1, l2 = self.links[10], self.links[11]
+        queries.handle_votes([(u1, l1, True, '1.2.3.4', False, False),
+                              (u2, l1, False, '1.2.3.5', False, False),
+                              (u1, l2, True, '1.2.3.4', False, False),
+                              # changes u1's mind about l2
+                              (u1, l2, False, '1.2.3.4', False, False)])
+
+        self.assertEqual(sorted((v._thing1_id, v._thing2_id, v._name)
+                                for v in self.commits),
+                         [(1, 10, '1'), (1, 11, '-1'), (2, 10, '-1')])
+        self.assertEqual(sorted(self.scores),
+                         [(10, 1, 1), (11, 0, 1)])
+        # once per voter and relation, in vote_batch and in new_votes
+        self.assertEqual(sorted(self.touched),
+                         [(self.LinkVote, 1), (self.LinkVote, 1),
+                          (self.LinkVote, 2), (self.LinkVote, 2)])
+        # the hot, top and controversial listings are queued once for
+        # the subreddit, with both links
+        sr_queued = [q for q in self.queued if q[0] > 1]
+        self.assertEqual(len(sr_queued), 1)
+        self.assertEqual(sorted(l._id for l in sr_queued[0][1]), [10, 10, 11])
@@ -0,0 +1,208 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is Reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+#
+# All portions of the code written by CondeNet are Copyright (c) 2006-2010
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+from hashlib import md5
+from unittest import TestCase
+
+from pylons import c
+
+from r2.lib.wrapped import StringTemplate, StubResolver, CacheStub
+from r2.lib.wrapped import Wrapped, CachedTemplate, CachedVariable
+from r2.lib.wrapped import RenderKey, hash_key
+
+def var(name):
+    return StringTemplate.start_delim + name + StringTemplate.end_delim
+
+class StubResolverTest(TestCase):
+    def setUp(self):
+        # a page with a comment, which has a reply, found in the
+        # first and second rounds of the render loop
+        self.found = {
+            'hcomment': [(0, StringTemplate(u'<c>%s %s</c>' %
+                                            (var('display'), var('hreply'))),
+                          dict(display = u'shown'))],
+            'hreply': [(1, StringTemplate(u'<r>%s %s</r>' %
+                                          (var('display'), var('timesince'))),
+                        dict(display = u'collapsed'))],
+            }
+
+    def test_page(self):
+        stubs = StubResolver(self.found, dict(timesince = u'1 hour'))
+        page = stubs.page(StringTemplate(u'<body>%s</body>' %
+                                         var('hcomment')))
+        self.assertEqual(page, u'<body><c>shown <r>collapsed 1 hour</r>'
+                               u'</c></body>')
+
+    def test_cached_content(self):
+        stubs = StubResolver(self.found, dict(timesince = u'1 hour'))
+        # children are filled in, but variables are kept for later
+        self.assertEqual(stubs.cached_content('hcomment').template,
+                         u'<c>%s <r>collapsed %s</r></c>' %
+                         (var('display'), var('timesince')))
+
+    def test_cachable_primary(self):
+        # the primary template is itself found in round 0
+        stub = CacheStub(object(), 'html')
+        found = dict((name, [(rnd + 1, r, kw) for rnd, r, kw in entries])
+                     for name, entries in self.found.iteritems())
+        found[stub.name] = [(0, StringTemplate(var('hcomment')), {})]
+        stubs = StubResolver(found, {})
+        self.assertEqual(stubs.page(stub),
+                         u'<c>shown <r>collapsed %s</r></c>' %
+                         var('timesince'))
+
+    def test_matches_update(self):
+        # the old renderer: substitute until nothing changes
+        kwargs = dict(timesince = u'1 hour')
+        updates = dict(hreply = StringTemplate(u'<r>collapsed %s</r>' %
+                                               var('timesince')))
+        updates['hcomment'] = StringTemplate(u'<c>shown %s</c>' %
+                                             updates['hreply'].template)
+        updates = dict((k, v.finalize()) for k, v in updates.iteritems())
+        res = StringTemplate(var('hcomment') + var('missing'))
+        while True:
+            prev = res.finalize()
+            res = res.update(kwargs).update(updates)
+            if res.finalize() == prev:
+                break
+
+        stubs = StubResolver(self.found, kwargs)
+        self.assertEqual(stubs.page(StringTemplate(var('hcomment') +
+                                                   var('missing'))),
+                         res.finalize())
+
+    def test_cycle(self):
+        stubs = StubResolver({}, dict(a = var('b'), b = var('a')))
+        self.assertEqual(stubs.page(StringTemplate(var('a'))), var('a'))
+
+class FakeTemplate(object):
+    hash = 'd41d8cd98f00b204e9800998ecf8427e'
+
+class FakeSite(object):
+    path = '/r/test/'
+
+class FakeContext(object):
+    user_is_loggedin = user_is_admin = cname = False
+    domain_prefix = 'www'
+    lang = 'en'
+    site = FakeSite()
+
+class FakeThing(object):
+    _fullname = 't3_1'
+    title = u'a link'
+
+    def wrapped_cache_key(self, wrapped, style):
+        return [wrapped._fullname]
+
+class KeyWrapped(Wrapped):
+    cachable = True
+
+    def template(self, style = 'html'):
+        return FakeTemplate
+
+class OtherWrapped(KeyWrapped):
+    pass
+
+class KeyTemplate(CachedTemplate):
+    def template(self, style = 'html'):
+        return FakeTemplate
+
+class Nested(object):
+    def __init__(self, key):
+        self.key = key
+
+    def cache_key(self, *a):
+        return self.key
+
+class CacheKeyTest(TestCase):
+    def setUp(self):
+        c._push_object(FakeContext())
+
+    def tearDown(self):
+        c._pop_object()
+
+    def key(self, w):
+        return w.cache_key(None, 'html')
+
+    def test_hash_key(self):
+        key = RenderKey(md5('key').hexdigest())
+        self.assertTrue(hash_key(key) is key)
+        self.assertEqual(hash_key('key'), key)
+
+    def test_memoized(self):
+        w = KeyWrapped(FakeThing(), num = 1, score = [1, 2])
+        key = self.key(w)
+        self.assertTrue(isinstance(key, RenderKey))
+        self.assertTrue(self.key(w) is key)
+
+        w.num = 2
+        self.assertNotEqual(self.key(w), key)
+        w.num = 1
+        self.assertEqual(self.key(w), key)
+
+        # changed in place
+        w.score.append(3)
+        key = self.key(w)
+        self.assertNotEqual(key, self.key(KeyWrapped(FakeThing(), num = 1,
+                                                     score = [1, 2])))
+
+        # equal, but rendered differently
+        w.num = True
+        self.assertNotEqual(self.key(w), key)
+
+    def test_context(self):
+        w = KeyWrapped(FakeThing())
+        key = self.key(w)
+        c.lang = 'fr'
+        self.assertNotEqual(self.key(w), key)
+        self.assertNotEqual(w.cache_key(None, 'compact'), self.key(w))
+
+    def test_lookup_key(self):
+        thing = FakeThing()
+        w = KeyWrapped(thing)
+        key = self.key(w)
+        w._fullname = 't3_2'
+        self.assertNotEqual(self.key(w), key)
+
+    def test_class_name(self):
+        a = KeyWrapped(FakeThing(), render_class = FakeThing)
+        b = OtherWrapped(FakeThing(), render_class = FakeThing)
+        self.assertNotEqual(self.key(a), self.key(b))
+
+    def test_none(self):
+        a = KeyWrapped(FakeThing(), timesince = CachedVariable('timesince'))
+        b = KeyWrapped(FakeThing(), timesince = u'')
+        self.assertNotEqual(self.key(a), self.key(b))
+
+    def test_unfrozen(self):
+        # a value that is keyed by its own cache_key could change
+        # without the wrapper noticing, so the key isn't reused
+        nested = Nested(u'a')
+        w = KeyWrapped(FakeThing(), child = nested)
+        key = self.key(w)
+        self.assertFalse('_cache_key' in w.__dict__)
+        nested.key = u'b'
+        self.assertNotEqual(self.key(w), key)
+
+        t = KeyTemplate()
+        key = t.cache_key(None, 'html', nested)
+        nested.key = u'c'
+        self.assertNotEqual(t.cache_key(None, 'html', nested), key)
@@ -0,0 +1,4 @@
+#!/bin/bash
+
+cd ~/reddit/r2
+/usr/local/bin/saferun /tmp/organic.pid /usr/local/bin/paster run run.ini r2/lib/organic.py -c "set_organic_pools()"